@@ -7,7 +7,8 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer
 
 from router import router
-from streaming.sensors import serve_sensors
+from streaming.sensors import serve_sensors, specs_cache
+from streaming.store import responses
 
 
 logger = logging.getLogger(__name__)
@@ -18,10 +19,17 @@ logger = logging.getLogger(__name__)
 async def startup_event(app: FastAPI):
     aio.create_task(serve_sensors())
     logger.info("Started server listening to sensors")
+    if responses.archive:
+        aio.create_task(responses.archive.run())
+        logger.info("Started archiving responses")
 
     # наивный envelope
     yield
 
+    if responses.archive:
+        responses.archive.close()
+    specs_cache.save()
+
 
 app = FastAPI(lifespan=startup_event)
 
@@ -0,0 +1,94 @@
+"""
+Compares sensor ingest servers, run from backend_app directory:
+python bench_ingest.py [SENSORS] [REPORTS_PER_SENSOR]
+"""
+
+import sys
+import json
+import time
+import asyncio as aio
+
+from config import settings
+from streaming.store import ResponseRepo
+from streaming.sensors import serve_sensors
+from wire.codec import Schema, encode_report
+from wire.framing import SIZE, read_frame, write_frame
+
+
+PORT = 32399
+
+REPORT = {
+    "cpu": {"system": 2.8, "user": 6.5, "iowait": 0.0, "idle": 89.9, "freq": 1725},
+    "net": {"recv": 11131, "sent": 631},
+    "mem": {"used": 69.6, "swap": 0.0},
+    "dsk": {"read": 0, "write": 164},
+}
+
+
+async def connect(idx: int) -> aio.StreamWriter:
+    reader, writer = await aio.open_connection("127.0.0.1", PORT)
+    specs = {"header": f"bench!bench!n{idx:05}", "codecs": ["bin1", "json"]}
+    await write_frame(writer, json.dumps(specs).encode(encoding="utf-8"))
+    await read_frame(reader)
+    return writer
+
+
+async def bench(ingest: str, nsensors: int, nreports: int):
+    settings.streaming.ingest = ingest
+    server = aio.create_task(serve_sensors(PORT))
+    await aio.sleep(0.1)
+
+    start = time.perf_counter()
+    writers = await aio.gather(*(connect(idx) for idx in range(nsensors)))
+    conn_elapsed = time.perf_counter() - start
+
+    # count reports reaching ResponseRepo
+    received = 0
+    insert_body = ResponseRepo.insert_body
+
+    def counting_insert(self, *args):
+        nonlocal received
+        received += 1
+        return insert_body(self, *args)
+
+    ResponseRepo.insert_body = counting_insert
+
+    schema = Schema.from_report("std", REPORT)
+    announce = json.dumps(schema.to_dict()).encode(encoding="utf-8")
+    frame = encode_report(schema, time.time(), REPORT)
+    frame = SIZE.pack(len(frame)) + frame
+
+    for writer in writers:
+        await write_frame(writer, announce)
+    start = time.perf_counter()
+    # every sensor sends one report per tick, as in real life
+    for tick in range(nreports):
+        for writer in writers:
+            writer.write(frame)
+        while received < nsensors * tick:
+            await aio.sleep(0)
+    while received < nsensors * nreports:
+        await aio.sleep(0)
+    reports_elapsed = time.perf_counter() - start
+
+    ResponseRepo.insert_body = insert_body
+    for writer in writers:
+        writer.close()
+    server.cancel()
+    await aio.sleep(0.1)
+
+    print(
+        f"{ingest:>8}: {nsensors / conn_elapsed:10,.0f} connections/s"
+        f" {received / reports_elapsed:10,.0f} reports/s"
+    )
+
+
+async def main():
+    nsensors = int(sys.argv[1]) if len(sys.argv) >= 2 else 1000
+    nreports = int(sys.argv[2]) if len(sys.argv) >= 3 else 100
+    for ingest in ("streams", "protocol"):
+        await bench(ingest, nsensors, nreports)
+
+
+if __name__ == "__main__":
+    aio.run(main())
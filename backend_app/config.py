@@ -1,8 +1,11 @@
+import sys
 from pathlib import Path
 from pydantic import BaseModel
 
 
 BASE_DIR = Path(__file__).parent.parent
+# wire protocol is shared with sensors and lives in the repository root
+sys.path.append(str(BASE_DIR))
 
 
 class AuthJWT(BaseModel):
@@ -12,8 +15,78 @@ class AuthJWT(BaseModel):
     access_token_expire_min: int = 60 * 24
 
 
+class Streaming(BaseModel):
+    # codecs backend agrees to speak with sensors, ordered by preference
+    codecs: list[str] = ["bin1", "json"]
+    # frames from sensors bigger than that break the connection
+    max_frame_size: int = 16 * 1024**2
+    # "protocol" parses frames right in the event loop callbacks,
+    # "streams" runs coroutine with StreamReader per sensor
+    ingest: str = "protocol"
+    # pending sensor connections, they all come at once after backend restart
+    backlog: int = 4096
+    # number of ingest processes sharing sensors port, 0 to ingest in web process
+    shards: int = 0
+    # unix socket shards forward reports through
+    shards_socket: str = "/tmp/rte-ingest.sock"
+    # bytes shard may have queued for web process before it stops reading sensors
+    shards_high_water: int = 4 * 1024**2
+    # seconds responses to clients are collected before being sent in one frame
+    flush_window: float = 0.05
+    # budget of outgoing queue of every client, then only the latest responses are kept
+    client_max_frames: int = 64
+    client_max_bytes: int = 4 * 1024**2
+    # seconds client may stay over budget before being disconnected
+    client_evict_after: float = 30
+    # standard responses kept in memory for every sensor
+    history_size: int = 3600
+    # sensors send full report every delta_keyframe ticks and only changes in between,
+    # 0 to always get full reports. Deltas are json frames, so sensors on binary codec
+    # asked for them send json, turn on only where json deltas beat bin1 reports
+    delta_keyframe: int = 0
+    # changes not bigger than that are not sent
+    delta_epsilon: float = 0
+    # compression of delta frames, None to send them as plain json
+    delta_compress: str | None = "zlib"
+    # sensors on binary codec send up to batch_samples samples in one frame,
+    # waiting no longer than batch_window seconds, 0 to send every sample
+    batch_samples: int = 0
+    batch_window: float = 1
+    # seconds subscription changes are collected before sensors get their new prompts
+    prompt_debounce: float = 0.5
+    # prompts being sent to sensors at once and seconds sensor has to confirm one
+    prompt_concurrency: int = 256
+    prompt_timeout: float = 10
+    # shortest interval between samples topics may ask sensors for
+    min_interval: float = 0.1
+    # seconds between samples of sensors nobody is subscribed to
+    idle_interval: float = 60
+    # prompts sensor keeps by hash, the same as its PROMPT_CACHE_SIZE
+    prompt_cache_size: int = 16
+    # specs of sensors by resume token, kept over restarts so sensors coming back
+    # at once send short resume frames instead of specs
+    specs_cache: Path = BASE_DIR / "backend_app" / "specs.cache.json"
+
+
+class Archive(BaseModel):
+    enabled: bool = True
+    path: Path = BASE_DIR / "backend_app" / "archive"
+    # rows in one segment file of raw responses or rollups
+    segment_rows: int = 1024**2
+    # seconds between writes of responses collected in memory
+    flush_interval: float = 1
+    # seconds between builds of rollups
+    compact_interval: float = 10
+    # seconds late responses are waited for before their bucket is rolled up
+    compact_lag: float = 5
+    # bucket lengths of rollup tiers in seconds, each built from the previous one
+    tiers: list[int] = [10, 60, 600]
+
+
 class Settings(BaseModel):
     auth_jwt: AuthJWT = AuthJWT()
+    streaming: Streaming = Streaming()
+    archive: Archive = Archive()
 
 
 settings = Settings()
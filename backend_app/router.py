@@ -13,6 +13,7 @@ from models import User
 from config import settings
 from auth import encode_jwt, decode_jwt
 from streaming.clients import ws_router
+from streaming.store import clients, queries
 
 
 logger = logging.getLogger(__name__)
@@ -96,6 +97,13 @@ def get_data_from_jwt_cookie(request: Request):
     return public_user_data
 
 
+@router.get("/internal/metrics")
+async def metrics(user_data: dict = Depends(get_data_from_jwt_cookie)):
+    logger.info("GET: /internal/metrics")
+    logger.info(f"Client {user_data['name']} read metrics")
+    return {"clients": clients.metrics(), "queries": queries.metrics()}
+
+
 @router.get("/check-cookie-login")
 async def check_cookie_login(user_data: dict = Depends(get_data_from_jwt_cookie)):
     logger.info("GET: /check-cookie-login")
@@ -0,0 +1,552 @@
+import sys
+import json
+import math
+import time
+import struct
+import mmap
+import shutil
+import logging
+import asyncio as aio
+from array import array
+from itertools import compress, repeat
+from operator import eq, and_
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+NAN = math.nan
+# aggregates kept by rollup tiers for every field
+AGGREGATES = ("min", "max", "avg", "last")
+
+
+class Segment:
+    """
+    Append-only columnar file of fixed capacity mapped into memory.
+    Page 0 holds number of rows and json header with column names,
+    then every column takes capacity * 8 bytes of doubles. The first column
+    is time, the earliest and the latest time of every block of BLOCK rows
+    follow the columns. Readers skip blocks out of the time range and slice
+    the ones in it without a scan, so late rows and sensors with skewed clocks
+    cost a scan of only the blocks they land in
+    """
+
+    HEADER = mmap.PAGESIZE
+    COUNT = struct.Struct("<Q")
+    # rows of one block of time bounds
+    BLOCK = 4096
+
+    __slots__ = (
+        "path",
+        "columns",
+        "capacity",
+        "count",
+        "block",
+        "blocks",
+        "first",
+        "last",
+        "file",
+        "mm",
+        "view",
+        "cols",
+    )
+
+    def __init__(self, path: Path, columns: list[str] | None = None, capacity: int = 0):
+        self.path = path
+        if not path.exists():
+            header = {"columns": columns, "capacity": capacity, "block": self.BLOCK}
+            with open(path, "wb") as file:
+                file.write(self.COUNT.pack(0) + json.dumps(header).encode())
+                # sparse until rows are written
+                file.truncate(
+                    self.HEADER + len(columns) * capacity * 8 + -(-capacity // self.BLOCK) * 16
+                )
+
+        self.file = open(path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        header_end = self.mm.find(b"}", self.COUNT.size) + 1
+        header = json.loads(self.mm[self.COUNT.size : header_end])
+        self.columns = header["columns"]
+        self.capacity = header["capacity"]
+        self.count = self.COUNT.unpack_from(self.mm, 0)[0]
+        self.view = view = memoryview(self.mm)
+        size = self.capacity * 8
+        self.cols = [
+            view[self.HEADER + i * size : self.HEADER + (i + 1) * size].cast("d")
+            for i in range(len(self.columns))
+        ]
+        self.first, self.last = math.inf, -math.inf
+        if (block := header.get("block")) is not None:
+            self.block = block
+            offset = self.HEADER + len(self.columns) * size
+            # min and max time of block i at 2 * i and 2 * i + 1
+            self.blocks = view[offset : offset + -(-self.capacity // block) * 16].cast("d")
+            if self.count:
+                used = self.blocks[: -(-self.count // block) * 2]
+                self.first, self.last = min(used[::2]), max(used[1::2])
+        else:
+            # segment of a previous version, blocks are kept in memory only
+            self.block = self.BLOCK
+            self.blocks = array("d", bytes(-(-self.capacity // self.BLOCK) * 16))
+            self._bound(0, self.cols[0][: self.count])
+
+    def free(self) -> int:
+        return self.capacity - self.count
+
+    # appends columns of equal length, returns number of rows written
+    def append(self, cols: list[array], start: int = 0) -> int:
+        n = min(len(cols[0]) - start, self.free())
+        for col, values in zip(self.cols, cols):
+            col[self.count : self.count + n] = values[start : start + n]
+        self._bound(self.count, cols[0][start : start + n])
+        self.count += n
+        self.COUNT.pack_into(self.mm, 0, self.count)
+        return n
+
+    # widens bounds of blocks by times written from row on
+    def _bound(self, row: int, times):
+        blocks, block = self.blocks, self.block
+        pos = 0
+        while pos < len(times):
+            idx, offset = divmod(row + pos, block)
+            chunk = times[pos : pos + block - offset]
+            low, high = min(chunk), max(chunk)
+            if offset:
+                # block has rows already
+                low, high = min(low, blocks[2 * idx]), max(high, blocks[2 * idx + 1])
+            blocks[2 * idx], blocks[2 * idx + 1] = low, high
+            self.first, self.last = min(self.first, low), max(self.last, high)
+            pos += len(chunk)
+
+    # (lo, hi, whole) runs of rows that may have start <= time < end,
+    # whole when all rows of the run have
+    def spans(self, start: float, end: float):
+        blocks, block = self.blocks, self.block
+        run = None
+        for idx in range(-(-self.count // block)):
+            low, high = blocks[2 * idx], blocks[2 * idx + 1]
+            if high < start or low >= end:
+                continue
+            lo, hi = idx * block, min((idx + 1) * block, self.count)
+            whole = start <= low and high < end
+            if run is not None and run[2] and whole and run[1] == lo:
+                run[1] = hi
+                continue
+            if run is not None:
+                yield tuple(run)
+            run = [lo, hi, whole]
+        if run is not None:
+            yield tuple(run)
+
+    def column(self, name: str) -> memoryview | None:
+        if name not in self.columns:
+            return None
+        return self.cols[self.columns.index(name)][: self.count]
+
+    def close(self):
+        for col in self.cols:
+            col.release()
+        if isinstance(self.blocks, memoryview):
+            self.blocks.release()
+        self.view.release()
+        self.mm.close()
+        self.file.close()
+
+
+class Tier:
+    """
+    Sequence of segments in one directory, step is 0 for raw responses
+    and bucket length in seconds for rollups. Segments of the previous run
+    with other columns are still read, columns they lack come as NaN
+    """
+
+    __slots__ = ("path", "step", "columns", "segments")
+
+    def __init__(self, path: Path, step: int, columns: list[str]):
+        self.path = path
+        self.step = step
+        self.columns = columns
+        path.mkdir(parents=True, exist_ok=True)
+        self.segments = [Segment(seg) for seg in sorted(path.glob("*.seg"))]
+        # new rows go to segment of the current columns
+        if self.segments and self.segments[-1].columns != columns:
+            self._open_segment()
+
+    def _open_segment(self):
+        seq = len(self.segments)
+        self.segments.append(
+            Segment(
+                self.path / f"{seq:08}.seg",
+                self.columns,
+                settings.archive.segment_rows,
+            )
+        )
+
+    def append(self, cols: list[array]):
+        start = 0
+        while start < len(cols[0]):
+            if not self.segments or not self.segments[-1].free():
+                self._open_segment()
+            start += self.segments[-1].append(cols, start)
+
+    # (segment, lo, hi, rows) of rows with start <= time < end of sensor
+    # (any sensor if None), rows is None when all of lo:hi are
+    def _select(self, start: float, end: float, sensor: int | None = None):
+        for seg in self.segments:
+            if not seg.count or seg.last < start or seg.first >= end:
+                continue
+            for lo, hi, whole in seg.spans(start, end):
+                if whole and sensor is None:
+                    yield seg, lo, hi, None
+                    continue
+                mask = None
+                if not whole:
+                    mask = [start <= t < end for t in seg.cols[0][lo:hi]]
+                if sensor is not None:
+                    mine = map(eq, seg.column("sensor")[lo:hi], repeat(sensor))
+                    mask = list(mine) if mask is None else list(map(and_, mask, mine))
+                if rows := list(compress(range(lo, hi), mask)):
+                    yield seg, lo, hi, rows
+
+    # rows with start <= time < end of sensor (any sensor if None) as columns
+    def read(self, start: float, end: float, sensor: int | None = None) -> dict[str, array]:
+        out = {name: array("d") for name in self.columns}
+        for seg, lo, hi, rows in self._select(start, end, sensor):
+            count = hi - lo if rows is None else len(rows)
+            for name, values in out.items():
+                if (col := seg.column(name)) is None:
+                    values.extend(array("d", [NAN]) * count)
+                elif rows is None:
+                    values.frombytes(col[lo:hi].cast("B"))
+                else:
+                    values.extend(map(col.__getitem__, rows))
+        return out
+
+    # rollup rows of sensor replace its rows of the same buckets, the others are appended
+    def replace(self, cols: list[array], sensor: int):
+        times = cols[0]
+        if not len(times):
+            return
+        kept = {}
+        for seg, lo, hi, rows in self._select(times[0], times[-1] + 1, sensor):
+            time_col = seg.cols[0]
+            for row in range(lo, hi) if rows is None else rows:
+                kept[time_col[row]] = (seg, row)
+        new = []
+        for idx, bucket in enumerate(times):
+            if (place := kept.get(bucket)) is None:
+                new.append(idx)
+                continue
+            seg, row = place
+            for name, values in zip(self.columns, cols):
+                if name in seg.columns:
+                    seg.cols[seg.columns.index(name)][row] = values[idx]
+        if new:
+            self.append([array("d", map(values.__getitem__, new)) for values in cols])
+
+    def close(self):
+        for seg in self.segments:
+            seg.close()
+
+
+class BatchArchive:
+    __slots__ = (
+        "path",
+        "fields",
+        "labels",
+        "labels_saved",
+        "pending",
+        "tiers",
+        "marks",
+        "late",
+    )
+
+    def __init__(self, path: Path, fields: list[str]):
+        self.path = path
+        self.fields = fields
+        path.mkdir(parents=True, exist_ok=True)
+
+        labels_path = path / "labels.json"
+        labels = json.loads(labels_path.read_text()) if labels_path.exists() else []
+        # label -> sensor id stored in sensor column
+        self.labels = {label: idx for idx, label in enumerate(labels)}
+        self.labels_saved = len(labels)
+
+        raw_columns = ["time", "sensor", *fields]
+        # columns of raw rows not yet written to disk
+        self.pending = [array("d") for _ in raw_columns]
+        self.tiers = [Tier(path / "raw", 0, raw_columns)]
+        rollup_columns = ["time", "sensor", "count"] + [
+            f"{field}:{agg}" for field in fields for agg in AGGREGATES
+        ]
+        for step in settings.archive.tiers:
+            self.tiers.append(Tier(path / f"{step}s", step, rollup_columns))
+
+        marks_path = path / "marks.json"
+        # step -> time up to which rollups are built
+        self.marks = json.loads(marks_path.read_text()) if marks_path.exists() else {}
+        late_path = path / "late.json"
+        late = json.loads(late_path.read_text()) if late_path.exists() else {}
+        # sensor -> the earliest time of its rows written after their bucket was rolled up
+        self.late = {int(sensor): time for sensor, time in late.items()}
+
+    # called in event loop, only appends to memory
+    def append(self, label: str, time: float, values):
+        if (sensor := self.labels.get(label)) is None:
+            sensor = self.labels[label] = len(self.labels)
+        pending = self.pending
+        pending[0].append(time)
+        pending[1].append(sensor)
+        for col, value in zip(pending[2:], values):
+            col.append(value)
+
+    # samples of a batch, column by column, None for columns sensor didn't report
+    def extend(self, label: str, times: list, cols: list):
+        if (sensor := self.labels.get(label)) is None:
+            sensor = self.labels[label] = len(self.labels)
+        count = len(times)
+        pending = self.pending
+        pending[0].extend(times)
+        pending[1].extend(array("d", [sensor]) * count)
+        for col, values in zip(pending[2:], cols):
+            col.extend(array("d", [NAN]) * count if values is None else values)
+
+    def take_pending(self) -> list[array]:
+        pending = self.pending
+        self.pending = [array("d") for _ in pending]
+        return pending
+
+    # called in archive thread
+    def flush(self, pending: list[array]):
+        if len(self.labels) != self.labels_saved:
+            labels = sorted(self.labels, key=self.labels.get)
+            (self.path / "labels.json").write_text(json.dumps(labels))
+            self.labels_saved = len(labels)
+        if len(pending[0]):
+            self._note_late(pending)
+            self.tiers[0].append(pending)
+
+    # spooled rows and rows of sensors with clocks behind may come after
+    # compaction passed their time, their buckets are rolled up again
+    def _note_late(self, pending: list[array]):
+        if len(self.tiers) < 2:
+            return
+        mark = self.marks.get(str(self.tiers[1].step), 0)
+        times = pending[0]
+        if min(times) >= mark:
+            return
+        for time, sensor in zip(times, pending[1]):
+            if time < mark and not self.late.get(int(sensor), math.inf) <= time:
+                self.late[int(sensor)] = time
+        # kept until compaction, rows on disk are not rolled up only once
+        (self.path / "late.json").write_text(json.dumps(self.late))
+
+    # builds rollups of closed buckets, every tier is built from the previous one
+    def compact(self, now: float):
+        limit = now - settings.archive.compact_lag
+        late = self.late
+        for src, dst in zip(self.tiers, self.tiers[1:]):
+            step = dst.step
+            mark = self.marks.get(str(step), 0)
+            # buckets late rows fell into replace their rollups,
+            # so do the buckets of coarser tiers covering them
+            late = {sensor: time // step * step for sensor, time in late.items() if time < mark}
+            for sensor, since in late.items():
+                dst.replace(self._rollup(src, step, src.read(since, mark, sensor)), sensor)
+            upto = limit // step * step
+            if upto > mark:
+                rows = src.read(mark, upto)
+                if rows["time"]:
+                    dst.append(self._rollup(src, step, rows))
+                self.marks[str(step)] = mark = upto
+            # coarser tier is built only from what this one covers
+            limit = mark
+        (self.path / "marks.json").write_text(json.dumps(self.marks))
+        if self.late:
+            self.late = {}
+            (self.path / "late.json").unlink(missing_ok=True)
+
+    def _rollup(self, src: Tier, step: int, rows: dict) -> list[array]:
+        # (bucket, sensor) -> [count, [min, max, sum, n, last, time of last] per field],
+        # late rows come after the later ones, so last goes by time, not by order
+        buckets = {}
+        times, sensors = rows["time"], rows["sensor"]
+        nfields = len(self.fields)
+        if src.step:
+            counts = rows["count"]
+            srcs = [
+                [rows[f"{field}:{agg}"] for agg in AGGREGATES] for field in self.fields
+            ]
+        else:
+            counts = None
+            srcs = [[rows[field]] * 4 for field in self.fields]
+
+        for i, t in enumerate(times):
+            key = (t // step * step, sensors[i])
+            count = counts[i] if counts else 1
+            if (acc := buckets.get(key)) is None:
+                acc = buckets[key] = [0, [[NAN, NAN, 0.0, 0, NAN, -math.inf] for _ in range(nfields)]]
+            acc[0] += count
+            for facc, (mins, maxs, avgs, lasts) in zip(acc[1], srcs):
+                if (avg := avgs[i]) != avg:
+                    continue
+                facc[0] = mins[i] if not facc[0] <= mins[i] else facc[0]
+                facc[1] = maxs[i] if not facc[1] >= maxs[i] else facc[1]
+                facc[2] += avg * count
+                facc[3] += count
+                if t >= facc[5]:
+                    facc[4], facc[5] = lasts[i], t
+
+        out = [array("d") for _ in range(3 + 4 * nfields)]
+        for (bucket, sensor), (count, faccs) in sorted(buckets.items()):
+            out[0].append(bucket)
+            out[1].append(sensor)
+            out[2].append(count)
+            for j, (fmin, fmax, fsum, n, last, _) in enumerate(faccs):
+                base = 3 + 4 * j
+                out[base].append(fmin)
+                out[base + 1].append(fmax)
+                out[base + 2].append(fsum / n if n else NAN)
+                out[base + 3].append(last)
+        return out
+
+    def query(self, label: str, start: float, end: float, resolution: float) -> dict:
+        if (sensor := self.labels.get(label)) is None:
+            return {"step": 0, "time": []}
+        # the coarsest tier still fine enough for requested resolution
+        tier = self.tiers[0]
+        for candidate in self.tiers[1:]:
+            if candidate.step <= resolution:
+                tier = candidate
+        rows = tier.read(start, end, sensor)
+        del rows["sensor"]
+        resp = {"step": tier.step}
+        for name, values in rows.items():
+            # json has no NaN
+            resp[name] = [None if v != v else v for v in values]
+        return resp
+
+    def close(self):
+        for tier in self.tiers:
+            tier.close()
+
+
+class Archive:
+    """
+    On-disk store of standard responses. Responses are appended to memory
+    in event loop, written to segments and compacted into rollups in
+    a dedicated thread, so neither disk nor compaction blocks the loop
+    """
+
+    __slots__ = ("path", "fields", "batches", "executor")
+
+    def __init__(self, path: Path, measures: dict):
+        self.path = Path(path)
+        # (cat, field) of standard response stored in columns "cat.field"
+        self.fields = [(cat, field) for cat, fields in measures.items() for field in fields]
+        self.batches = {}
+        # single thread keeps writes, compaction and queries ordered
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+    def _batch(self, batch: str) -> BatchArchive:
+        if (arch := self.batches.get(batch)) is None:
+            arch = self.batches[batch] = BatchArchive(
+                self.path / batch, [f"{cat}.{field}" for cat, field in self.fields]
+            )
+        return arch
+
+    def append(self, batch: str, label: str, time, resp: dict):
+        self._batch(batch).append(
+            label,
+            float(time),
+            [resp.get(cat, {}).get(field, NAN) for cat, field in self.fields],
+        )
+
+    def extend(self, batch: str, label: str, times: list, columns: dict):
+        self._batch(batch).extend(label, times, [columns.get(key) for key in self.fields])
+
+    def _flush(self, pending: dict):
+        for batch, cols in pending.items():
+            self.batches[batch].flush(cols)
+
+    def _compact(self):
+        now = time.time()
+        for arch in list(self.batches.values()):
+            arch.compact(now)
+
+    async def flush(self):
+        pending = {batch: arch.take_pending() for batch, arch in self.batches.items()}
+        await aio.get_running_loop().run_in_executor(self.executor, self._flush, pending)
+
+    async def compact(self):
+        await aio.get_running_loop().run_in_executor(self.executor, self._compact)
+
+    async def query(self, batch: str, label: str, start: float, end: float, resolution: float) -> dict:
+        # batch may be stored by previous run only
+        if batch not in self.batches and not (self.path / batch).exists():
+            return {"step": 0, "time": []}
+        return await aio.get_running_loop().run_in_executor(
+            self.executor, self._batch(batch).query, label, start, end, resolution
+        )
+
+    # background task started with the application
+    async def run(self):
+        last_compact = time.monotonic()
+        while True:
+            await aio.sleep(settings.archive.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_compact >= settings.archive.compact_interval:
+                await self.compact()
+                last_compact = time.monotonic()
+
+    def close(self):
+        self._flush({batch: arch.take_pending() for batch, arch in self.batches.items()})
+        for arch in self.batches.values():
+            arch.close()
+
+
+# python -m streaming.archive [SENSORS] [TICKS]
+# writes TICKS reports of SENSORS sensors and queries them back
+async def _bench(nsensors: int, nticks: int):
+    with open("json/measures.standard.json", "r") as file:
+        measures = json.load(file)
+    path = Path("/tmp/rte-archive-bench")
+    shutil.rmtree(path, ignore_errors=True)
+    archive = Archive(path, measures)
+    resp = {cat: {field: 1.0 for field in fields} for cat, fields in measures.items()}
+    t0 = time.time() - nticks - 1000
+
+    append_elapsed = flush_elapsed = 0
+    for tick in range(nticks):
+        start = time.perf_counter()
+        for idx in range(nsensors):
+            archive.append("bench", f"n{idx:05}", t0 + tick, resp)
+        append_elapsed += time.perf_counter() - start
+        start = time.perf_counter()
+        await archive.flush()
+        flush_elapsed += time.perf_counter() - start
+    rows = nsensors * nticks
+    print(f"append:  {rows / append_elapsed:12,.0f} rows/s in event loop")
+    print(f"flush:   {rows / flush_elapsed:12,.0f} rows/s to disk")
+
+    start = time.perf_counter()
+    await archive.compact()
+    print(f"compact: {rows / (time.perf_counter() - start):12,.0f} rows/s")
+
+    for resolution in (1, 10, 60):
+        start = time.perf_counter()
+        resp = await archive.query("bench", "n00042", t0, t0 + nticks, resolution)
+        elapsed = time.perf_counter() - start
+        print(f"query resolution {resolution:>2}s: {len(resp['time'])} rows in {elapsed * 1000:.1f} ms")
+
+    archive.close()
+    shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    nsensors = int(sys.argv[1]) if len(sys.argv) >= 2 else 10_000
+    nticks = int(sys.argv[2]) if len(sys.argv) >= 3 else 60
+    aio.run(_bench(nsensors, nticks))
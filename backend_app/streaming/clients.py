@@ -1,7 +1,8 @@
 import json
 import logging
+from functools import lru_cache
 from fastapi import APIRouter, WebSocket
-from streaming.store import clients, sensors
+from streaming.store import clients, sensors, responses
 
 
 logger = logging.getLogger(__name__)
@@ -19,7 +20,15 @@ async def handle_client(ws: WebSocket):
     "spec?BATCH?LABEL" - get SPECifications of machine with LABEL in BATCH
     "desc?BATCH?LABEL" - DESCribe fields for specific machine with LABEL in BATCH
     "mext?BATCH?LABEL" - EXTended Monitoring to machine with LABEL in BATCH
-    "stop" - stop subscription
+    "subs?TOPIC" - SUBScribe to TOPIC in addition to other subscriptions,
+        TOPIC is "BATCH[!LABEL[!CAT[!FIELD,FIELD...]]][@SECONDS]", "*" matches any batch,
+        label or category and SECONDS is the longest interval between samples client wants
+    "usub?TOPIC" - UnSUBscribe from TOPIC
+    "hist?BATCH?LABEL?SECONDS" - get HISTory of the last SECONDS of machine with LABEL in BATCH
+    "arch?BATCH?LABEL?START?END?RESOLUTION" - get ARCHived responses of machine with LABEL in BATCH
+        between START and END timestamps, aggregated to RESOLUTION seconds if possible
+    "stop" - stop all subscriptions
+    "mstd" and "mext" replace all subscriptions of the client
     """
 
     # websocket connecting
@@ -38,6 +47,7 @@ async def handle_client(ws: WebSocket):
                     await send_table_header(ws, batch)
                 case "mstd":
                     batch = msg.split("?")[1]
+                    clients.unsubscribe(ws)
                     clients.subscribe(ws, batch)
                 case "spec":
                     batch, label = msg.split("?")[1:3]
@@ -47,7 +57,20 @@ async def handle_client(ws: WebSocket):
                     await send_description(ws, batch, label)
                 case "mext":
                     batch, label = msg.split("?")[1:3]
+                    clients.unsubscribe(ws)
                     clients.subscribe(ws, f"{batch}!{label}")
+                case "subs":
+                    clients.subscribe(ws, msg.split("?")[1])
+                case "usub":
+                    clients.unsubscribe(ws, msg.split("?")[1])
+                case "hist":
+                    batch, label, seconds = msg.split("?")[1:4]
+                    await send_history(ws, batch, label, float(seconds))
+                case "arch":
+                    batch, label, start, end, resolution = msg.split("?")[1:6]
+                    await send_archive(
+                        ws, batch, label, float(start), float(end), float(resolution)
+                    )
                 case "stop":
                     clients.unsubscribe(ws)
 
@@ -56,31 +79,58 @@ async def handle_client(ws: WebSocket):
             break
 
 
+# static responses are serialised once and sent as they are,
+# dashboards reloading at once don't make a json of each
 async def send_batches(ws: WebSocket):
-    resp = {"header": "lsob", "batches": sensors.batches}
-    await ws.send_json(resp)
+    await ws.send_text(sensors.batches_frame())
     logger.info(f"Sent batches to client {ws.client}")
 
 
 async def send_spec(ws: WebSocket, batch: str, label: str):
-    resp = {"header": f"spec!{batch}!{label}", **sensors.get_specs(batch, label)}
-    await ws.send_json(resp)
+    await ws.send_text(sensors.specs_frame(batch, label))
     logger.info(f"Sent specs to client {ws.client}")
 
 
+async def send_history(ws: WebSocket, batch: str, label: str, seconds: float):
+    resp = {
+        "header": f"hist!{batch}!{label}",
+        **responses.history.window(batch, label, seconds),
+    }
+    await ws.send_json(resp)
+    logger.info(f"Sent history to client {ws.client}")
+
+
+async def send_archive(
+    ws: WebSocket, batch: str, label: str, start: float, end: float, resolution: float
+):
+    if not responses.archive:
+        return
+    resp = {
+        "header": f"arch!{batch}!{label}",
+        **await responses.archive.query(batch, label, start, end, resolution),
+    }
+    await ws.send_json(resp)
+    logger.info(f"Sent archive to client {ws.client}")
+
+
 with open("json/measures.standard.json", "r") as file:
     measures_std = json.load(file)
 with open("json/measures.extended.json", "r") as file:
     measures_ext = json.load(file)
 
 
+# measures don't change while backend runs, batch and label come from clients,
+# so the number of cached frames is bounded
+@lru_cache(maxsize=4096)
+def measures_frame(header: str, extended: bool) -> str:
+    return json.dumps({"header": header, **(measures_ext if extended else measures_std)})
+
+
 async def send_table_header(ws: WebSocket, batch: str):
-    resp = {"header": f"head!{batch}", **measures_std}
-    await ws.send_json(resp)
+    await ws.send_text(measures_frame(f"head!{batch}", False))
     logger.info(f"Sent table header to client {ws.client}")
 
 
 async def send_description(ws: WebSocket, batch: str, label: str):
-    resp = {"header": f"desc!{batch}!{label}", **measures_ext}
-    await ws.send_json(resp)
+    await ws.send_text(measures_frame(f"desc!{batch}!{label}", True))
     logger.info(f"Sent description to client {ws.client}")
@@ -0,0 +1,157 @@
+import time
+import logging
+import asyncio as aio
+from collections import deque
+from typing import Callable
+from fastapi import WebSocket
+from config import settings
+from streaming.topics import WILDCARD
+
+
+logger = logging.getLogger(__name__)
+
+
+# responses of one flush window are already serialised, so frame is glued from strings
+# topic of one sensor "batch!label[!...]" gets the latest response as is,
+# others get "mbat!TOPIC" frame with rows of all updated sensors
+def build_frame(query: str, rows: dict[str, str]) -> str:
+    # interval topic asks sensors for doesn't change what client gets
+    topic = query.partition("@")[0]
+    batch, _, rest = topic.partition("!")
+    if (label := rest.partition("!")[0]) and WILDCARD not in (batch, label):
+        return next(reversed(rows.values()))
+    return f'{{"header": "mbat!{topic}", "rows": [{", ".join(rows.values())}]}}'
+
+
+class Outbox:
+    """
+    Outgoing queue of one client limited by number of frames and bytes.
+    Once the budget is exceeded queued frames collapse into the latest
+    response of each batch!label, which is sent as soon as client catches up.
+    Outbox failing to send closes and tells its owner through on_failed
+    """
+
+    __slots__ = (
+        "ws",
+        "on_failed",
+        "closed",
+        "queue",
+        "nbytes",
+        "latest",
+        "over_since",
+        "sent",
+        "dropped",
+        "ready",
+        "task",
+    )
+
+    def __init__(self, ws: WebSocket, on_failed: Callable[[WebSocket], None] | None = None):
+        self.ws = ws
+        self.on_failed = on_failed
+        # nothing is queued once client is gone
+        self.closed = False
+        # (query, rows, frame) in order of arrival
+        self.queue = deque()
+        self.nbytes = 0
+        # query -> {batch!label: response} when over budget, None otherwise
+        self.latest = None
+        # monotonic time client went over budget
+        self.over_since = None
+        self.sent = 0
+        # responses replaced by newer ones before being sent
+        self.dropped = 0
+        self.ready = aio.Event()
+        self.task = aio.create_task(self.run())
+
+    def put(self, query: str, rows: dict[str, str], frame: str):
+        if self.closed:
+            return
+        if (
+            self.latest is None
+            and len(self.queue) < settings.streaming.client_max_frames
+            and self.nbytes + len(frame) <= settings.streaming.client_max_bytes
+        ):
+            self.queue.append((query, rows, frame))
+            self.nbytes += len(frame)
+        else:
+            self._overflow(query, rows)
+        self.ready.set()
+
+    def _overflow(self, query: str, rows: dict[str, str]):
+        if self.over_since is None:
+            self.over_since = time.monotonic()
+        if self.latest is None:
+            self.latest = {}
+            for queued_query, queued_rows, _ in self.queue:
+                self._merge(queued_query, queued_rows)
+            self.queue.clear()
+            self.nbytes = 0
+        self._merge(query, rows)
+
+    def _merge(self, query: str, rows: dict[str, str]):
+        if query not in self.latest:
+            self.latest[query] = {}
+        latest = self.latest[query]
+        for label, resp in rows.items():
+            if label in latest:
+                self.dropped += 1
+            latest[label] = resp
+
+    def overdue(self, now: float) -> bool:
+        return (
+            self.over_since is not None
+            and now - self.over_since > settings.streaming.client_evict_after
+        )
+
+    def depth(self) -> int:
+        if self.latest is not None:
+            return sum(len(rows) for rows in self.latest.values())
+        return len(self.queue)
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue or self.latest:
+                if self.queue:
+                    query, rows, frame = self.queue.popleft()
+                    self.nbytes -= len(frame)
+                    frames = (frame,)
+                else:
+                    latest, self.latest = self.latest, None
+                    frames = [build_frame(query, rows) for query, rows in latest.items()]
+                try:
+                    for frame in frames:
+                        await self.ws.send_text(frame)
+                        self.sent += 1
+                except Exception:
+                    logger.info(f"Failed to send to client {self.ws.client}")
+                    self._drop()
+                    if self.on_failed is not None:
+                        self.on_failed(self.ws)
+                    return
+            # client caught up
+            self.over_since = None
+
+    def close(self):
+        self._drop()
+        self.task.cancel()
+
+    def _drop(self):
+        self.closed = True
+        self.queue.clear()
+        self.nbytes = 0
+        self.latest = None
+
+    def metrics(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "bytes": self.nbytes,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "over_budget": (
+                round(time.monotonic() - self.over_since, 1)
+                if self.over_since is not None
+                else 0
+            ),
+        }
@@ -0,0 +1,125 @@
+import math
+import logging
+from array import array
+from config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+NAN = math.nan
+
+
+class Ring:
+    """
+    Last samples of standard responses of one sensor,
+    every field is a column of fixed size, so sensor takes
+    (fields + 1) * size * 8 bytes no matter how long it reports
+    """
+
+    __slots__ = ("size", "pos", "count", "times", "cols")
+
+    def __init__(self, size: int):
+        self.size = size
+        # index the next sample is written to
+        self.pos = 0
+        self.count = 0
+        self.times = array("d", bytes(8 * size))
+        # (cat, field) -> column
+        self.cols = {}
+
+    def append(self, time: float, resp: dict):
+        pos = self.pos
+        self.times[pos] = time
+        for col in self.cols.values():
+            col[pos] = NAN
+        for cat, fields in resp.items():
+            if not isinstance(fields, dict):
+                continue
+            for field, value in fields.items():
+                if (col := self.cols.get((cat, field))) is None:
+                    col = self.cols[cat, field] = array("d", [NAN]) * self.size
+                col[pos] = value
+        self.pos = (pos + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    # samples of a batch, columns being (cat, field) -> values of every sample,
+    # only the last size samples fit into the ring
+    def extend(self, times: list, columns: dict):
+        count = len(times)
+        for key in columns:
+            if key not in self.cols:
+                self.cols[key] = array("d", [NAN]) * self.size
+        start = max(count - self.size, 0)
+        while start < count:
+            pos = self.pos
+            n = min(count - start, self.size - pos)
+            self.times[pos : pos + n] = array("d", times[start : start + n])
+            for key, col in self.cols.items():
+                if (values := columns.get(key)) is None:
+                    col[pos : pos + n] = array("d", [NAN]) * n
+                else:
+                    col[pos : pos + n] = array("d", values[start : start + n].tobytes())
+            self.pos = (pos + n) % self.size
+            self.count = min(self.count + n, self.size)
+            start += n
+
+    # positions of samples not older than since, in chronological order
+    def _since(self, since: float) -> range | list:
+        n = 0
+        pos = self.pos
+        while n < self.count and self.times[(pos - n - 1) % self.size] >= since:
+            n += 1
+        start = (pos - n) % self.size
+        if start + n <= self.size:
+            return range(start, start + n)
+        return [*range(start, self.size), *range(0, pos)]
+
+    def window(self, since: float) -> dict:
+        idx = self._since(since)
+        if isinstance(idx, range):
+            # contiguous piece of columns
+            def take(col):
+                return col[idx.start : idx.stop].tolist()
+        else:
+            def take(col):
+                return [col[i] for i in idx]
+
+        resp = {"time": take(self.times)}
+        for (cat, field), col in self.cols.items():
+            if cat not in resp:
+                resp[cat] = {}
+            # json has no NaN
+            resp[cat][field] = [None if v != v else v for v in take(col)]
+        return resp
+
+
+class History:
+    __slots__ = ("rings",)
+
+    def __init__(self) -> None:
+        # (batch, label) -> Ring
+        self.rings = {}
+
+    # late responses older than the newest one are left to the archive,
+    # ring keeps samples in chronological order
+    def append(self, batch: str, label: str, time, resp: dict, late: bool = False):
+        if (ring := self.rings.get((batch, label))) is None:
+            ring = self.rings[batch, label] = Ring(settings.streaming.history_size)
+            logger.info(f"Started history of sensor {batch}!{label}")
+        elif late and ring.count and float(time) < ring.times[(ring.pos - 1) % ring.size]:
+            return
+        ring.append(float(time), resp)
+
+    def extend(self, batch: str, label: str, times: list, columns: dict):
+        if (ring := self.rings.get((batch, label))) is None:
+            ring = self.rings[batch, label] = Ring(settings.streaming.history_size)
+            logger.info(f"Started history of sensor {batch}!{label}")
+        ring.extend(times, columns)
+
+    # columnar window of the last seconds of sensor history
+    def window(self, batch: str, label: str, seconds: float) -> dict:
+        if (ring := self.rings.get((batch, label))) is None or not ring.count:
+            return {"time": []}
+        newest = ring.times[(ring.pos - 1) % ring.size]
+        return ring.window(newest - seconds)
@@ -0,0 +1,123 @@
+import logging
+import asyncio as aio
+from config import settings
+from streaming.store import sensors, responses
+from streaming.sensors import accept_hello, hello_ack, decode_frame
+from wire.codec import CMD_SPECS
+from wire.framing import FrameProtocol
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReportBatcher:
+    """
+    Collects reports decoded by all sensor connections
+    and hands them to ResponseRepo once per event loop iteration
+    """
+
+    __slots__ = ("pending", "scheduled")
+
+    def __init__(self) -> None:
+        self.pending = []
+        self.scheduled = False
+
+    def add(self, batch: str, label: str, mark: str, time, resp: dict):
+        self.pending.append((batch, label, mark, time, resp))
+        if not self.scheduled:
+            self.scheduled = True
+            aio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        self.scheduled = False
+        responses.insert_batch(pending)
+
+
+batcher = ReportBatcher()
+
+
+class SensorProtocol(FrameProtocol):
+    """
+    Sensor connection without coroutine per sensor: frames are parsed
+    in buffer_updated callback. Also serves as the writer of Sensor,
+    so queries are sent to it with the same sendall as to StreamWriter
+    """
+
+    def __init__(self):
+        super().__init__(settings.streaming.max_frame_size)
+        self.batch = None
+        self.label = None
+        # report schemas announced by this sensor, by id
+        self.schemas = {}
+        # resolved when transport resumes writing
+        self.drained = None
+        # sensor writers awaiting drained
+        self.waiters = 0
+
+    def connection_made(self, transport: aio.Transport):
+        super().connection_made(transport)
+        logger.info(f"Connected {transport.get_extra_info('peername')}")
+
+    def frame_received(self, frame: memoryview):
+        # the first frame is always specs or resume
+        if self.batch is None:
+            if (hello := accept_hello(frame)) is None:
+                self.send_frame(CMD_SPECS.encode(encoding="utf-8"))
+                return
+            self.batch, self.label, codec, specs, token = hello
+            sensors.insert(self.batch, self.label, None, self, specs, codec)
+            if (ack := hello_ack(codec, token)) is not None:
+                self.send_frame(ack)
+            return
+
+        if (report := decode_frame(self.batch, self.label, self.schemas, frame)) is not None:
+            batcher.add(self.batch, self.label, *report)
+
+    # broken frame is dropped, the connection and the frames after it are kept
+    def frame_failed(self, frame: memoryview, exc: Exception):
+        if self.batch is None:
+            super().frame_failed(frame, exc)
+            return
+        logger.warning(
+            f"Sensor {self.batch}!{self.label} sent frame of {len(frame)} bytes that can't be decoded: {exc!r}"
+        )
+
+    def connection_lost(self, exc: Exception | None):
+        if self.batch is not None:
+            sensors.disconnect(self.batch, self.label, self)
+        # exception nobody awaits would be logged as never retrieved
+        if self.drained is not None and self.waiters and not self.drained.done():
+            self.drained.set_exception(ConnectionResetError())
+        self.drained = None
+
+    # flow control for writer interface
+
+    def pause_writing(self):
+        self.drained = aio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self.drained is not None and not self.drained.done():
+            self.drained.set_result(None)
+        self.drained = None
+
+    # writer interface
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError
+        if self.drained is not None:
+            self.waiters += 1
+            try:
+                await self.drained
+            finally:
+                self.waiters -= 1
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
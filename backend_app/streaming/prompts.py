@@ -0,0 +1,93 @@
+# categories of json/query.*.json, given there as CAT_fields and CAT_extended
+CATEGORIES = ("cpu", "net", "mem", "dsk")
+# category nobody asks for anymore
+UNWANTED = {"fields": [], "detailed": 0}
+
+
+# flat json/query.*.json -> prompt as sensor reads it
+def sensor_prompt(query: dict) -> dict:
+    prompt = {"mark": query["mark"], "interval": query["interval"]}
+    for cat in CATEGORIES:
+        prompt[cat] = {
+            "fields": list(query[f"{cat}_fields"]),
+            "detailed": int(query[f"{cat}_extended"]),
+        }
+    return prompt
+
+
+class PromptBuilder:
+    """
+    Smallest prompt covering all topics of one sensor: the union of fields of
+    every category, detailed rows where extended topics want them and the
+    shortest interval asked for. Sensor nobody watches samples standard fields
+    every idle_interval seconds
+    """
+
+    __slots__ = ("std", "ext", "idle_interval", "extra")
+
+    def __init__(self, query_std: dict, query_ext: dict, idle_interval: float):
+        self.std = sensor_prompt(query_std)
+        self.ext = sensor_prompt(query_ext)
+        self.idle_interval = idle_interval
+        # sections every prompt carries, e.g. delta and batch
+        self.extra = {}
+
+    def build(self, std_topics: list, ext_topics: list) -> dict:
+        if not std_topics and not ext_topics:
+            return {**self.std, "interval": self.idle_interval, **self.extra}
+
+        cats = {cat: {"fields": [], "detailed": 0} for cat in CATEGORIES}
+        intervals = []
+        if std_topics:
+            for cat in CATEGORIES:
+                _union(cats[cat], self.std[cat]["fields"], 0)
+            intervals.extend(topic.interval or self.std["interval"] for topic in std_topics)
+        for topic in ext_topics:
+            for cat, fields in self._wanted(topic):
+                if cat not in cats:
+                    cats[cat] = {"fields": [], "detailed": 0}
+                _union(cats[cat], fields, 1)
+            intervals.append(topic.interval or self.ext["interval"])
+
+        return {
+            "mark": "ext" if ext_topics else "std",
+            "interval": min(intervals),
+            **cats,
+            **self.extra,
+        }
+
+    # (cat, fields) extended topic asks for
+    def _wanted(self, topic) -> list[tuple[str, list]]:
+        if topic.cat is None:
+            wanted = [(cat, self.ext[cat]["fields"]) for cat in CATEGORIES]
+        elif topic.cat in self.ext:
+            wanted = [(topic.cat, self.ext[topic.cat]["fields"])]
+        elif topic.fields:
+            # category backend doesn't query by default, e.g. gpu of a plugin tracker
+            wanted = [(topic.cat, sorted(topic.fields))]
+        else:
+            return []
+        if topic.fields is None:
+            return wanted
+        return [(cat, [field for field in fields if field in topic.fields]) for cat, fields in wanted]
+
+
+def _union(cat_prompt: dict, fields: list, detailed: int):
+    cat_prompt["fields"].extend(field for field in fields if field not in cat_prompt["fields"])
+    cat_prompt["detailed"] = max(cat_prompt["detailed"], detailed)
+
+
+# sections of prompt that changed since base, sensor merges them into its prompt
+# of the same mark and keeps what diff leaves out
+def prompt_diff(base: dict, prompt: dict) -> dict:
+    diff = {"mark": prompt["mark"]}
+    for key, value in prompt.items():
+        if base.get(key) != value:
+            diff[key] = value
+    for key in base.keys() - prompt.keys():
+        diff[key] = UNWANTED if _is_category(base[key]) else None
+    return diff
+
+
+def _is_category(value) -> bool:
+    return isinstance(value, dict) and "fields" in value
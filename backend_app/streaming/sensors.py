@@ -1,7 +1,14 @@
 import json
+import secrets
 import logging
 import asyncio as aio
+from pathlib import Path
+from config import settings
 from streaming.store import sensors, responses, PEER_DISCONNECTED, recvall, sendall
+from wire.codec import Schema, KIND_REPORT, KIND_BATCH, negotiate, is_binary, decode_header
+from wire.codec import decode_report, decode_batch
+from wire.codec import CMD_RESUME, CMD_SPECS, content_hash
+from wire.delta import is_compressed, decompress
 
 
 logger = logging.getLogger(__name__)
@@ -9,27 +16,186 @@ logger = logging.getLogger(__name__)
 
 # port used to listen to sensors
 SENSORS_PORT = 32300
+RESUME = CMD_RESUME.encode(encoding="utf-8")
 
 
 # entry point for the communication with sensors
-async def serve_sensors():
-    server = await aio.start_server(handle_sensor, port=SENSORS_PORT)
+async def serve_sensors(port: int = SENSORS_PORT):
+    if settings.streaming.shards:
+        # imported here since shards depend on this module
+        from streaming.shards import serve_shards
+
+        await serve_shards(port)
+        return
+
+    if settings.streaming.ingest == "protocol":
+        # imported here since ingest depends on this module
+        from streaming.ingest import SensorProtocol
+
+        loop = aio.get_running_loop()
+        server = await loop.create_server(
+            SensorProtocol, port=port, backlog=settings.streaming.backlog
+        )
+    else:
+        server = await aio.start_server(
+            handle_sensor, port=port, backlog=settings.streaming.backlog
+        )
     await server.serve_forever()
 
 
+class SpecsCache:
+    """
+    Specs of sensors by resume token given to them in ack. Sensor reconnects
+    with the token and hash of its specs frame instead of specs, which matters
+    when thousands of sensors come back at once after backend restart,
+    so tokens are saved on shutdown and loaded on start
+    """
+
+    __slots__ = ("path", "tokens", "issued")
+
+    def __init__(self, path: Path):
+        self.path = path
+        # token -> [batch, label, codec, hash of specs frame, specs]
+        self.tokens = {}
+        # (batch, label) -> the last token issued to sensor
+        self.issued = {}
+        try:
+            entries = json.loads(path.read_text()) if path.exists() else {}
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Can't load specs cache {path}: {exc}")
+            entries = {}
+        for token, entry in entries.items():
+            self.put(token, entry)
+
+    def put(self, token: str, entry: list):
+        batch, label = entry[:2]
+        if (old := self.issued.get((batch, label))) is not None:
+            self.tokens.pop(old, None)
+        self.tokens[token] = entry
+        self.issued[batch, label] = token
+
+    def issue(self, batch: str, label: str, codec: str, digest: str, specs: dict) -> str:
+        token = secrets.token_hex(8)
+        self.put(token, [batch, label, codec, digest, specs])
+        return token
+
+    # entry of token, None when it is unknown or sensor specs changed since
+    def resume(self, token: str, digest: str) -> list | None:
+        if (entry := self.tokens.get(token)) is None or entry[3] != digest:
+            return None
+        return entry
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.tokens))
+        tmp.replace(self.path)
+        logger.info(f"Saved specs of {len(self.tokens)} sensors to {self.path}")
+
+
+specs_cache = SpecsCache(settings.streaming.specs_cache)
+
+
+# parses specs frame, returns batch, label and codec agreed with sensor,
+# codec is None for legacy sensors not offering codecs, they speak json only
+def accept_specs(frame) -> tuple[str, str, str | None, dict]:
+    specs = json.loads(bytes(frame))
+    proto, batch, label = specs.pop("header").split("!")[:3]
+    if "codecs" not in specs:
+        logger.info(f"Sensor {batch}!{label} offered no codecs, it speaks json only")
+        return batch, label, None, specs
+    codec = negotiate(specs.pop("codecs"), settings.streaming.codecs)
+    logger.info(f"Sensor {batch}!{label} uses codec {codec}")
+    return batch, label, codec, specs
+
+
+# legacy sensors take every frame from backend for a prompt, so they get no ack
+def hello_ack(codec: str | None, token: str) -> bytes | None:
+    if codec is None:
+        return None
+    return f"ack?{codec}?{token}".encode(encoding="utf-8")
+
+
+# first frame of sensor: specs or resume, returns batch, label, codec, specs and
+# resume token for ack, None when resume token is not known and specs are needed
+def accept_hello(frame) -> tuple[str, str, str | None, dict, str] | None:
+    data = bytes(frame)
+    if data.startswith(RESUME):
+        token, _, digest = data[len(RESUME) :].decode(encoding="utf-8").partition("?")
+        if (entry := specs_cache.resume(token, digest)) is None:
+            logger.info("Sensor resumed with unknown token, asking for specs")
+            return None
+        batch, label, codec, _, specs = entry
+        logger.info(f"Sensor {batch}!{label} resumed, uses codec {codec}")
+        return batch, label, codec, specs, token
+    batch, label, codec, specs = accept_specs(data)
+    token = specs_cache.issue(batch, label, codec, content_hash(data), specs)
+    return batch, label, codec, specs, token
+
+
+# decodes report frame into (mark, time, body)
+# schema frames are remembered in schemas and give None,
+# body of delta frame is the delta itself, it is applied by ResponseRepo
+def decode_frame(batch: str, label: str, schemas: dict, frame) -> tuple | None:
+    if is_compressed(frame):
+        frame = decompress(frame, settings.streaming.max_frame_size)
+    if is_binary(frame):
+        kind, schema_id, time = decode_header(frame)
+        if kind not in (KIND_REPORT, KIND_BATCH) or schema_id not in schemas:
+            logger.warning(
+                f"Sensor {batch}!{label} sent binary frame of unknown kind {kind} or schema {schema_id}"
+            )
+            return None
+        schema = schemas[schema_id]
+        if kind == KIND_BATCH:
+            # frame buffer is reused, samples are copied out of it
+            times, values = decode_batch(schema, frame)
+            samples = {
+                "type": "batch",
+                "cats": schema.cats,
+                "stale": schema.stale,
+                "times": times.tolist(),
+                "values": values.tobytes(),
+            }
+            return schema.mark, round(time), samples
+        report = decode_report(schema, frame)
+        if schema.stale:
+            report["stale"] = list(schema.stale)
+        return schema.mark, round(time), report
+
+    resp = json.loads(bytes(frame))
+    if resp.get("type") == "schema":
+        schemas[resp["id"]] = Schema.from_dict(resp)
+        logger.info(f"Sensor {batch}!{label} announced report schema {resp['id']}")
+        return None
+    proto, _batch, _label, mark, time = resp.pop("header").split("!")[:5]
+    return mark, time, resp
+
+
 # initially recieves sensor specs
 # then infinitely waits for responses from sensor
 # another function in another event loop sends queries to sensors
 async def handle_sensor(reader: aio.StreamReader, writer: aio.StreamWriter):
     logger.info(f"Connected {writer.get_extra_info('peername')}")
-    # recieving specs
-    specs = json.loads(await recvall(reader))
-    proto, batch, label = specs.pop("header").split("!")[:3]
-    sensors.insert(batch, label, reader, writer, specs)
+    # recieving specs or resume frame
+    while True:
+        if (frame := await recvall(reader)) == PEER_DISCONNECTED:
+            return
+        if (hello := accept_hello(frame)) is not None:
+            break
+        await sendall(CMD_SPECS, writer)
+    batch, label, codec, specs, token = hello
+    sensors.insert(batch, label, reader, writer, specs, codec)
+    if (ack := hello_ack(codec, token)) is not None:
+        await sendall(ack, writer)
+    # report schemas announced by this sensor, by id
+    schemas = {}
     # recieving responses
     while True:
         if (resp := await recvall(reader)) == PEER_DISCONNECTED:
             break
+        if (report := decode_frame(batch, label, schemas, resp)) is None:
+            continue
         # trigger sending resp to client
-        mark = responses.insert(batch, label, json.loads(resp))
+        mark = responses.insert_body(batch, label, *report)
         responses.send_last(mark, batch, label)
+    sensors.disconnect(batch, label, writer)
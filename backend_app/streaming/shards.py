@@ -0,0 +1,238 @@
+import marshal
+import logging
+import asyncio as aio
+import multiprocessing as mp
+from config import settings
+from streaming.store import sensors, responses
+from streaming.sensors import SENSORS_PORT, accept_hello, hello_ack, decode_frame, specs_cache
+from wire.codec import CMD_SPECS
+from wire.framing import SIZE, FrameProtocol, read_frame, write_frame
+
+
+logger = logging.getLogger(__name__)
+
+
+# Sharded ingest: N worker processes accept sensors on the same port with SO_REUSEPORT,
+# decode their reports and forward them to the web process over unix socket.
+# Messages between web process and workers are marshalled tuples:
+# worker -> web: ("specs", batch, label, specs, token, entry of SpecsCache),
+#                ("report", batch, label, mark, time, resp),
+#                ("gone", batch, label) when sensor disconnects
+# web -> worker: ("send", batch, label, frame) to be written to sensor as is
+
+
+# entry point in the web process
+async def serve_shards(port: int = SENSORS_PORT):
+    path = settings.streaming.shards_socket
+    server = await aio.start_unix_server(handle_shard, path=path)
+    ctx = mp.get_context("spawn")
+    for idx in range(settings.streaming.shards):
+        ctx.Process(target=run_shard, args=(idx, port), daemon=True).start()
+    logger.info(f"Started {settings.streaming.shards} ingest shards on port {port}")
+    await server.serve_forever()
+
+
+async def handle_shard(reader: aio.StreamReader, writer: aio.StreamWriter):
+    idx = marshal.loads(await read_frame(reader))
+    logger.info(f"Ingest shard {idx} connected")
+    try:
+        while True:
+            try:
+                frame = await read_frame(reader)
+            except aio.IncompleteReadError:
+                logger.warning(f"Ingest shard {idx} disconnected")
+                break
+            try:
+                msgs = marshal.loads(frame)
+            except (ValueError, EOFError, TypeError):
+                logger.exception(f"Ingest shard {idx} sent frame that can't be unmarshalled")
+                continue
+
+            reports = []
+            for msg in msgs:
+                # message of one sensor can't take the link of the whole shard down
+                try:
+                    _received(writer, msg, reports)
+                except Exception:
+                    logger.exception(f"Ingest shard {idx} sent message that can't be handled")
+            responses.insert_batch(reports)
+    finally:
+        # its sensors reconnect to other shards
+        for batch, labels in list(sensors._ls.items()):
+            for label, sensor in list(labels.items()):
+                if _routed(sensor, writer):
+                    sensors.disconnect(batch, label)
+        writer.close()
+
+
+def _received(writer: aio.StreamWriter, msg: tuple, reports: list):
+    match msg[0]:
+        case "report":
+            reports.append(msg[1:])
+        case "specs":
+            _, batch, label, specs, token, entry = msg
+            # web process saves tokens issued by all shards
+            specs_cache.put(token, entry)
+            # sensor reconnected to another shard replaces the old route
+            _, _, codec, _, _ = entry
+            sensors.insert(batch, label, None, ShardWriter(writer, batch, label), specs, codec)
+        case "gone":
+            _, batch, label = msg
+            # unless sensor has reconnected to another shard meanwhile
+            if _routed(sensors._ls.get(batch, {}).get(label), writer):
+                sensors.disconnect(batch, label)
+        case kind:
+            logger.warning(f"Ingest shard sent message of unknown kind {kind}")
+
+
+# sensor is served by shard of writer
+def _routed(sensor, writer: aio.StreamWriter) -> bool:
+    if sensor is None or not isinstance(sensor.writer, ShardWriter):
+        return False
+    return sensor.writer.link is writer
+
+
+class ShardWriter:
+    """
+    Writer of Sensor connected to ingest shard,
+    frames written to it are routed to the shard owning the sensor
+    """
+
+    __slots__ = ("link", "batch", "label")
+
+    def __init__(self, link: aio.StreamWriter, batch: str, label: str):
+        self.link = link
+        self.batch = batch
+        self.label = label
+
+    def writelines(self, data):
+        msg = marshal.dumps((("send", self.batch, self.label, b"".join(data)),))
+        self.link.writelines((SIZE.pack(len(msg)), msg))
+
+    async def drain(self):
+        await self.link.drain()
+
+    def is_closing(self) -> bool:
+        return self.link.is_closing()
+
+
+# entry point of the shard process
+def run_shard(idx: int, port: int):
+    aio.run(serve_shard(idx, port))
+
+
+async def serve_shard(idx: int, port: int):
+    reader, writer = await aio.open_unix_connection(settings.streaming.shards_socket)
+    await write_frame(writer, marshal.dumps(idx))
+    uplink = Uplink(writer)
+
+    loop = aio.get_running_loop()
+    server = await loop.create_server(
+        lambda: ShardProtocol(uplink),
+        port=port,
+        backlog=settings.streaming.backlog,
+        reuse_port=True,
+    )
+
+    # frames from web process routed to sensors of this shard
+    while True:
+        try:
+            msgs = marshal.loads(await read_frame(reader))
+        except aio.IncompleteReadError:
+            server.close()
+            break
+        for _, batch, label, frame in msgs:
+            if (conn := uplink.conns.get((batch, label))) is not None:
+                conn.transport.write(frame)
+
+
+class Uplink:
+    """
+    Connection of the shard to the web process,
+    messages are sent in one frame per event loop iteration.
+    Once web process lags settings.streaming.shards_high_water bytes behind,
+    sensors of the shard are not read until it catches up, so they are held
+    back by TCP instead of growing the queue of the shard
+    """
+
+    __slots__ = ("writer", "pending", "conns", "protocols", "paused")
+
+    def __init__(self, writer: aio.StreamWriter):
+        self.writer = writer
+        # drain waits until the queue is below high water again
+        writer.transport.set_write_buffer_limits(high=settings.streaming.shards_high_water)
+        self.pending = []
+        # (batch, label) -> ShardProtocol of sensors connected to this shard
+        self.conns = {}
+        # every connection of the shard, also the ones not past hello yet
+        self.protocols = set()
+        self.paused = False
+
+    def send(self, msg: tuple):
+        if not self.pending:
+            aio.get_running_loop().call_soon(self.flush)
+        self.pending.append(msg)
+
+    def flush(self):
+        msg = marshal.dumps(self.pending)
+        self.pending = []
+        self.writer.writelines((SIZE.pack(len(msg)), msg))
+        queued = self.writer.transport.get_write_buffer_size()
+        if not self.paused and queued > settings.streaming.shards_high_water:
+            self.paused = True
+            logger.warning(f"Web process lags behind, {len(self.protocols)} sensors are not read")
+            for proto in self.protocols:
+                proto.transport.pause_reading()
+            aio.create_task(self._resume())
+
+    async def _resume(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # web process is gone, shard stops with it
+            return
+        self.paused = False
+        logger.info("Web process caught up, sensors are read again")
+        for proto in self.protocols:
+            proto.transport.resume_reading()
+
+
+class ShardProtocol(FrameProtocol):
+    def __init__(self, uplink: Uplink):
+        super().__init__(settings.streaming.max_frame_size)
+        self.uplink = uplink
+        self.batch = None
+        self.label = None
+        # report schemas announced by this sensor, by id
+        self.schemas = {}
+
+    def connection_made(self, transport: aio.Transport):
+        super().connection_made(transport)
+        self.uplink.protocols.add(self)
+        if self.uplink.paused:
+            transport.pause_reading()
+
+    def frame_received(self, frame: memoryview):
+        # the first frame is always specs or resume,
+        # shard knows tokens it issued and the ones saved before start
+        if self.batch is None:
+            if (hello := accept_hello(frame)) is None:
+                self.send_frame(CMD_SPECS.encode(encoding="utf-8"))
+                return
+            self.batch, self.label, codec, specs, token = hello
+            self.uplink.conns[self.batch, self.label] = self
+            entry = specs_cache.tokens[token]
+            self.uplink.send(("specs", self.batch, self.label, specs, token, entry))
+            if (ack := hello_ack(codec, token)) is not None:
+                self.send_frame(ack)
+            return
+
+        if (report := decode_frame(self.batch, self.label, self.schemas, frame)) is not None:
+            self.uplink.send(("report", self.batch, self.label, *report))
+
+    def connection_lost(self, exc: Exception | None):
+        self.uplink.protocols.discard(self)
+        # sensor reconnected to this shard has already replaced the old route
+        if self.uplink.conns.get((self.batch, self.label)) is self:
+            del self.uplink.conns[self.batch, self.label]
+            self.uplink.send(("gone", self.batch, self.label))
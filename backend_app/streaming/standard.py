@@ -0,0 +1,158 @@
+import sys
+import json
+import time
+from copy import deepcopy as cp
+from operator import itemgetter
+
+
+# categories of extended response and how their rows are reduced to standard
+AVERAGED = ("cpu",)
+SUMMED = ("net", "dsk")
+
+
+class Standardiser:
+    """
+    Reduces extended response to standard one: cpu is averaged over cores,
+    net and dsk are summed over nics and disks, mem turns into percents.
+    Getters of standard fields are compiled once per layout of rows,
+    so the response is reduced column by column without copying it
+    """
+
+    __slots__ = ("fields", "plans")
+
+    def __init__(self, query_std: dict):
+        # cat -> standard fields from json/query.standard.json
+        self.fields = {
+            cat: tuple(query_std[f"{cat}_fields"]) for cat in (*AVERAGED, *SUMMED, "mem")
+        }
+        # (cat, fields of row) -> (standard fields present in row, getter of them)
+        self.plans = {}
+
+    def _plan(self, cat: str, row: dict) -> tuple:
+        key = (cat, tuple(row))
+        if (plan := self.plans.get(key)) is None:
+            fields = tuple(field for field in self.fields[cat] if field in row)
+            if not fields:
+                getter = None
+            elif len(fields) == 1:
+                getter = lambda row, field=fields[0]: (row[field],)
+            else:
+                getter = itemgetter(*fields)
+            plan = self.plans[key] = (fields, getter)
+        return plan
+
+    # sums of standard fields over rows and the number of rows having each of them
+    def _sums(self, cat: str, rows: list[dict]) -> tuple[dict, dict]:
+        if not rows:
+            return {}, {}
+        fields, getter = self._plan(cat, rows[0])
+        width = len(rows[0])
+        if all(len(row) == width for row in rows):
+            try:
+                cols = zip(*map(getter, rows)) if fields else ()
+                sums = {field: sum(col) for field, col in zip(fields, cols)}
+                return sums, dict.fromkeys(fields, len(rows))
+            except KeyError:
+                pass
+        # rows of different layouts, e.g. nic appeared in the middle of tick
+        sums, counts = {}, {}
+        for field in self.fields[cat]:
+            if col := [row[field] for row in rows if field in row]:
+                sums[field], counts[field] = sum(col), len(col)
+        return sums, counts
+
+    def _pick(self, cat: str, row: dict) -> dict:
+        return {field: row[field] for field in self._plan(cat, row)[0]}
+
+    def _mem(self, mem: dict, specs: dict) -> dict:
+        std = self._pick("mem", mem)
+        for field, total in (("used", "mem_total"), ("swap", "swp_total")):
+            if field in std and specs.get(total):
+                std[field] = round(std[field] / specs[total] * 100, 1)
+        return std
+
+    def standardise(self, resp: dict, specs: dict) -> dict:
+        std = {}
+        for cat in AVERAGED:
+            if (rows := resp.get(cat)) is None:
+                continue
+            if isinstance(rows, list):
+                sums, counts = self._sums(cat, rows)
+                std[cat] = {field: value / counts[field] for field, value in sums.items()}
+            else:
+                std[cat] = self._pick(cat, rows)
+        for cat in SUMMED:
+            if (rows := resp.get(cat)) is None:
+                continue
+            if rows and isinstance(next(iter(rows.values())), dict):
+                std[cat] = self._sums(cat, list(rows.values()))[0]
+            else:
+                std[cat] = self._pick(cat, rows)
+        if (mem := resp.get("mem")) is not None:
+            std["mem"] = self._mem(mem, specs.get("mem", {}))
+        return std
+
+
+# python -m streaming.standard [CORES]
+# checks Standardiser against straightforward reduction and compares their speed
+def _reference(query_std: dict, resp: dict, specs: dict) -> dict:
+    resp = cp(resp)
+    cpu = {
+        field: sum(core[field] for core in resp["cpu"]) / len(resp["cpu"])
+        for field in query_std["cpu_fields"]
+    }
+    net = {
+        field: sum(nic[field] for nic in resp["net"].values())
+        for field in query_std["net_fields"]
+    }
+    dsk = {
+        field: sum(disk[field] for disk in resp["dsk"].values())
+        for field in query_std["dsk_fields"]
+    }
+    mem = {field: resp["mem"][field] for field in query_std["mem_fields"]}
+    mem["used"] = round(mem["used"] / specs["mem"]["mem_total"] * 100, 1)
+    mem["swap"] = round(mem["swap"] / specs["mem"]["swp_total"] * 100, 1)
+    return {"cpu": cpu, "net": net, "mem": mem, "dsk": dsk}
+
+
+def _bench(cores: int, repeat: int = 2000):
+    with open("json/query.standard.json", "r") as file:
+        query_std = json.load(file)
+    with open("json/query.extended.json", "r") as file:
+        query_ext = json.load(file)
+
+    resp = {
+        "cpu": [
+            {field: float(core + idx) for idx, field in enumerate(query_ext["cpu_fields"])}
+            for core in range(cores)
+        ],
+        "net": {
+            f"eth{nic}": {field: nic * 100 + idx for idx, field in enumerate(query_ext["net_fields"])}
+            for nic in range(4)
+        },
+        "mem": {field: 1024 * (idx + 1) for idx, field in enumerate(query_ext["mem_fields"])},
+        "dsk": {
+            f"sd{chr(97 + disk)}": {field: disk * 10 + idx for idx, field in enumerate(query_ext["dsk_fields"])}
+            for disk in range(8)
+        },
+    }
+    specs = {"mem": {"mem_total": 65536, "swp_total": 8192}}
+
+    standardiser = Standardiser(query_std)
+    expected = _reference(query_std, resp, specs)
+    got = standardiser.standardise(resp, specs)
+    assert got == expected, f"{got} != {expected}"
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        _reference(query_std, resp, specs)
+    reference = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        standardiser.standardise(resp, specs)
+    compiled = (time.perf_counter() - start) / repeat
+    print(f"{cores} cores: reference {reference * 1e6:.1f} us, compiled {compiled * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    _bench(int(sys.argv[1]) if len(sys.argv) >= 2 else 128)
@@ -1,85 +1,203 @@
 import json
+import time
 import asyncio as aio
-import struct
 import secrets
 import logging
-from copy import deepcopy as cp
 from fastapi import WebSocket
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from config import settings
+from wire.framing import read_frame, write_frame
+from streaming.fanout import Outbox, build_frame
+from streaming.history import History
+from streaming.archive import Archive
+from streaming.standard import Standardiser
+from streaming.topics import Topic, TopicIndex, WILDCARD
+from streaming.prompts import PromptBuilder, prompt_diff
+from wire.delta import DeltaDecoder
+from wire.codec import CMD_USE, ROW_FLAT, content_hash, batch_report
 
 
 logger = logging.getLogger(__name__)
 
 
 # random string indicating that sensor was disconnected
-PEER_DISCONNECTED = f"{secrets.randbits(32)}"
+PEER_DISCONNECTED = f"{secrets.randbits(32)}".encode(encoding="utf-8")
 
 
 class ClientRepo:
-    __slots__ = ("_ls", "queries", "subs")
+    __slots__ = ("_ls", "topics", "index", "window", "flushing", "evicted")
 
     def __init__(self) -> None:
-        self._ls = set()
-        self.queries = {}
-        self.subs = {}
+        # map ws -> Outbox
+        self._ls = {}
+        # map ws -> {query: Topic} the client is subscribed to
+        self.topics = {}
+        self.index = TopicIndex()
+        # map query -> {batch!label: serialised response} collected during flush window
+        self.window = {}
+        self.flushing = False
+        # number of clients disconnected for not keeping up
+        self.evicted = 0
 
     async def connect(self, ws: WebSocket):
         await ws.accept()
-        # self._ls.add(ws)
+        # client that can't be sent to is gone, even if its socket didn't say so yet
+        self._ls[ws] = Outbox(ws, self.disconnect)
         logger.info(f"Client {ws.client} established connection via WebSocket")
 
     def subscribe(self, ws: WebSocket, query: str):
-        if self.queries.get(ws, None) == query:
-            logger.info(f"Client {ws.client} is already subscribed to query {query}")
+        if query in self.topics.get(ws, ()):
+            logger.info(f"Client {ws.client} is already subscribed to topic {query}")
+            return
+        try:
+            topic = Topic(query)
+        except ValueError as exc:
+            logger.warning(f"Client {ws.client} can't subscribe: {exc}")
             return
 
-        self.unsubscribe(ws)
-
-        self.queries[ws] = query
-        if query not in self.subs:
-            self.subs[query] = set()
-        self.subs[query].add(ws)
-        queries.insert(query)
-        logger.info(f"Client {ws.client} subscribed to query {query}")
+        if ws not in self.topics:
+            self.topics[ws] = {}
+        self.topics[ws][query] = topic
+        self.index.add(topic, ws)
+        queries.refresh(topic)
+        logger.info(f"Client {ws.client} subscribed to topic {query}")
+        if len(topic.path) == 1:
+            self.send_snapshot(ws, topic)
+
+    # batch subscriber gets the last known state right away, not after the next reports
+    def send_snapshot(self, ws: WebSocket, topic: Topic):
+        batch = topic.path[0]
+        if batch != WILDCARD:
+            snapshot = responses.snapshot(batch)
+        else:
+            rows = {}
+            for batch in responses.std:
+                if (batch_snapshot := responses.snapshot(batch)) is not None:
+                    rows.update(batch_snapshot[0])
+            snapshot = (rows, build_frame(topic.query, rows)) if rows else None
+        if snapshot is None:
+            return
+        rows, frame = snapshot
+        self._ls[ws].put(topic.query, rows, frame)
+        logger.info(f"Sent snapshot of {len(rows)} responses on topic {topic.query} to client {ws.client}")
+
+    # response goes to every topic covering the sensor, std one comes serialised
+    # and ext one is serialised once for all topics taking it whole
+    def route(self, batch: str, label: str, std: str | None, ext: dict | None):
+        std_topics, ext_topics = self.index.match(batch, label)
+        sensor = f"{batch}!{label}"
+        if std is not None and std_topics:
+            for topic in std_topics:
+                self._collect(topic.query, sensor, std)
+        if ext is not None and ext_topics:
+            data = None
+            for topic in ext_topics:
+                if topic.narrowed:
+                    self._collect(topic.query, sensor, json.dumps(topic.select(ext)))
+                    continue
+                if data is None:
+                    data = json.dumps(ext)
+                self._collect(topic.query, sensor, data)
+
+    def _collect(self, query: str, sensor: str, data: str):
+        if query not in self.window:
+            self.window[query] = {}
+        self.window[query][sensor] = data
+        if not self.flushing:
+            self.flushing = True
+            aio.get_running_loop().call_later(
+                settings.streaming.flush_window, self.flush
+            )
 
-    def notify(self, query: str, resp: dict):
-        sub: WebSocket
-        for sub in self.subs.get(query, []):
-            logger.info(
-                f"Sending response {resp} to client {sub.client} on query {query}"
+    def flush(self):
+        self.flushing = False
+        window, self.window = self.window, {}
+        now = time.monotonic()
+        for query, rows in window.items():
+            frame = build_frame(query, rows)
+            for sub in list(self.index.subscribers(query)):
+                outbox = self._ls[sub]
+                outbox.put(query, rows, frame)
+                if outbox.overdue(now):
+                    self.evict(sub)
+            logger.debug(
+                f"Sent {len(rows)} responses on topic {query} to {len(self.index.subscribers(query))} clients"
             )
-            aio.create_task(sub.send_json(resp))
 
-    def unsubscribe(self, ws: WebSocket):
-        if ws not in self.queries:
+    def evict(self, ws: WebSocket):
+        logger.warning(
+            f"Client {ws.client} is over its budget for too long, disconnecting: {self._ls[ws].metrics()}"
+        )
+        self.evicted += 1
+        self.disconnect(ws)
+        aio.create_task(ws.close())
+
+    def metrics(self) -> dict:
+        return {
+            "evicted": self.evicted,
+            "clients": [
+                {
+                    "client": f"{ws.client}",
+                    "topics": list(self.topics.get(ws, ())),
+                    **outbox.metrics(),
+                }
+                for ws, outbox in self._ls.items()
+            ],
+        }
+
+    # from one topic or from all of them
+    def unsubscribe(self, ws: WebSocket, query: str | None = None):
+        topics = self.topics.get(ws, {})
+        if query is not None and query not in topics:
+            logger.info(f"Client {ws.client} is not subscribed to topic {query}")
+            return
+        if not topics:
             logger.info(f"Client {ws.client} is already unsubscribed")
             return
 
-        old_query = self.queries[ws]
-        self.subs[self.queries[ws]].remove(ws)
-        del self.queries[ws]
-        queries.remove(old_query)
-        logger.info(f"Client {ws.client} is unsubscribed from query {old_query}")
+        for topic in [topics[query]] if query is not None else list(topics.values()):
+            del topics[topic.query]
+            self.index.remove(topic, ws)
+            queries.refresh(topic)
+            logger.info(f"Client {ws.client} is unsubscribed from topic {topic.query}")
+        if not topics:
+            del self.topics[ws]
 
     def disconnect(self, ws: WebSocket):
         self.unsubscribe(ws)
-        # self._ls.remove(ws)
+        if ws in self._ls:
+            self._ls.pop(ws).close()
         logger.info(f"Client {ws.client} disconnected")
 
 
 @dataclass(frozen=True, slots=True)
 class Sensor:
-    reader: aio.StreamReader
+    # reader is None for sensors served by SensorProtocol, which is the writer itself
+    reader: aio.StreamReader | None
     writer: aio.StreamWriter
     specs: dict
+    # codec agreed in hello, None for legacy sensors, which never confirm prompts
+    codec: str | None = None
+    # hash of full prompt -> (hash of text it was sent as, hash of the prompt
+    # it was applied to), sensor has them cached, the least recently used first
+    prompts: dict = field(default_factory=dict)
+    # mark -> the last prompt of that mark sensor runs, diffs are made against it
+    sent: dict = field(default_factory=dict)
 
 
 class SensorRepo:
-    __slots__ = ("_ls", "batches")
+    __slots__ = ("_ls", "specs", "batches", "frames")
 
     def __init__(self) -> None:
+        # batch -> {label: Sensor} of connected sensors
         self._ls = {}
+        # (batch, label) -> specs, kept after sensor is gone for its reports
+        # still on the way and for clients looking at it
+        self.specs = {}
         self.batches = []
+        # serialised "lsob" and "spec" responses, (batch, label) -> frame and None -> batches,
+        # dropped when sensor (re)connects with possibly new specs
+        self.frames = {}
 
     def __iter__(self) -> list[Sensor]:
         return self._ls
@@ -91,41 +209,132 @@ class SensorRepo:
         reader: aio.StreamReader,
         writer: aio.StreamWriter,
         specs: dict,
+        codec: str | None = None,
     ):
         if batch not in self._ls.keys():
             self._ls[batch] = {}
             self.batches.append(batch)
+            self.frames.pop(None, None)
             responses.add_batch(batch)
-        self._ls[batch][label] = Sensor(reader, writer, specs)
+        self._ls[batch][label] = Sensor(reader, writer, specs, codec)
+        self.specs[batch, label] = specs
+        self.frames.pop((batch, label), None)
+        queries.connected(batch, label)
         logger.info(f"Sensor {batch}!{label} established connection")
         logger.info(f"Sensor {batch}!{label} specs: {specs}")
 
-    
+    # writer is the connection that ended, sensor reconnected over another one meanwhile
+    # keeps its state, None drops the sensor whatever it is connected over
+    def disconnect(self, batch: str, label: str, writer=None):
+        labels = self._ls.get(batch, {})
+        if (sensor := labels.get(label)) is not None:
+            if writer is not None and sensor.writer is not writer:
+                return
+            # prompts don't go to dead writers
+            del labels[label]
+        responses.forget(batch, label)
+        queries.disconnected(batch, label)
+        logger.info(f"Sensor {batch}!{label} disconnected")
+
     def get_specs(self, batch: str, label: str):
-        return self._ls[batch][label].specs
+        return self.specs[batch, label]
+
+    def batches_frame(self) -> str:
+        if (frame := self.frames.get(None)) is None:
+            frame = self.frames[None] = json.dumps({"header": "lsob", "batches": self.batches})
+        return frame
+
+    def specs_frame(self, batch: str, label: str) -> str:
+        if (frame := self.frames.get((batch, label))) is None:
+            resp = {"header": f"spec!{batch}!{label}", **self.get_specs(batch, label)}
+            frame = self.frames[batch, label] = json.dumps(resp)
+        return frame
 
 
 class ResponseRepo:
-    __slots__ = ("std", "ext")
+    __slots__ = (
+        "std",
+        "ext",
+        "rows",
+        "snapshots",
+        "deltas",
+        "history",
+        "archive",
+        "standardiser",
+    )
 
     def __init__(self) -> None:
         self.std = {}
         self.ext = {}
+        # batch -> {label: serialised std response}, None until it is asked for
+        self.rows = {}
+        # batch -> (rows, "mbat" frame of all of them) kept until a response changes
+        self.snapshots = {}
+        # (batch, label) -> DeltaDecoder of sensors sending delta reports
+        self.deltas = {}
+        with open("json/query.standard.json", "r") as std_file:
+            self.standardiser = Standardiser(json.load(std_file))
+        # recent standard responses of every sensor
+        self.history = History()
+        # all standard responses on disk
+        self.archive = None
+        if settings.archive.enabled:
+            with open("json/measures.standard.json", "r") as file:
+                self.archive = Archive(settings.archive.path, json.load(file))
 
     def add_batch(self, batch: str):
         self.std[batch] = {}
         self.ext[batch] = {}
+        self.rows[batch] = {}
         logger.info(f"Got new batch {batch}")
 
-    def insert(self, batch: str, label: str, resp: dict) -> str:
+    def _set_std(self, batch: str, label: str, resp: dict):
+        self.std[batch][label] = resp
+        self.rows[batch][label] = None
+        self.snapshots.pop(batch, None)
+
+    # std response serialised once for live routing and snapshots
+    def std_row(self, batch: str, label: str) -> str:
+        if (row := self.rows[batch][label]) is None:
+            row = self.rows[batch][label] = json.dumps(self.std[batch][label])
+        return row
+
+    # last known std responses of all sensors of batch, subscribers
+    # opening the batch at once share the same frame
+    def snapshot(self, batch: str) -> tuple[dict, str] | None:
+        if not self.std.get(batch):
+            return None
+        if (snapshot := self.snapshots.get(batch)) is None:
+            rows = {f"{batch}!{label}": self.std_row(batch, label) for label in self.std[batch]}
+            snapshot = self.snapshots[batch] = (rows, build_frame(batch, rows))
+        return snapshot
+
+    def insert(self, batch: str, label: str, resp: dict) -> str | None:
         logger.info(
             f"Sensor {batch}!{label} send response with header {resp['header']}"
         )
         proto, _batch, _label, mark, time = resp.pop("header").split("!")[:5]
+        return self.insert_body(batch, label, mark, time, resp)
+
+    # resp is already free of header, binary reports come here directly
+    # returns None when nothing was inserted
+    def insert_body(self, batch: str, label: str, mark: str, time, resp: dict) -> str | None:
+        if resp.get("type") == "late":
+            self.insert_late(batch, label, resp["reports"])
+            return None
+        if resp.get("type") == "ack":
+            queries.acked(batch, label, resp)
+            return None
+        if resp.get("type") == "batch":
+            return self.insert_samples(batch, label, mark, resp)
+        if resp.get("type") == "delta":
+            if (resp := self.rebuild(batch, label, resp)) is None:
+                return None
 
         if mark == "std" or mark == "flb":
             header = f"mstd!{batch}!{label}!{time}"
-            self.std[batch][label] = {"header": header, **resp}
+            self._set_std(batch, label, {"header": header, **resp})
+            self._keep(batch, label, time, resp)
             logger.info(f"Added mstd response from sensor {batch}!{label}")
             return "std"
 
@@ -135,205 +344,363 @@ class ResponseRepo:
             logger.info(f"Added mext response from sensor {batch}!{label}")
 
             # someone monitoring the whole batch including current particular machine
-            if batch in queries:
-                self.std[batch][label] = {
-                    "header": header,
-                    **self.standartise_response(batch, label, resp),
-                }
+            if clients.index.covers(batch):
+                std_resp = self.standartise_response(batch, label, resp)
+                std_header = f"mstd!{batch}!{label}!{time}"
+                self._set_std(batch, label, {"header": std_header, **std_resp})
+                self._keep(batch, label, time, std_resp)
                 logger.info(
-                    f"There is batch {batch} in queries so added mstd response from sensor {batch}!{label}"
+                    f"Batch {batch} is subscribed to so added mstd response from sensor {batch}!{label}"
                 )
             return "ext"
 
+    # reports sensor spooled while backend was not reachable go to history only,
+    # subscribers get them from history queries, not as current responses
+    def insert_late(self, batch: str, label: str, reports: list[dict]):
+        kept = 0
+        for report in reports:
+            mark, time, resp = report["mark"], report["time"], report["body"]
+            if mark == "ext":
+                resp = self.standartise_response(batch, label, resp)
+            elif mark not in ("std", "flb"):
+                continue
+            self._keep(batch, label, time, resp, late=True)
+            kept += 1
+        logger.info(f"Added {kept} late responses from sensor {batch}!{label} to history")
+
+    # samples of binary batch, flat standard ones go to history column by column,
+    # only the latest one becomes the current response
+    def insert_samples(self, batch: str, label: str, mark: str, samples: dict) -> str | None:
+        cats, times = samples["cats"], samples["times"]
+        values = memoryview(samples["values"]).cast("d")
+        stale = {"stale": list(samples["stale"])} if samples.get("stale") else {}
+        if not (count := len(times)):
+            return None
+        if mark not in ("std", "flb") or any(layout != ROW_FLAT for _, layout, _, _ in cats):
+            # reports made one by one, the last one is current
+            for idx in range(count):
+                report = {**batch_report(cats, values, count, idx), **stale}
+                last = self.insert_body(batch, label, mark, times[idx], report)
+            return last
+
+        fields = [(cat, field) for cat, _, cat_fields, _ in cats for field in cat_fields]
+        columns = {key: values[col * count : (col + 1) * count] for col, key in enumerate(fields)}
+        self.history.extend(batch, label, times, columns)
+        if self.archive:
+            self.archive.extend(batch, label, times, columns)
+        header = f"mstd!{batch}!{label}!{times[-1]}"
+        self._set_std(
+            batch, label, {"header": header, **batch_report(cats, values, count, count - 1), **stale}
+        )
+        logger.info(f"Added {count} batched mstd responses from sensor {batch}!{label}")
+        return "std"
+
+    # full report of sensor sending deltas
+    def rebuild(self, batch: str, label: str, delta: dict) -> dict | None:
+        if (decoder := self.deltas.get((batch, label))) is None:
+            decoder = self.deltas[batch, label] = DeltaDecoder()
+        if (resp := decoder.apply(delta)) is None:
+            logger.warning(
+                f"Sensor {batch}!{label} sent delta {delta['seq']} not following {decoder.seq}, waiting for keyframe"
+            )
+        elif "stale" in delta:
+            # decoder keeps the report of the last keyframe, so it gets a copy
+            resp = {**resp, "stale": delta["stale"]}
+        return resp
+
+    # state of sensor connection, reconnected sensor starts with keyframe
+    def forget(self, batch: str, label: str):
+        self.deltas.pop((batch, label), None)
+
+    def _keep(self, batch: str, label: str, time, resp: dict, late: bool = False):
+        self.history.append(batch, label, time, resp, late)
+        if self.archive:
+            self.archive.append(batch, label, time, resp)
+
+    # reports collected during one event loop iteration,
+    # clients get only the last response of each sensor
+    def insert_batch(self, reports: list[tuple]):
+        last = {}
+        for batch, label, mark, time, resp in reports:
+            # broken report of one sensor doesn't cost the others their reports
+            try:
+                mark = self.insert_body(batch, label, mark, time, resp)
+            except Exception:
+                logger.exception(f"Report of sensor {batch}!{label} can't be inserted")
+                continue
+            if mark is not None:
+                last[batch, label] = mark
+        for (batch, label), mark in last.items():
+            self.send_last(mark, batch, label)
+
+    # named rows become lists of rows with names and flat categories one row lists,
+    # categories left out of the prompt by narrowed topics are missing
     def _flatten_ext(self, resp: dict) -> dict:
-        net = resp["net"]
-        resp["net"] = [
-            {
-                "name": key,
-                **val,
-            }
-            for key, val in net.items()
-        ]
-        
-        mem = resp["mem"]
-        resp["mem"] = [mem]
-        
-        dsk = resp["dsk"]
-        resp["dsk"] = [
-            {
-                "name": key,
-                **val,
-            }
-            for key, val in dsk.items()
-        ]
+        for cat in ("net", "mem", "dsk"):
+            if not isinstance(rows := resp.get(cat), dict):
+                continue
+            if rows and isinstance(next(iter(rows.values())), dict):
+                resp[cat] = [{"name": key, **val} for key, val in rows.items()]
+            else:
+                resp[cat] = [rows] if rows else []
         return resp
 
     def send_last(self, mark: str, batch: str, label: str):
         if mark == "std":
             logger.info(f"Sending last mstd response from sensor {batch}!{label}")
-            clients.notify(batch, self.std[batch][label])
+            clients.route(batch, label, self.std_row(batch, label), None)
         elif mark == "ext":
             logger.info(f"Sending last mext response from sensor {batch}!{label}")
-            clients.notify(
-                f"{batch}!{label}", self._flatten_ext(self.ext[batch][label])
-            )
+            # standard response made of extended one goes to batch subscribers
+            std = self.std_row(batch, label) if clients.index.covers(batch) else None
+            clients.route(batch, label, std, self._flatten_ext(self.ext[batch][label]))
 
     # when sensor sends only extended responses while we need both extended and standard
     # we can reduce amount of information in extended resp to make standard
     def standartise_response(self, batch: str, label: str, resp: dict) -> dict:
-        cpu = self._standartise_cpu(resp["cpu"])
-        net = self._standartise_net(resp["net"])
-        mem = self._standartise_mem(batch, label, resp["mem"])
-        dsk = self._standartise_dsk(resp["dsk"])
-        return {"cpu": cpu, "net": net, "mem": mem, "dsk": dsk}
-
-    def _standartise_cpu(cpu_percore: list[dict]) -> dict:
-        cores = len(cpu_percore)
-        if not cores:
-            return {}
-
-        cpu: dict = cp(cpu_percore[0])
-        cpu_std_fields = set(queries.std["cpu_fields"])
-        for field in cpu:
-            if field not in cpu_std_fields:
-                cpu.pop(field)
-            else:
-                for i in range(1, cores):
-                    cpu[field] += cpu_percore[i][field]
-                cpu[field] /= cores
-
-    def _standartise_net(net_pernic: dict) -> dict:
-        nics = net_pernic.keys()
-        if not nics:
-            return {}
-
-        net = cp(net_pernic[nics[0]])
-        net_std_fields = set(queries.std["net_fields"])
-        for field in net.keys():
-            if field not in net_std_fields:
-                net.pop(field)
-            else:
-                for nic in nics:
-                    net[field] += net_pernic[nic][field]
-
-        return net
-
-    def _standartise_mem(batch, label, mem_ext: dict) -> dict:
-        mem = cp(mem_ext)
-        # some fucking hardcode
-        for field in ["buffers", "cached", "shared"]:
-            mem.pop(field, None)
-        if "used" in mem:
-            mem["used"] = round(
-                mem["used"] / sensors[batch][label]["mem"]["mem_total"] * 100, 1
-            )
-        if "swap" in mem:
-            mem["swap"] = round(
-                mem["swap"] / sensors[batch][label]["mem"]["swp_total"] * 100, 1
-            )
-
-        return mem
-
-    def _standartise_dsk(dsk_perdisk: dict) -> dict:
-        disks = dsk_perdisk.keys()
-        if not disks:
-            return {}
-
-        dsk = cp(dsk_perdisk[disks[0]])
-        dsk_std_fields = set(queries.std["dsk_fields"])
-        for field in dsk:
-            if field not in dsk_std_fields:
-                dsk.pop(field)
-            else:
-                for disk in disks:
-                    dsk[field] += dsk_perdisk[disk][field]
-
-        return dsk
+        std = self.standardiser.standardise(resp, sensors.get_specs(batch, label))
+        if "stale" in resp:
+            std["stale"] = resp["stale"]
+        return std
 
 
 class QueryRepo:
-    __slots__ = ("std", "std_str", "ext", "ext_str", "query_set", "query_cnt")
+    __slots__ = (
+        "builder",
+        "current",
+        "running",
+        "acks",
+        "limit",
+        "fanouts",
+        "dirty",
+        "updating",
+        "busy",
+        "tasks",
+    )
 
     def __init__(self) -> None:
         with open("json/query.standard.json", "r") as std_file:
-            self.std = json.load(std_file)
-            self.std_str = json.dumps(self.std)
+            query_std = json.load(std_file)
         with open("json/query.extended.json", "r") as ext_file:
-            self.ext = json.load(ext_file)
-            self.ext_str = json.dumps(self.ext)
-
-        # all queries existing right now
-        self.query_set = set()
-        # map query -> #{how much such a queries exist}
-        self.query_cnt = {}
-
-    def __contains__(self, query: str) -> bool:
-        return self.query_set.__contains__(query)
-
-    def insert(self, query: str):
-        # стандартный майкрософтовский энвелоуп
-        self.query_set.add(query)
-        if query not in self.query_cnt:
-            self.query_cnt[query] = 0
-            logger.info(f"Got new query {query}, updating it on sensors...")
-        if self.query_cnt[query] == 0:
-            aio.create_task(self.inject_query(query))
-        self.query_cnt[query] += 1
-
-    def remove(self, query: str):
-        self.query_cnt[query] -= 1
-        if self.query_cnt[query] == 0:
-            self.query_set.remove(query)
-            logger.info(f"Removed query {query}, updating it on sensors...")
-            aio.create_task(self.seize_query(query))
-
-    async def inject_query(self, query: str):
-        tokens = query.split("!")
-        
-
-        if len(tokens) == 1:
-            batch = query
-            for label in sensors._ls[batch]:
-                if f"{batch}!{label}" not in self.query_set:
-                    sensor: Sensor = sensors._ls[batch][label]
-                    await sendall(self.std_str, sensor.writer)
-                else:
-                    logger.info(
-                        f"Didn't inject std query {query} to sensor {batch}!{label} since it has ext query"
-                    )
-        else:
-            batch, label = tokens[:2]
-            sensor: Sensor = sensors._ls[batch][label]
-            await sendall(self.ext_str, sensor.writer)
-            logger.info(f"Injected ext query {query} to sensor {batch}!{label}")
-
-    async def seize_query(self, query: str):
-        tokens = query.split("!")
-        
-        if len(tokens) == 1:
-            batch = query
-            for label in sensors._ls[batch]:
-                if f"{batch}!{label}" not in self.query_set:
-                    sensor: Sensor = sensors._ls[batch][label]
-                    await sendall("stop", sensor.writer)
-                    logger.info(
-                        f"Seized std query {query} from sensor {batch}!{label}"
-                    )
-                else:
-                    logger.info(
-                        f"Didn't seize query {query} from sensor {batch}!{label} since it has ext query"
-                    )
-        else:
-            batch, label = tokens[:2]
-            sensor: Sensor = sensors._ls[batch][label]
-            if batch in self.query_set:
-                await sendall(self.std_str, sensor.writer)
-                logger.info(
-                    f"Replaces ext query {query} with std on sensor {batch}!{label}"
+            query_ext = json.load(ext_file)
+        self.builder = PromptBuilder(query_std, query_ext, settings.streaming.idle_interval)
+        # sensors are asked to report deltas
+        if settings.streaming.delta_keyframe:
+            self.builder.extra["delta"] = {
+                "keyframe": settings.streaming.delta_keyframe,
+                "epsilon": settings.streaming.delta_epsilon,
+                "compress": settings.streaming.delta_compress,
+            }
+        # sensors sampling fast are asked to batch samples
+        if settings.streaming.batch_samples:
+            self.builder.extra["batch"] = {
+                "samples": settings.streaming.batch_samples,
+                "window": settings.streaming.batch_window,
+            }
+
+        # map (batch, label) -> hash of prompt the sensor was last told to run
+        self.current = {}
+        # map (batch, label) -> hash of prompt the sensor confirmed it runs
+        self.running = {}
+        # map (batch, label) -> (hash sensor confirms with, future) of prompt being sent
+        self.acks = {}
+        # bounds prompts in flight, made in the event loop on first use
+        self.limit = None
+        # map batch -> stats of the latest fan-out of prompts to it
+        self.fanouts = {}
+        # sensors whose subscriptions changed during debounce window
+        self.dirty = set()
+        self.updating = False
+        # sensors with a prompt in flight, they get the next one once it is settled
+        self.busy = set()
+        # running updates, event loop keeps only weak references to tasks
+        self.tasks = set()
+
+    # sensors covered by topic that was subscribed to or left
+    # get the prompt their subscribers need now
+    def refresh(self, topic: Topic):
+        batch_key, label_key = (topic.path + (WILDCARD,))[:2]
+        batches = sensors._ls if batch_key == WILDCARD else (batch_key,)
+        for batch in batches:
+            for label in sensors._ls.get(batch, ()):
+                if label_key in (WILDCARD, label):
+                    self._mark_dirty(batch, label)
+
+    # new connection of sensor has no prompt sent over it
+    def connected(self, batch: str, label: str):
+        self.current.pop((batch, label), None)
+        self._mark_dirty(batch, label)
+
+    # prompt in flight won't be confirmed over the connection that is gone
+    def disconnected(self, batch: str, label: str):
+        self.running.pop((batch, label), None)
+        if (ack := self.acks.get((batch, label))) is not None and not ack[1].done():
+            ack[1].set_exception(ConnectionResetError(f"sensor {batch}!{label} disconnected"))
+
+    # changes of subscriptions are debounced, so client switching views
+    # or many clients coming at once make one prompt per sensor
+    def _mark_dirty(self, batch: str, label: str):
+        self.dirty.add((batch, label))
+        if not self.updating:
+            self.updating = True
+            aio.get_running_loop().call_later(settings.streaming.prompt_debounce, self._start_update)
+
+    def _start_update(self):
+        task = aio.create_task(self.update())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def update(self):
+        self.updating = False
+        dirty, self.dirty = self.dirty, set()
+        jobs = []
+        for batch, label in dirty:
+            if (batch, label) in self.busy:
+                # diff of the next prompt depends on the ack of this one
+                self.dirty.add((batch, label))
+                continue
+            prompt = self.builder.build(*clients.index.match(batch, label))
+            digest = content_hash(json.dumps(prompt))
+            if self.current.get((batch, label)) == digest:
+                continue
+            self.current[batch, label] = digest
+            self.busy.add((batch, label))
+            jobs.append(self.dispatch(batch, label, prompt, digest))
+        if not jobs:
+            return
+
+        start = time.monotonic()
+        fanouts = {}
+        for result in await aio.gather(*jobs, return_exceptions=True):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to send prompt: {result!r}")
+                continue
+            batch, acked, done = result
+            if batch not in fanouts:
+                fanouts[batch] = {"sensors": 0, "acked": 0, "seconds": 0.0}
+            fanout = fanouts[batch]
+            fanout["sensors"] += 1
+            fanout["acked"] += acked
+            # until the last sensor of the batch confirmed its prompt or timed out
+            fanout["seconds"] = round(max(fanout["seconds"], done - start), 3)
+        for batch, fanout in fanouts.items():
+            logger.info(
+                f"Prompts reached {fanout['acked']} of {fanout['sensors']} sensors of batch {batch} in {fanout['seconds']}s"
+            )
+        self.fanouts.update(fanouts)
+
+    # sensor has at most one prompt in flight, see update
+    async def dispatch(self, batch: str, label: str, prompt: dict, digest: str) -> tuple:
+        try:
+            return await self._dispatch(batch, label, prompt, digest)
+        finally:
+            self.busy.discard((batch, label))
+            # subscriptions changed while the prompt was in flight
+            if (batch, label) in self.dirty:
+                self._mark_dirty(batch, label)
+
+    # prompt is sent and confirmed within settings.streaming.prompt_timeout,
+    # at most settings.streaming.prompt_concurrency sensors are waited for at once
+    async def _dispatch(self, batch: str, label: str, prompt: dict, digest: str) -> tuple:
+        if self.limit is None:
+            self.limit = aio.Semaphore(settings.streaming.prompt_concurrency)
+        async with self.limit:
+            if (sensor := sensors._ls.get(batch, {}).get(label)) is None:
+                # gone while waiting for its turn
+                self.current.pop((batch, label), None)
+                return batch, False, time.monotonic()
+            if sensor.codec is None:
+                return await self._dispatch_legacy(batch, label, sensor, prompt, digest)
+            frame, sent_as = self.prompt_frame(sensor, prompt)
+            ack = self.acks[batch, label] = (sent_as, aio.get_running_loop().create_future())
+            try:
+                await aio.wait_for(
+                    self._send(sensor, frame, ack[1]), settings.streaming.prompt_timeout
                 )
-            else:
-                await sendall("stop", sensor.writer)
-                logger.info(f"Seized ext query {query} from sensor {batch}!{label}")
+                self.running[batch, label] = digest
+                logger.info(f"Sensor {batch}!{label} runs {prompt['mark']} prompt {digest}")
+                acked = True
+            except (aio.TimeoutError, ConnectionError, LookupError) as exc:
+                logger.warning(f"Sensor {batch}!{label} didn't confirm prompt {digest}: {exc!r}")
+                # what sensor runs is unknown, the next prompt goes as a whole
+                sensor.sent.clear()
+                sensor.prompts.pop(digest, None)
+                self.current.pop((batch, label), None)
+                self.running.pop((batch, label), None)
+                acked = False
+            finally:
+                if self.acks.get((batch, label)) is ack:
+                    del self.acks[batch, label]
+        return batch, acked, time.monotonic()
+
+    # legacy sensor runs whatever it got and never says so, waiting for its ack
+    # would hold a slot of the limit for the whole prompt_timeout
+    async def _dispatch_legacy(
+        self, batch: str, label: str, sensor: Sensor, prompt: dict, digest: str
+    ) -> tuple:
+        try:
+            await aio.wait_for(
+                sendall(json.dumps(prompt), sensor.writer), settings.streaming.prompt_timeout
+            )
+        except (aio.TimeoutError, ConnectionError) as exc:
+            logger.warning(f"Sensor {batch}!{label} didn't get prompt {digest}: {exc!r}")
+            self.current.pop((batch, label), None)
+        else:
+            logger.info(f"Sensor {batch}!{label} got {prompt['mark']} prompt {digest}, legacy sensors don't confirm")
+        return batch, False, time.monotonic()
+
+    @staticmethod
+    async def _send(sensor: Sensor, frame: str, ack: aio.Future):
+        await sendall(frame, sensor.writer)
+        await ack
+
+    # sensor confirmed prompt it got or reported the one asked by hash as missing
+    def acked(self, batch: str, label: str, resp: dict):
+        if (ack := self.acks.get((batch, label))) is None or ack[1].done():
+            return
+        sent_as, future = ack
+        if resp.get("prompt") == sent_as:
+            future.set_result(None)
+        elif resp.get("missing") == sent_as:
+            future.set_exception(LookupError(f"prompt {sent_as} is not cached by sensor"))
+            # sent again as a whole
+            self._mark_dirty(batch, label)
+
+    # sensor gets the diff against its prompt of the same mark. Sensor applies
+    # text it has seen again to the prompt it runs, so the text is referred to
+    # by hash only when sensor runs the prompt it was applied to before.
+    # Returns the frame and the hash sensor confirms it with
+    def prompt_frame(self, sensor: Sensor, prompt: dict) -> tuple[str, str]:
+        prompt_str = json.dumps(prompt)
+        digest, mark = content_hash(prompt_str), prompt["mark"]
+        base = sensor.sent.get(mark)
+        base_digest = None if base is None else content_hash(json.dumps(base))
+        sensor.sent[mark] = prompt
+        if (entry := sensor.prompts.get(digest)) is not None and entry[1] == base_digest:
+            # used text becomes the most recently used one on sensor too
+            del sensor.prompts[digest]
+            sensor.prompts[digest] = entry
+            return f"{CMD_USE}{entry[0]}", entry[0]
+        if base is not None:
+            prompt_str = json.dumps(prompt_diff(base, prompt))
+        sensor.prompts.pop(digest, None)
+        # sensor drops the least recently used prompt once its cache is full
+        if len(sensor.prompts) >= settings.streaming.prompt_cache_size:
+            del sensor.prompts[next(iter(sensor.prompts))]
+        sent_as = content_hash(prompt_str)
+        sensor.prompts[digest] = (sent_as, base_digest)
+        return prompt_str, sent_as
+
+    def metrics(self) -> dict:
+        return {
+            "sensors": len(self.current),
+            "confirmed": sum(
+                self.running.get(sensor) == digest for sensor, digest in self.current.items()
+            ),
+            "pending": len(self.acks),
+            # the latest fan-out of prompts to every batch
+            "fanouts": self.fanouts,
+        }
 
 
 clients = ClientRepo()
@@ -342,23 +709,15 @@ responses = ResponseRepo()
 queries = QueryRepo()
 
 
-async def recvall(reader: aio.StreamReader) -> str:
-    raw_size = await reader.read(4)
-    if raw_size == b"":
+# returns raw frame: json.loads accepts bytes, while binary reports can't be decoded
+async def recvall(reader: aio.StreamReader) -> bytes:
+    try:
+        return await read_frame(reader, settings.streaming.max_frame_size)
+    except aio.IncompleteReadError:
         return PEER_DISCONNECTED
-    size = struct.unpack("i", raw_size)[0]
-
-    data = await reader.read(size)
-    data = data.decode(encoding="utf-8")
-    return data
-
-
-async def sendall(data: str, writer: aio.StreamWriter):
-    data = data.encode(encoding="utf-8")
-    size = struct.pack("i", len(data))
 
-    writer.write(size)
-    await writer.drain()
 
-    writer.write(data)
-    await writer.drain()
+async def sendall(data: str | bytes, writer: aio.StreamWriter):
+    if isinstance(data, str):
+        data = data.encode(encoding="utf-8")
+    await write_frame(writer, data)
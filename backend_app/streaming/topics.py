@@ -0,0 +1,161 @@
+import logging
+from fastapi import WebSocket
+from config import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# matches any batch, label or category
+WILDCARD = "*"
+
+
+class Topic:
+    """
+    Subscription "BATCH[!LABEL[!CAT[!FIELD,FIELD...]]][@SECONDS]", any of the first
+    three levels may be "*". Batch topics get standard responses of every sensor
+    in the batch, deeper ones get extended responses of the sensor, narrowed
+    to the category and fields when they are given. SECONDS asks sensors
+    to sample at least that often, but not more often than
+    settings.streaming.min_interval
+    """
+
+    __slots__ = ("query", "path", "fields", "interval")
+
+    def __init__(self, query: str):
+        body, _, interval = query.partition("@")
+        tokens = body.split("!")
+        if len(tokens) > 4 or not all(tokens):
+            raise ValueError(f"Malformed topic {query}")
+        self.query = query
+        # batch, label and category as far as they are given
+        self.path = tuple(tokens[:3])
+        self.fields = frozenset(tokens[3].split(",")) if len(tokens) == 4 else None
+        self.interval = None
+        if interval:
+            try:
+                self.interval = float(interval)
+            except ValueError:
+                raise ValueError(f"Malformed interval of topic {query}") from None
+            # any client could make the whole cluster sample extended fields at kHz
+            if not self.interval >= settings.streaming.min_interval:
+                raise ValueError(
+                    f"Interval of topic {query} is below {settings.streaming.min_interval}s"
+                )
+
+    # category extended topic is narrowed to, None for all of them
+    @property
+    def cat(self) -> str | None:
+        return self.path[2] if len(self.path) == 3 and self.path[2] != WILDCARD else None
+
+    # only some categories or fields of extended response are sent
+    @property
+    def narrowed(self) -> bool:
+        return self.cat is not None or self.fields is not None
+
+    # flattened extended response, see ResponseRepo.send_last
+    def select(self, resp: dict) -> dict:
+        cat, fields = self.cat, self.fields
+        selected = {"header": resp["header"]}
+        for key, value in resp.items():
+            if key == "stale":
+                # categories sensor couldn't sample, only the ones topic asked for
+                if stale := [stale_cat for stale_cat in value if cat in (None, stale_cat)]:
+                    selected[key] = stale
+                continue
+            if key == "header" or (cat is not None and key != cat):
+                continue
+            if fields is None:
+                selected[key] = value
+            elif isinstance(value, list):
+                selected[key] = [_pick(row, fields) for row in value]
+            elif isinstance(value, dict):
+                selected[key] = _pick(value, fields)
+        return selected
+
+
+# rows of named things keep their names
+def _pick(row: dict, fields: frozenset) -> dict:
+    return {field: value for field, value in row.items() if field in fields or field == "name"}
+
+
+class Node:
+    __slots__ = ("children", "topics")
+
+    def __init__(self) -> None:
+        # batch, label or category -> Node
+        self.children = {}
+        # query -> (Topic, subscribed clients) of topics ending at this node
+        self.topics = {}
+
+
+class TopicIndex:
+    """
+    Trie of subscriptions keyed by batch -> label -> category. Looking up
+    topics of a sensor visits only the nodes on its path and their wildcard
+    siblings, so routing a response costs the number of matching topics
+    """
+
+    __slots__ = ("root", "subs")
+
+    def __init__(self) -> None:
+        self.root = Node()
+        # query -> clients, the same sets as in trie nodes
+        self.subs = {}
+
+    def add(self, topic: Topic, ws: WebSocket):
+        node = self.root
+        for key in topic.path:
+            if (child := node.children.get(key)) is None:
+                child = node.children[key] = Node()
+            node = child
+        if topic.query not in node.topics:
+            node.topics[topic.query] = (topic, set())
+            self.subs[topic.query] = node.topics[topic.query][1]
+            logger.info(f"Got new topic {topic.query}")
+        node.topics[topic.query][1].add(ws)
+
+    def remove(self, topic: Topic, ws: WebSocket):
+        trail = [self.root]
+        for key in topic.path:
+            if (node := trail[-1].children.get(key)) is None:
+                return
+            trail.append(node)
+        if (entry := trail[-1].topics.get(topic.query)) is None:
+            return
+        entry[1].discard(ws)
+        if entry[1]:
+            return
+        del trail[-1].topics[topic.query]
+        del self.subs[topic.query]
+        logger.info(f"Removed topic {topic.query}")
+        # nodes left without topics and children are pruned
+        for key, node, parent in zip(reversed(topic.path), reversed(trail), reversed(trail[:-1])):
+            if node.topics or node.children:
+                break
+            del parent.children[key]
+
+    def subscribers(self, query: str) -> set:
+        return self.subs.get(query, ())
+
+    @staticmethod
+    def _children(node: Node, key: str):
+        if (child := node.children.get(key)) is not None:
+            yield child
+        if key != WILDCARD and (child := node.children.get(WILDCARD)) is not None:
+            yield child
+
+    # standard and extended topics covering the sensor
+    def match(self, batch: str, label: str) -> tuple[list[Topic], list[Topic]]:
+        std, ext = [], []
+        for batch_node in self._children(self.root, batch):
+            std.extend(topic for topic, _ in batch_node.topics.values())
+            for label_node in self._children(batch_node, label):
+                ext.extend(topic for topic, _ in label_node.topics.values())
+                for cat_node in label_node.children.values():
+                    ext.extend(topic for topic, _ in cat_node.topics.values())
+        return std, ext
+
+    # someone gets standard responses of the batch
+    def covers(self, batch: str) -> bool:
+        return any(node.topics for node in self._children(self.root, batch))
@@ -0,0 +1,10 @@
+import os
+from pathlib import Path
+
+from config import settings
+
+
+# json/ is read relative to backend_app, as when backend is run from there
+os.chdir(Path(__file__).parent.parent)
+# tests don't write archive segments
+settings.archive.enabled = False
@@ -0,0 +1,142 @@
+import json
+import random
+from array import array
+
+import pytest
+
+from config import settings
+from streaming.archive import Segment, Tier, BatchArchive
+
+
+COLUMNS = ["time", "sensor", "cpu.user"]
+
+
+def rows(times: list, sensors: list) -> list[array]:
+    return [array("d", times), array("d", sensors), array("d", (t * 2 for t in times))]
+
+
+def expected(cols: list[array], start: float, end: float, sensor=None) -> dict:
+    picked = [
+        i
+        for i, t in enumerate(cols[0])
+        if start <= t < end and (sensor is None or cols[1][i] == sensor)
+    ]
+    return {name: [col[i] for i in picked] for name, col in zip(COLUMNS, cols)}
+
+
+def read(tier: Tier, start: float, end: float, sensor=None) -> dict:
+    return {name: list(col) for name, col in tier.read(start, end, sensor).items()}
+
+
+@pytest.fixture
+def segment_rows(monkeypatch):
+    monkeypatch.setattr(settings.archive, "segment_rows", 100)
+    monkeypatch.setattr(Segment, "BLOCK", 8)
+
+
+def test_skewed_clocks_and_late_rows_cost_only_their_blocks(tmp_path, segment_rows):
+    # four sensors a tick apart with clocks up to 3 s off, then a few spooled rows
+    times = [1000 + i // 4 + (i % 4) * 0.75 for i in range(200)]
+    times[150:153] = [1001.0, 1002.0, 1003.0]
+    sensors = [i % 4 for i in range(200)]
+    cols = rows(times, sensors)
+    tier = Tier(tmp_path, 0, COLUMNS)
+    tier.append(cols)
+
+    spans = [span for seg in tier.segments for span in seg.spans(1020, 1040)]
+    # blocks at the edges of the range and the one of spooled rows are scanned,
+    # the rest is sliced
+    assert sum(hi - lo for lo, hi, whole in spans if not whole) <= 3 * Segment.BLOCK
+    for start, end in ((0, 2000), (1010, 1020), (1001, 1004), (1049.5, 1060), (900, 1000)):
+        for sensor in (None, 0, 3):
+            assert read(tier, start, end, sensor) == expected(cols, start, end, sensor)
+
+
+def test_segment_bounds_survive_reopening(tmp_path, segment_rows):
+    tier = Tier(tmp_path, 0, COLUMNS)
+    tier.append(rows([5.0, 3.0, 4.0] + [float(t) for t in range(10, 20)], [0] * 13))
+    blocks = list(tier.segments[0].blocks[:4])
+    tier.close()
+
+    (seg,) = Tier(tmp_path, 0, COLUMNS).segments
+    assert (seg.first, seg.last) == (3.0, 19.0)
+    assert list(seg.blocks[:4]) == blocks == [3.0, 14.0, 15.0, 19.0]
+
+
+def test_segment_of_previous_version_gets_bounds_from_its_rows(tmp_path):
+    path = tmp_path / "00000000.seg"
+    seg = Segment(path, COLUMNS, 10)
+    seg.append(rows([1.0, 2.0, 7.0], [0, 1, 0]))
+    seg.close()
+    # header without blocks, as written before they were kept
+    data = bytearray(path.read_bytes())
+    header_end = data.index(b"}") + 1
+    header = json.dumps({"columns": COLUMNS, "capacity": 10}).encode()
+    data[Segment.COUNT.size : header_end] = header.ljust(header_end - Segment.COUNT.size)
+    path.write_bytes(data)
+
+    seg = Segment(path)
+    assert (seg.first, seg.last) == (1.0, 7.0)
+    assert list(seg.spans(0, 5)) == [(0, 3, False)]
+    seg.close()
+
+
+def test_segments_of_other_columns_are_read(tmp_path, segment_rows):
+    tier = Tier(tmp_path, 0, COLUMNS)
+    tier.append(rows([1.0, 2.0], [0, 0]))
+    tier.close()
+
+    tier = Tier(tmp_path, 0, [*COLUMNS, "mem.used"])
+    tier.append([array("d", [3.0]), array("d", [0]), array("d", [6.0]), array("d", [9.0])])
+    got = read(tier, 0, 10)
+    assert got["time"] == [1.0, 2.0, 3.0]
+    assert got["cpu.user"] == [2.0, 4.0, 6.0]
+    assert got["mem.used"][2] == 9.0 and all(v != v for v in got["mem.used"][:2])
+
+
+def test_late_rows_are_rolled_up_again(tmp_path, segment_rows, monkeypatch):
+    monkeypatch.setattr(settings.archive, "tiers", [10, 60])
+    monkeypatch.setattr(settings.archive, "compact_lag", 0)
+    arch = BatchArchive(tmp_path, ["cpu.user"])
+    for t in range(100):
+        arch.append("a", 1000.0 + t, [1.0])
+        arch.append("b", 1000.0 + t, [5.0])
+    arch.flush(arch.take_pending())
+    arch.compact(1200)
+    assert arch.query("a", 1000, 1100, 10)["count"] == [10] * 10
+
+    # spooled rows of a come after their buckets were rolled up
+    arch.append("a", 1011.5, [4.0])
+    arch.append("a", 1012.5, [7.0])
+    arch.flush(arch.take_pending())
+    arch.close()
+    arch = BatchArchive(tmp_path, ["cpu.user"])
+    arch.compact(1200)
+
+    tens = arch.query("a", 1000, 1100, 10)
+    assert tens["time"] == [1000.0 + 10 * i for i in range(10)]
+    assert tens["count"][1] == 12
+    assert tens["cpu.user:max"][1] == 7.0
+    assert tens["cpu.user:avg"][1] == pytest.approx((10 + 4 + 7) / 12)
+    # the last by time, not the last written
+    assert tens["cpu.user:last"][1] == 1.0
+    assert arch.query("a", 900, 1100, 60)["count"] == [22, 60, 20]
+    assert arch.query("b", 1000, 1100, 10)["count"] == [10] * 10
+    assert not arch.late and not (tmp_path / "late.json").exists()
+    arch.close()
+
+
+def test_random_rows_of_many_segments(tmp_path, segment_rows):
+    rand = random.Random(7)
+    times = sorted(rand.uniform(0, 1000) for _ in range(1000))
+    # a few late rows
+    for idx in rand.sample(range(1000), 20):
+        times[idx] -= rand.uniform(0, 50)
+    cols = rows(times, [rand.randrange(5) for _ in times])
+    tier = Tier(tmp_path, 0, COLUMNS)
+    tier.append(cols)
+    for _ in range(50):
+        start = rand.uniform(-10, 1000)
+        end = start + rand.uniform(0, 300)
+        sensor = rand.choice((None, 0, 4))
+        assert read(tier, start, end, sensor) == expected(cols, start, end, sensor)
@@ -0,0 +1,33 @@
+import asyncio as aio
+
+from streaming.store import ClientRepo
+
+
+class GoneClient:
+    client = "gone:1"
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame: str):
+        raise RuntimeError("websocket is closed")
+
+
+def test_client_failing_to_receive_is_disconnected():
+    async def run():
+        clients = ClientRepo()
+        ws = GoneClient()
+        await clients.connect(ws)
+        clients.subscribe(ws, "b")
+        outbox = clients._ls[ws]
+
+        outbox.put("b", {"b!l": "{}"}, "{}")
+        await aio.sleep(0.01)
+        assert ws not in clients._ls
+        assert not clients.topics
+        assert not clients.index.subscribers("b")
+        # responses routed before the client was dropped are not queued
+        outbox.put("b", {"b!l": "{}"}, "{}")
+        assert outbox.closed and outbox.depth() == 0
+
+    aio.run(run())
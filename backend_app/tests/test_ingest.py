@@ -0,0 +1,73 @@
+import json
+import logging
+import asyncio as aio
+from types import SimpleNamespace
+
+import pytest
+
+from streaming import ingest
+from streaming.ingest import SensorProtocol
+from wire.framing import SIZE
+
+
+class Transport:
+    def __init__(self):
+        self.closing = False
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def get_extra_info(self, name: str):
+        return ("127.0.0.1", 40000)
+
+
+def connected() -> SensorProtocol:
+    proto = SensorProtocol()
+    proto.connection_made(Transport())
+    proto.batch, proto.label = "b", "l"
+    return proto
+
+
+def feed(proto: SensorProtocol, *frames: bytes):
+    data = b"".join(SIZE.pack(len(frame)) + frame for frame in frames)
+    proto.get_buffer(len(data))[: len(data)] = data
+    proto.buffer_updated(len(data))
+
+
+def test_frame_that_cant_be_decoded_is_dropped(monkeypatch, caplog):
+    added = []
+    monkeypatch.setattr(ingest, "batcher", SimpleNamespace(add=lambda *report: added.append(report)))
+    proto = connected()
+    report = json.dumps({"header": "report!b!l!std!1700000000", "cpu": {"user": 1.0}})
+    with caplog.at_level(logging.WARNING):
+        feed(proto, b"{not json", report.encode())
+    assert "Sensor b!l sent frame of 9 bytes" in caplog.text
+    # the report after the broken frame still got through
+    assert added == [("b", "l", "std", "1700000000", {"cpu": {"user": 1.0}})]
+
+
+def test_lost_connection_fails_only_awaited_drain(monkeypatch):
+    monkeypatch.setattr(ingest, "sensors", SimpleNamespace(disconnect=lambda batch, label, writer: None))
+
+    async def run():
+        loop = aio.get_running_loop()
+        errors = []
+        loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+        proto = connected()
+        proto.pause_writing()
+        drained = proto.drained
+        proto.connection_lost(None)
+        # nobody to retrieve the exception
+        assert not drained.done()
+
+        proto = connected()
+        proto.pause_writing()
+        draining = aio.create_task(proto.drain())
+        await aio.sleep(0)
+        proto.connection_lost(None)
+        with pytest.raises(ConnectionResetError):
+            await draining
+        assert errors == []
+
+    aio.run(run())
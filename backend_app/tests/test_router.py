@@ -0,0 +1,19 @@
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+# auth dependencies of the web process
+pytest.importorskip("jwt")
+pytest.importorskip("python_freeipa")
+
+from router import router, get_data_from_jwt_cookie
+
+
+def test_metrics_need_login():
+    route = next(route for route in router.routes if route.path == "/internal/metrics")
+    assert get_data_from_jwt_cookie in [dep.call for dep in route.dependant.dependencies]
+
+    request = Request({"type": "http", "headers": []})
+    with pytest.raises(HTTPException) as err:
+        get_data_from_jwt_cookie(request)
+    assert err.value.status_code == 401
@@ -0,0 +1,69 @@
+import json
+
+from streaming.store import responses
+from streaming.sensors import accept_hello, decode_frame, hello_ack
+from wire.codec import Schema, Batch, encode_report
+from wire.delta import DeltaEncoder
+
+
+def specs_frame(**extra) -> bytes:
+    return json.dumps(
+        {"type": "specs", "header": "spec!b!l", "cpu": {"cores": 4}, **extra}
+    ).encode()
+
+
+def test_json_report_as_sensor_sends_it():
+    frame = json.dumps(
+        {
+            "header": "report!b!l!std!1700000000",
+            "stale": [],
+            "cpu": {"user": 1.5},
+            "mem": {"used": 10.0},
+        }
+    ).encode()
+    mark, time, body = decode_frame("b", "l", {}, memoryview(frame))
+    assert mark == "std"
+    assert time == "1700000000"
+    assert body == {"stale": [], "cpu": {"user": 1.5}, "mem": {"used": 10.0}}
+
+
+def test_codec_is_negotiated_with_sensor_offering_codecs():
+    batch, label, codec, specs, token = accept_hello(specs_frame(codecs=["bin1", "json"]))
+    assert (batch, label, codec) == ("b", "l", "bin1")
+    assert specs == {"type": "specs", "cpu": {"cores": 4}}
+    assert hello_ack(codec, token) == f"ack?bin1?{token}".encode()
+
+
+def test_legacy_sensor_gets_no_ack():
+    batch, label, codec, specs, token = accept_hello(specs_frame())
+    assert codec is None
+    assert hello_ack(codec, token) is None
+
+
+def test_stale_categories_come_with_binary_reports():
+    schema = Schema.from_report("std", {"cpu": {"user": 1.5}}, ["mem"])
+    schemas = {}
+    assert decode_frame("b", "l", schemas, json.dumps(schema.to_dict()).encode()) is None
+    frame = encode_report(schema, 1700000000.0, {"cpu": {"user": 1.5}})
+    mark, _, body = decode_frame("b", "l", schemas, memoryview(frame))
+    assert body == {"cpu": {"user": 1.5}, "stale": ["mem"]}
+
+
+def test_stale_categories_come_with_batches():
+    schema = Schema.from_report("std", {"cpu": {"user": 1.5}}, ["mem"])
+    batch = Batch(schema)
+    batch.add(1700000000.0, {"cpu": {"user": 1.5}})
+    batch.add(1700000001.0, {"cpu": {"user": 2.5}})
+    schemas = {schema.id: Schema.from_dict(json.loads(json.dumps(schema.to_dict())))}
+    mark, time, samples = decode_frame("b", "l", schemas, memoryview(batch.encode()))
+    assert list(samples["stale"]) == ["mem"]
+
+
+def test_stale_categories_come_with_deltas():
+    encoder = DeltaEncoder({"keyframe": 10})
+    keyframe = json.loads(encoder.frame("delta!b!l!std!1", "std", {"cpu": {"user": 1.5}}, ["mem"]))
+    delta = json.loads(encoder.frame("delta!b!l!std!2", "std", {"cpu": {"user": 2.5}}, ["mem"]))
+    assert responses.rebuild("b", "d", keyframe) == {"cpu": {"user": 1.5}, "stale": ["mem"]}
+    assert responses.rebuild("b", "d", delta) == {"cpu": {"user": 2.5}, "stale": ["mem"]}
+    # decoder state stays free of them
+    assert responses.deltas["b", "d"].report == {"cpu": {"user": 2.5}}
@@ -0,0 +1,100 @@
+import socket
+import marshal
+import asyncio as aio
+
+from config import settings
+from streaming.store import responses
+from streaming.shards import Uplink, ShardProtocol, handle_shard
+from wire.framing import read_frame, write_frame
+
+
+class Transport:
+    def __init__(self):
+        self.reading = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+
+def test_sensors_are_not_read_while_web_process_lags(monkeypatch):
+    monkeypatch.setattr(settings.streaming, "shards_high_water", 256 * 1024)
+
+    async def run():
+        web, shard = socket.socketpair()
+        web.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        shard.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        _, writer = await aio.open_connection(sock=shard)
+        reader, web_writer = await aio.open_connection(sock=web)
+        uplink = Uplink(writer)
+        sensor = ShardProtocol(uplink)
+        sensor.connection_made(Transport())
+
+        while not uplink.paused:
+            uplink.send(("report", "b", "l", "std", 1, {"pad": bytes(64 * 1024)}))
+            await aio.sleep(0)
+        assert not sensor.transport.reading
+        # connections made meanwhile wait too
+        late = ShardProtocol(uplink)
+        late.connection_made(Transport())
+        assert not late.transport.reading
+
+        while uplink.paused:
+            await read_frame(reader)
+        assert sensor.transport.reading and late.transport.reading
+        writer.close()
+        web_writer.close()
+
+    aio.run(run())
+
+
+def test_web_process_hears_of_disconnected_sensors():
+    async def run():
+        web, shard = socket.socketpair()
+        _, writer = await aio.open_connection(sock=shard)
+        reader, web_writer = await aio.open_connection(sock=web)
+        uplink = Uplink(writer)
+        old, new = ShardProtocol(uplink), ShardProtocol(uplink)
+        for proto in (old, new):
+            proto.connection_made(Transport())
+            proto.batch, proto.label = "b", "l"
+        uplink.conns["b", "l"] = old
+
+        old.connection_lost(None)
+        assert marshal.loads(await read_frame(reader)) == [("gone", "b", "l")]
+        # sensor reconnected before its old connection was lost
+        old.connection_made(Transport())
+        uplink.conns["b", "l"] = new
+        old.connection_lost(None)
+        new.connection_lost(None)
+        assert marshal.loads(await read_frame(reader)) == [("gone", "b", "l")]
+        assert not uplink.conns and not uplink.protocols
+        writer.close()
+        web_writer.close()
+
+    aio.run(run())
+
+
+def test_bad_message_does_not_take_shard_link_down():
+    async def run():
+        web, shard = socket.socketpair()
+        reader, writer = await aio.open_connection(sock=web)
+        link = aio.create_task(handle_shard(reader, writer))
+        _, shard_writer = await aio.open_connection(sock=shard)
+        await write_frame(shard_writer, marshal.dumps(0))
+        entry = ["shard", "l", None, "digest", {}]
+        msgs = [
+            ("specs", "shard", "l"),
+            ("specs", "shard", "l", {}, "token", entry),
+            ("report", "shard", "l", "std", "1700000000", {"cpu": {"user": 1.0}}),
+        ]
+        await write_frame(shard_writer, marshal.dumps(msgs))
+        await write_frame(shard_writer, b"not marshal")
+        await write_frame(shard_writer, marshal.dumps([("report", "shard", "l", "std", "1700000001", {})]))
+        shard_writer.close()
+        await aio.wait_for(link, 1)
+        assert responses.std["shard"]["l"]["header"] == "mstd!shard!l!1700000001"
+
+    aio.run(run())
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from streaming.standard import Standardiser
+
+
+SPECS = {"mem": {"mem_total": 16384, "swp_total": 4096}}
+
+
+@pytest.fixture
+def standardiser():
+    with open("json/query.standard.json", "r") as file:
+        return Standardiser(json.load(file))
+
+
+def core(user, system, iowait, idle, **extra):
+    return {"user": user, "system": system, "iowait": iowait, "idle": idle, **extra}
+
+
+def test_cores_are_averaged(standardiser):
+    resp = {
+        "cpu": [
+            core(10.0, 4.0, 1.0, 85.0, freq=2400, nice=0.5),
+            core(30.0, 6.0, 0.0, 64.0, freq=3600, nice=1.5),
+        ]
+    }
+    assert standardiser.standardise(resp, SPECS) == {
+        "cpu": {"system": 5.0, "user": 20.0, "iowait": 0.5, "idle": 74.5, "freq": 3000.0}
+    }
+
+
+def test_nics_and_disks_are_summed(standardiser):
+    resp = {
+        "net": {
+            "eth0": {"recv": 100, "sent": 10, "drops": 1},
+            "eth1": {"recv": 50, "sent": 5, "drops": 0},
+            "lo": {"recv": 1, "sent": 1, "drops": 0},
+        },
+        "dsk": {
+            "sda": {"read": 2048, "write": 512, "busy": 3.5},
+            "nvme0n1": {"read": 1024, "write": 256, "busy": 1.0},
+        },
+    }
+    assert standardiser.standardise(resp, SPECS) == {
+        "net": {"recv": 151, "sent": 16},
+        "dsk": {"read": 3072, "write": 768},
+    }
+
+
+def test_memory_turns_into_percents(standardiser):
+    resp = {"mem": {"used": 4096, "swap": 1024, "cached": 2048}}
+    assert standardiser.standardise(resp, SPECS) == {"mem": {"used": 25.0, "swap": 25.0}}
+    # without totals in specs values are left as reported
+    assert standardiser.standardise(resp, {"mem": {"mem_total": 0}}) == {
+        "mem": {"used": 4096, "swap": 1024}
+    }
+    assert standardiser.standardise(resp, {}) == {"mem": {"used": 4096, "swap": 1024}}
+
+
+def test_fields_missing_from_every_row_are_left_out(standardiser):
+    resp = {
+        "cpu": [core(10.0, 4.0, 1.0, 85.0), core(30.0, 6.0, 0.0, 64.0)],
+        "net": {"eth0": {"recv": 100}, "eth1": {"recv": 50}},
+        "mem": {"used": 4096},
+    }
+    assert standardiser.standardise(resp, SPECS) == {
+        "cpu": {"system": 5.0, "user": 20.0, "iowait": 0.5, "idle": 74.5},
+        "net": {"recv": 150},
+        "mem": {"used": 25.0},
+    }
+
+
+# e.g. nic appeared or frequency of a core couldn't be read in the middle of tick
+def test_fields_missing_from_some_rows_count_rows_having_them(standardiser):
+    for cores in (
+        [core(10.0, 4.0, 1.0, 85.0, freq=2400), core(30.0, 6.0, 0.0, 64.0)],
+        [core(10.0, 4.0, 1.0, 85.0), core(30.0, 6.0, 0.0, 64.0, freq=2400)],
+    ):
+        assert standardiser.standardise({"cpu": cores}, SPECS) == {
+            "cpu": {"system": 5.0, "user": 20.0, "iowait": 0.5, "idle": 74.5, "freq": 2400.0}
+        }
+    resp = {"net": {"eth0": {"recv": 100}, "eth1": {"recv": 50, "sent": 5}}}
+    assert standardiser.standardise(resp, SPECS) == {"net": {"recv": 150, "sent": 5}}
+
+
+def test_empty_and_absent_categories(standardiser):
+    resp = {"cpu": [], "net": {}, "dsk": {}, "gpu": {"load": 5}}
+    assert standardiser.standardise(resp, SPECS) == {"cpu": {}, "net": {}, "dsk": {}}
+    assert standardiser.standardise({}, SPECS) == {}
+
+
+# sensor asked for plain extended fields reports categories as single rows
+def test_flat_categories_are_picked(standardiser):
+    resp = {
+        "cpu": core(10.0, 4.0, 1.0, 85.0, nice=0.5),
+        "net": {"recv": 100, "sent": 10, "drops": 1},
+    }
+    assert standardiser.standardise(resp, SPECS) == {
+        "cpu": {"system": 4.0, "user": 10.0, "iowait": 1.0, "idle": 85.0},
+        "net": {"recv": 100, "sent": 10},
+    }
@@ -0,0 +1,153 @@
+import json
+import asyncio as aio
+
+from config import settings
+from streaming.store import Sensor, QueryRepo, ResponseRepo, sensors, responses
+from wire.codec import CODEC_JSON
+
+
+def test_deltas_are_off_by_default():
+    assert settings.streaming.delta_keyframe == 0
+
+
+def test_disconnected_sensor_starts_over_with_keyframe():
+    keyframe = {"seq": 7, "key": 1, "body": {"mem": {"used": 1.0}}}
+    delta = {"seq": 8, "set": [["mem", None, "used", 2.0]]}
+    assert responses.rebuild("b", "l", keyframe) == {"mem": {"used": 1.0}}
+    sensors.disconnect("b", "l")
+    assert ("b", "l") not in responses.deltas
+    # delta of the old connection can't be applied to nothing
+    assert responses.rebuild("b", "l", delta) is None
+
+
+class Writer:
+    def __init__(self):
+        self.frames = []
+
+    def writelines(self, data):
+        self.frames.append(b"".join(data)[4:])
+
+    async def drain(self):
+        pass
+
+
+def test_sensor_gets_next_prompt_once_the_one_in_flight_is_acked(monkeypatch):
+    monkeypatch.setattr(settings.streaming, "prompt_debounce", 0)
+    writer = Writer()
+    monkeypatch.setitem(sensors._ls, "q", {"l": Sensor(None, writer, {}, CODEC_JSON)})
+
+    async def run():
+        repo = QueryRepo()
+        repo._mark_dirty("q", "l")
+        await aio.sleep(0.01)
+        assert len(writer.frames) == 1
+        # update waiting for the ack is kept from garbage collection
+        assert len(repo.tasks) == 1
+        first = repo.acks["q", "l"]
+
+        # subscriptions change before sensor confirmed the first prompt
+        repo.builder.idle_interval = 30
+        repo._mark_dirty("q", "l")
+        await aio.sleep(0.01)
+        assert len(writer.frames) == 1
+        assert repo.acks["q", "l"] is first
+
+        repo.acked("q", "l", {"prompt": first[0]})
+        await aio.sleep(0.01)
+        assert len(writer.frames) == 2
+        assert json.loads(writer.frames[1])["interval"] == 30
+        repo.acked("q", "l", {"prompt": repo.acks["q", "l"][0]})
+        await aio.sleep(0.01)
+        assert not repo.busy and not repo.acks and not repo.tasks
+
+    aio.run(run())
+
+
+def test_prompt_is_used_by_hash_only_on_the_prompt_it_was_applied_to():
+    repo, sensor = QueryRepo(), Sensor(None, Writer(), {}, CODEC_JSON)
+    first = {"mark": "std", "interval": 1}
+    second = {"mark": "std", "interval": 2}
+    _, first_as = repo.prompt_frame(sensor, first)
+    diff, diff_as = repo.prompt_frame(sensor, second)
+    assert json.loads(diff) == {"mark": "std", "interval": 2}
+
+    # first text would be applied to the second prompt, it has to be diffed against it
+    frame, _ = repo.prompt_frame(sensor, first)
+    assert frame == json.dumps({"mark": "std", "interval": 1})
+    frame, sent_as = repo.prompt_frame(sensor, second)
+    assert frame == f"use {diff_as}" and sent_as == diff_as
+
+
+def test_batched_samples_keep_their_times():
+    from array import array
+    from wire.codec import ROW_FLAT, ROW_LIST
+
+    repo = ResponseRepo()
+    repo.add_batch("b")
+    times = [100.25, 100.5, 100.75]
+    flat = (("cpu", ROW_FLAT, ("load",), None),)
+    listed = (("net", ROW_LIST, ("sent",), 1),)
+    for label, cats in (("flat", flat), ("listed", listed)):
+        samples = {
+            "type": "batch",
+            "cats": cats,
+            "times": times,
+            "values": array("d", [1.0, 2.0, 3.0]).tobytes(),
+        }
+        assert repo.insert_samples("b", label, "std", samples) == "std"
+        assert repo.history.window("b", label, 10)["time"] == times
+
+
+def test_broken_report_does_not_drop_the_rest_of_batch():
+    repo = ResponseRepo()
+    repo.add_batch("b")
+    good = {"cpu": {"user": 1.0}}
+    repo.insert_batch(
+        [
+            ("b", "bad", "std", "1700000000", {"type": "batch"}),
+            ("b", "good", "std", "1700000000", good),
+        ]
+    )
+    assert "bad" not in repo.std["b"]
+    assert repo.std["b"]["good"] == {"header": "mstd!b!good!1700000000", **good}
+
+
+def test_legacy_sensor_is_not_waited_for(monkeypatch):
+    monkeypatch.setattr(settings.streaming, "prompt_debounce", 0)
+    writer = Writer()
+    monkeypatch.setitem(sensors._ls, "legacy", {"l": Sensor(None, writer, {})})
+
+    async def run():
+        repo = QueryRepo()
+        repo._mark_dirty("legacy", "l")
+        await aio.sleep(0.01)
+        # full prompt, nothing left in flight
+        assert json.loads(writer.frames[0])["mark"] == "std"
+        assert not repo.acks and not repo.busy
+        assert repo.fanouts["legacy"]["sensors"] == 1
+        assert repo.fanouts["legacy"]["acked"] == 0
+
+    aio.run(run())
+
+
+def test_gone_sensor_gets_no_prompts(monkeypatch):
+    monkeypatch.setattr(settings.streaming, "prompt_debounce", 0)
+    old, new = Writer(), Writer()
+
+    async def run():
+        sensors.insert("gone", "l", None, old, {}, CODEC_JSON)
+        sensors.insert("gone", "l", None, new, {}, CODEC_JSON)
+        # the old connection ends after the sensor reconnected
+        sensors.disconnect("gone", "l", old)
+        assert sensors._ls["gone"]["l"].writer is new
+        sensors.disconnect("gone", "l", new)
+        assert "l" not in sensors._ls["gone"]
+        # clients still see what it was
+        assert sensors.get_specs("gone", "l") == {}
+
+        repo = QueryRepo()
+        repo._mark_dirty("gone", "l")
+        await aio.sleep(0.01)
+        assert not old.frames and not new.frames and not repo.busy
+
+    aio.run(run())
@@ -36,6 +36,19 @@ export const useMonitoringDataStore = defineStore('monitoringDataStore', {
           // console.log(msg)
           }
         },
+        updateStd(parsed_data){
+          let nodeMonitored = false
+          for (let i = 0; i < this.serverMsgStd.length; i++){
+            if (this.serverMsgStd[i].name === parsed_data.header.split("!")[2]){
+              this.serverMsgStd[i] = formatComputeNodeOutput(parsed_data)
+              nodeMonitored = true
+              break
+            }
+          }
+          if (!nodeMonitored){
+            this.serverMsgStd.push(formatComputeNodeOutput(parsed_data))
+          }
+        },
         listenMsg(){
           this.socket.addEventListener("message", (event) => {
             let parsed_data = JSON.parse(event.data)
@@ -44,16 +57,12 @@ export const useMonitoringDataStore = defineStore('monitoringDataStore', {
               this.serverMsgSpc = parsed_data;
 
             } else if (parsed_data.header.split("!")[0] === "mstd"){
-              let nodeMonitored = false
-              for (let i = 0; i < this.serverMsgStd.length; i++){
-                if (this.serverMsgStd[i].name === parsed_data.header.split("!")[2]){
-                  this.serverMsgStd[i] = formatComputeNodeOutput(parsed_data)
-                  nodeMonitored = true
-                  break
-                }
-              }
-              if (!nodeMonitored){
-                this.serverMsgStd.push(formatComputeNodeOutput(parsed_data))
+              this.updateStd(parsed_data)
+
+            } else if (parsed_data.header.split("!")[0] === "mbat"){
+              // responses of the whole batch collected by server in one frame
+              for (let i = 0; i < parsed_data.rows.length; i++){
+                this.updateStd(parsed_data.rows[i])
               }
 
             } else if (parsed_data.header.split("!")[0] === "head") {
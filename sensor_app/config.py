@@ -1,5 +1,12 @@
+import sys
 import socket
 import logging
+import pathlib
+
+
+BASE_DIR = pathlib.Path(__file__).parent.parent
+# wire protocol is shared with backend and lives in the repository root
+sys.path.append(str(BASE_DIR))
 
 
 DEBUG = True
@@ -9,7 +16,40 @@ PORT_BACKEND = 32300
 GROUP = "BATCHNAME"
 MACHINE = socket.gethostname()
 ALWAYS_RECONNECT = True
+# seconds before reconnect, doubled after every failed attempt up to RECONNECT_DELAY_MAX,
+# actual delay is random between zero and that, so sensors don't come back all at once
 RECONNECT_DELAY = 5
+RECONNECT_DELAY_MAX = 120
+# seconds report may be held back because no sample changed
+REPORT_UNCHANGED_AFTER = 30
+# category whose samples don't change is sampled up to that many times less often
+UNCHANGED_BACKOFF_MAX = 8
+# threads collecting samples, trackers of different categories run concurrently
+TRACKER_WORKERS = 4
+# seconds tracker may take before its category is reported stale
+TRACKER_TIMEOUT = 2
+# seconds disk usage is cached, it changes slowly while statvfs of many mounts is not free
+DSK_USAGE_TTL = 30
+# seconds partitions are cached when mount table can't be watched in procfs
+DSK_MOUNTS_TTL = 60
+# prompts from backend bigger than that break the connection
+MAX_FRAME_SIZE = 1024**2
+# prompts kept by hash, so backend can switch between them with "use <hash>",
+# the least recently used ones are dropped first
+PROMPT_CACHE_SIZE = 16
 LOGFILE = "sensor.log"
 LOGLEVEL = logging.DEBUG
-SENSOR_CATEGORIES = ["cpu", "net", "mem", "dsk", "gpu"]
+# read counters straight from /proc on linux instead of asking psutil
+RAW_PROCFS = True
+SENSOR_CATEGORIES = ["cpu", "net", "mem", "dsk", "gpu", "tmp", "fan"]
+# trackers to run, see registry.py, the others are not even imported
+TRACKERS = ["cpu", "net", "mem", "dsk", "gpu", "tmp", "fan"]
+# hardware sensors are read from here, tests point it to fake tree
+SYSFS_ROOT = "/sys"
+# reports made while backend is not reachable are kept here and sent once it is back
+SPOOL_DIR = "spool"
+# the oldest segment of reports is dropped when spool grows over that
+SPOOL_SIZE = 64 * 1024**2
+SPOOL_SEGMENT_SIZE = 4 * 1024**2
+# spooled reports are sent in frames of about that many bytes
+SPOOL_BATCH_SIZE = 256 * 1024
@@ -1,25 +1,60 @@
+import random
 import asyncio as aio
-import struct
 
 import config
+from wire.codec import CODEC_JSON
+from wire.framing import read_frame, write_frame
 
 import logging
 
 logger = logging.getLogger(__name__)
-CONN_ERROR = (OSError, BrokenPipeError, ConnectionResetError)
+CONN_ERROR = (OSError, BrokenPipeError, ConnectionResetError, aio.IncompleteReadError)
 
 
 class Connection:
-    __slots__ = ("reader", "writer", "reader_lock", "writer_lock")
+    __slots__ = (
+        "reader",
+        "writer",
+        "reader_lock",
+        "writer_lock",
+        "codec",
+        "schema_id",
+        "delta",
+        "batch",
+        "batch_started",
+        "spooling",
+        "token",
+        "acked",
+    )
 
     def __init__(self):
         self.reader = None
         self.writer = None
         self.reader_lock = aio.Lock()
         self.writer_lock = aio.Lock()
+        # json until backend acknowledges something better
+        self.codec = CODEC_JSON
+        # id of the last report schema sent over this connection
+        self.schema_id = None
+        # DeltaEncoder when prompt asks for delta reports
+        self.delta = None
+        # Batch of samples not sent yet and monotonic time of its first sample
+        self.batch = None
+        self.batch_started = 0.0
+        # reports go to spool until connection is up and spooled ones are sent
+        self.spooling = True
+        # resume token of backend, sent instead of specs on reconnect
+        self.token = None
+        # set when backend acknowledged specs or resume
+        self.acked = aio.Event()
 
     async def establish(self):
+        attempt = 0
         while not self.writer or self.writer.is_closing():
+            # the very first connection is tried right away
+            if attempt or self.writer is not None:
+                delay = config.RECONNECT_DELAY * 2 ** min(attempt, 16)
+                await aio.sleep(random.uniform(0, min(delay, config.RECONNECT_DELAY_MAX)))
             logger.info("Trying to establish connection")
             try:
                 self.reader, self.writer = await aio.open_connection(
@@ -27,30 +62,30 @@ class Connection:
                     port=config.PORT_BACKEND,
                 )
             except CONN_ERROR:
-                pass
-            await aio.sleep(config.RECONNECT_DELAY)
+                attempt += 1
+        # new connection has to negotiate codec and send schemas again
+        self.codec = CODEC_JSON
+        self.schema_id = None
+        self.delta = None
+        self.batch = None
+        self.acked.clear()
         logger.info("Connection established")
 
+    # broken connection is closed, so establish opens a new one
+    def close(self):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.close()
+
     async def recvall(self) -> str:
         async with self.reader_lock:
-            raw_size = await self.reader.read(4)
-            if raw_size == b"":
-                raise ConnectionResetError
-            size = struct.unpack("i", raw_size)[0]
-
-            data = await self.reader.read(size)
+            data = await read_frame(self.reader, config.MAX_FRAME_SIZE)
             data = data.decode(encoding="utf-8")
             logger.debug(f"Received: {data}")
             return data
 
-    async def sendall(self, data: str):
+    async def sendall(self, data: str | bytes):
         async with self.writer_lock:
-            data = data.encode(encoding="utf-8")
-            size = struct.pack("i", len(data))
-
-            self.writer.write(size)
-            await self.writer.drain()
-
-            self.writer.write(data)
-            await self.writer.drain()
+            if isinstance(data, str):
+                data = data.encode(encoding="utf-8")
+            await write_frame(self.writer, data)
             logger.debug(f"Sent: {data}")
@@ -0,0 +1,81 @@
+import os
+import glob
+import logging
+
+import config
+import procfs
+from sensor import Tracker, COST_EXPENSIVE, byte_converter
+
+
+logger = logging.getLogger(__name__)
+
+
+# attributes of amdgpu and other drm drivers exposing load and vram in sysfs
+LOAD = "gpu_busy_percent"
+VRAM_USED = "mem_info_vram_used"
+VRAM_TOTAL = "mem_info_vram_total"
+
+
+class GpuTracker(Tracker):
+    """
+    Load and memory of gpus from /sys/class/drm/cardN/device,
+    reading them wakes the gpu firmware up, so it is sampled rarely
+    """
+
+    CATEGORY = "gpu"
+    COST = COST_EXPENSIVE
+    LAYOUT = ((), {"memory": "bytes"})
+
+    __slots__ = ("cards",)
+
+    def __init__(self, root: str | None = None):
+        root = root or config.SYSFS_ROOT
+        # card -> (ProcFile of load, ProcFile of used vram, total vram in bytes)
+        self.cards = {}
+        for card in sorted(glob.glob(f"{root}/class/drm/card*"), key=procfs.natural_key):
+            name = os.path.basename(card)
+            # connectors like card0-DP-1 are not gpus
+            if "-" in name or not os.path.exists(f"{card}/device/{LOAD}"):
+                continue
+            device = f"{card}/device"
+            self.cards[name] = (
+                procfs.ProcFile(f"{device}/{LOAD}", 64),
+                procfs.ProcFile(f"{device}/{VRAM_USED}", 64)
+                if os.path.exists(f"{device}/{VRAM_USED}")
+                else None,
+                int(procfs.read_text(f"{device}/{VRAM_TOTAL}") or 0),
+            )
+        if not self.cards:
+            raise FileNotFoundError("No gpus exposing load in sysfs")
+        super().__init__()
+
+    def get_specs(self) -> dict:
+        return {
+            "gpus": list(self.cards),
+            "dedic_mem": [byte_converter(total, "gb") for _, _, total in self.cards.values()],
+        }
+
+    def get_report_detailed(self, plan) -> dict:
+        fields = plan.fields
+        memory_scale = plan.scale_of("memory")
+        report = {}
+        for name, (load, used, _) in self.cards.items():
+            row = report[name] = {}
+            try:
+                if "load" in fields:
+                    row["load"] = int(load.read())
+                if "memory" in fields and used is not None:
+                    row["memory"] = round(int(used.read()) * memory_scale, 2)
+            except (OSError, ValueError) as exc:
+                # gpu is resetting or powered down
+                logger.debug(f"Can't read {name}: {exc}")
+        return report
+
+    def get_report(self, plan) -> dict:
+        rows = list(self.get_report_detailed(plan).values())
+        report = {}
+        if loads := [row["load"] for row in rows if "load" in row]:
+            report["load"] = round(sum(loads) / len(loads), 1)
+        if memory := [row["memory"] for row in rows if "memory" in row]:
+            report["memory"] = round(sum(memory), 2)
+        return report
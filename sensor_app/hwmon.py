@@ -0,0 +1,134 @@
+import os
+import glob
+import logging
+
+import config
+import procfs
+from sensor import Tracker, COST_MODERATE
+
+
+logger = logging.getLogger(__name__)
+
+
+class Hwmon:
+    """
+    Inputs of one kind (temp, fan) of all chips in /sys/class/hwmon.
+    Attribute files stay open and are re-read with pread, every one of them
+    is a single number, e.g. millidegrees for temperatures and rpm for fans
+    """
+
+    __slots__ = ("inputs",)
+
+    def __init__(self, kind: str, attrs: tuple, root: str):
+        # "chip/label" -> {attr: ProcFile}
+        self.inputs = {}
+        for chip in sorted(glob.glob(f"{root}/class/hwmon/hwmon*"), key=procfs.natural_key):
+            chip_name = procfs.read_text(f"{chip}/name") or os.path.basename(chip)
+            for path in sorted(glob.glob(f"{chip}/{kind}*_input"), key=procfs.natural_key):
+                base = path[: -len("_input")]
+                label = procfs.read_text(f"{base}_label") or os.path.basename(base)
+                name = f"{chip_name}/{label}"
+                if name in self.inputs:
+                    # the same chip twice, e.g. two nvme drives
+                    name = f"{os.path.basename(chip)}/{label}"
+                self.inputs[name] = {
+                    attr: procfs.ProcFile(f"{base}_{attr}", 64)
+                    for attr in attrs
+                    if os.path.exists(f"{base}_{attr}")
+                }
+
+    def read(self, attrs) -> dict[str, dict[str, int]]:
+        values = {}
+        for name, files in self.inputs.items():
+            row = values[name] = {}
+            for attr in attrs:
+                if (file := files.get(attr)) is None:
+                    continue
+                try:
+                    row[attr] = int(file.read())
+                except (OSError, ValueError):
+                    # sensor is there but can't be read right now
+                    continue
+        return values
+
+
+class TmpTracker(Tracker):
+    CATEGORY = "tmp"
+    COST = COST_MODERATE
+    # report field -> attribute of hwmon temperature
+    FIELDS_MAP = {"current": "input", "high": "max", "crit": "crit"}
+
+    __slots__ = ("hwmon",)
+
+    def __init__(self, root: str | None = None):
+        self.hwmon = Hwmon("temp", tuple(self.FIELDS_MAP.values()), root or config.SYSFS_ROOT)
+        if not self.hwmon.inputs:
+            raise FileNotFoundError("No temperature sensors in hwmon")
+        super().__init__()
+
+    def get_specs(self) -> dict:
+        return {"zones": list(self.hwmon.inputs)}
+
+    @staticmethod
+    def _convert(millidegrees: int, unit: str | None) -> float:
+        degrees = millidegrees / 1000
+        if unit == "f":
+            degrees = degrees * 9 / 5 + 32
+        return round(degrees, 1)
+
+    def get_report_detailed(self, plan) -> dict:
+        mp = self.__class__.FIELDS_MAP
+        fields, units = plan.fields, plan.units
+        attrs = [mp[field] for field in fields if field in mp]
+        return {
+            name: {
+                field: self._convert(row[mp[field]], units.get(field))
+                for field in fields
+                if field in mp and mp[field] in row
+            }
+            for name, row in self.hwmon.read(attrs).items()
+        }
+
+    # the hottest zone is what matters
+    def get_report(self, plan) -> dict:
+        report = {}
+        for row in self.get_report_detailed(plan).values():
+            for field, value in row.items():
+                report[field] = max(report.get(field, value), value)
+        return report
+
+
+class FanTracker(Tracker):
+    CATEGORY = "fan"
+    COST = COST_MODERATE
+    # report field -> attribute of hwmon fan, both in rpm
+    FIELDS_MAP = {"rpm": "input", "min": "min"}
+
+    __slots__ = ("hwmon",)
+
+    def __init__(self, root: str | None = None):
+        self.hwmon = Hwmon("fan", tuple(self.FIELDS_MAP.values()), root or config.SYSFS_ROOT)
+        if not self.hwmon.inputs:
+            raise FileNotFoundError("No fans in hwmon")
+        super().__init__()
+
+    def get_specs(self) -> dict:
+        return {"fans": list(self.hwmon.inputs)}
+
+    def get_report_detailed(self, plan) -> dict:
+        mp = self.__class__.FIELDS_MAP
+        fields = plan.fields
+        attrs = [mp[field] for field in fields if field in mp]
+        return {
+            name: {field: row[mp[field]] for field in fields if field in mp and mp[field] in row}
+            for name, row in self.hwmon.read(attrs).items()
+        }
+
+    def get_report(self, plan) -> dict:
+        rows = list(self.get_report_detailed(plan).values())
+        report = {}
+        for field in plan.fields:
+            values = [row[field] for row in rows if field in row]
+            if values:
+                report[field] = round(sum(values) / len(values))
+        return report
@@ -0,0 +1,458 @@
+import os
+import re
+import sys
+import time
+import select
+import tempfile
+from math import inf
+from array import array
+from operator import sub, mul, truediv, itemgetter
+from itertools import repeat, chain
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Linux counters read straight from procfs: files stay open and are re-read
+# with pread into reused buffers, values are parsed into flat arrays,
+# so a tick doesn't open files or build namedtuples per core, nic and disk
+# like psutil does. Trackers fall back to psutil when procfs is not there
+
+PROC = "/proc"
+SYS = "/sys"
+AVAILABLE = sys.platform.startswith("linux")
+
+# columns of cpu lines in /proc/stat
+CPU_FIELDS = (
+    "user",
+    "nice",
+    "system",
+    "idle",
+    "iowait",
+    "irq",
+    "softirq",
+    "steal",
+    "guest",
+    "guest_nice",
+)
+CPU_WIDTH = len(CPU_FIELDS)
+# guest time is already counted in user and nice
+CPU_GUEST = CPU_FIELDS.index("guest")
+# values of "cpu" and "cpuN" lines of /proc/stat
+CPU_LINE = re.compile(rb"^cpu\S* +(.*)$", re.M)
+# "  eth0: values" of /proc/net/dev
+NET_DEV_LINE = re.compile(rb"^ *([^:\s]+):(.*)$", re.M)
+# "major minor name values" of /proc/diskstats
+DISKSTATS_LINE = re.compile(rb"^ *\d+ +\d+ (\S+) (.*)$", re.M)
+# "MemTotal:  16318412 kB" of /proc/meminfo
+MEMINFO_LINE = re.compile(rb"^([^:\s]+): +(\d+)", re.M)
+
+
+def open_reader(cls, *args):
+    if not AVAILABLE:
+        return None
+    try:
+        return cls(*args)
+    except (OSError, ValueError) as exc:
+        logger.warning(f"Can't read {cls.__name__} from procfs, using psutil: {exc}")
+        return None
+
+
+def read_text(path: str) -> str | None:
+    try:
+        with open(path, "r") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+# hwmon2 goes after hwmon1 and before hwmon10
+def natural_key(path: str) -> list:
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", path)]
+
+
+class ProcFile:
+    """
+    File of procfs kept open and re-read from the start with pread,
+    the buffer is reused and only grows. Content is handed out as memoryview
+    of the buffer, valid until the next read, and parsed by regular
+    expressions straight from it, so only the values are copied
+    """
+
+    __slots__ = ("path", "fd", "buf", "view")
+
+    def __init__(self, path: str, size: int = 16 * 1024):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+    def read(self) -> memoryview:
+        while True:
+            n = os.preadv(self.fd, (self.buf,), 0)
+            if n < len(self.buf):
+                return self.view[:n]
+            # content didn't fit, generated files can't be read in parts
+            self.view.release()
+            self.buf = bytearray(2 * len(self.buf))
+            self.view = memoryview(self.buf)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ProcStat:
+    """
+    Cpu times of /proc/stat, percents are computed for all cores at once
+    over the flat arrays of counters of the current and the previous tick
+    """
+
+    __slots__ = ("file", "ncpu", "prev", "cur", "pct")
+
+    def __init__(self, root: str = PROC):
+        self.file = ProcFile(f"{root}/stat")
+        self.ncpu = -1
+        self.cur = array("d")
+        self.sample()
+
+    def _counters(self) -> array:
+        data = self.file.read()
+        # cpu lines come first, the long interrupt lines are not needed
+        if (end := self.file.buf.find(b"\nintr", 0, len(data))) == -1:
+            end = len(data)
+        lines = CPU_LINE.findall(data, 0, end)
+        tokens = b" ".join(lines).split()
+        if len(tokens) == len(lines) * CPU_WIDTH:
+            return array("d", map(float, tokens))
+        # old kernels have no steal and guest columns
+        counters = array("d")
+        for line in lines:
+            values = line.split()[:CPU_WIDTH]
+            counters.extend(map(float, values))
+            counters.extend(repeat(0.0, CPU_WIDTH - len(values)))
+        return counters
+
+    def sample(self):
+        counters = self._counters()
+        if len(counters) != CPU_WIDTH * (self.ncpu + 1):
+            # cpu went online or offline, percents start over
+            self.ncpu = len(counters) // CPU_WIDTH - 1
+            self.cur = counters
+        self.prev, self.cur = self.cur, counters
+
+        deltas = list(map(sub, self.cur, self.prev))
+        if deltas and min(deltas) < 0:
+            # counters never go back, unless cpu went offline and online again
+            deltas = [delta if delta > 0 else 0.0 for delta in deltas]
+        # percents are rounded to tenths as psutil does,
+        # cpu without ticks divides by infinity and gets zeros
+        totals = []
+        for base in range(0, len(deltas), CPU_WIDTH):
+            total = (
+                sum(deltas[base : base + CPU_WIDTH])
+                - deltas[base + CPU_GUEST]
+                - deltas[base + CPU_GUEST + 1]
+            )
+            totals.append(total if total > 0 else inf)
+        pct = map(
+            truediv,
+            map(mul, deltas, repeat(100)),
+            chain.from_iterable(map(repeat, totals, repeat(CPU_WIDTH))),
+        )
+        self.pct = list(map(round, pct, repeat(1)))
+
+    # rows of percents since the previous call, in CPU_FIELDS order
+    # as psutil.cpu_times_percent on Linux, the total row or one per core
+    def rows(self, percpu: bool = False) -> list[list[float]]:
+        self.sample()
+        pct = self.pct
+        if not percpu:
+            return [pct[:CPU_WIDTH]]
+        return [pct[base : base + CPU_WIDTH] for base in range(CPU_WIDTH, len(pct), CPU_WIDTH)]
+
+
+class ProcCounters:
+    """
+    Monotonic per device counters of procfs file, one row of array per device.
+    Subclasses know the file, which columns to take and how to name them
+    """
+
+    # psutil field -> (column of the file after the device name, multiplier)
+    COLUMNS = {}
+
+    __slots__ = ("file", "fields", "names", "prev", "cur", "time", "elapsed")
+
+    def __init__(self, path: str):
+        self.file = ProcFile(path)
+        self.fields = tuple(self.__class__.COLUMNS)
+        self.names = ()
+        self.prev = array("d")
+        self.cur = array("d")
+        self.time = None
+        self.elapsed = 0.0
+        self.sample()
+
+    def _rows(self, data: memoryview) -> list[tuple[str, list[bytes]]]:
+        raise NotImplementedError
+
+    def sample(self) -> float:
+        rows = self._rows(self.file.read())
+        now = time.monotonic()
+        cols = self.__class__.COLUMNS.values()
+        counters = array(
+            "d", [int(values[col]) * scale for _, values in rows for col, scale in cols]
+        )
+        names = tuple(name for name, _ in rows)
+        if names != self.names:
+            # device appeared or vanished, deltas start over
+            self.names = names
+            self.cur = counters
+            self.time = None
+        self.prev, self.cur = self.cur, counters
+        self.elapsed = now - self.time if self.time is not None else 0.0
+        self.time = now
+        return self.elapsed
+
+    # {name: increases since the previous sample in self.fields order},
+    # empty on the first sample
+    def rows(self, names=None) -> dict[str, list[float]]:
+        if not self.elapsed:
+            return {}
+        width = len(self.fields)
+        deltas = list(map(sub, self.cur, self.prev))
+        return {
+            name: deltas[row * width : (row + 1) * width]
+            for row, name in enumerate(self.names)
+            if names is None or name in names
+        }
+
+    # sums of rows over devices, None on the first sample
+    def total(self, names=None) -> list[float] | None:
+        if not self.elapsed:
+            return None
+        rows = self.rows(names).values()
+        return list(map(sum, zip(*rows))) if rows else [0.0] * len(self.fields)
+
+
+class ProcNetDev(ProcCounters):
+    COLUMNS = {
+        "bytes_recv": (0, 1),
+        "packets_recv": (1, 1),
+        "errin": (2, 1),
+        "dropin": (3, 1),
+        "bytes_sent": (8, 1),
+        "packets_sent": (9, 1),
+        "errout": (10, 1),
+        "dropout": (11, 1),
+    }
+
+    __slots__ = ()
+
+    def __init__(self, root: str = PROC):
+        super().__init__(f"{root}/net/dev")
+
+    def _rows(self, data: memoryview) -> list:
+        # lines of headers have no colon
+        return [(name.decode(), values.split()) for name, values in NET_DEV_LINE.findall(data)]
+
+
+class ProcDiskStats(ProcCounters):
+    COLUMNS = {
+        "read_count": (0, 1),
+        "read_merged_count": (1, 1),
+        # sectors are always 512 bytes in diskstats
+        "read_bytes": (2, 512),
+        "read_time": (3, 1),
+        "write_count": (4, 1),
+        "write_merged_count": (5, 1),
+        "write_bytes": (6, 512),
+        "write_time": (7, 1),
+    }
+
+    __slots__ = ("disks",)
+
+    def __init__(self, root: str = PROC, sys_root: str = SYS):
+        super().__init__(f"{root}/diskstats")
+        # whole disks are summed without their partitions as psutil does
+        self.disks = {
+            name
+            for name in self.names
+            if os.path.exists(f"{sys_root}/block/{name.replace('/', '!')}")
+        }
+
+    def _rows(self, data: memoryview) -> list:
+        rows = []
+        for name, values in DISKSTATS_LINE.findall(data):
+            if len(values := values.split()) >= 8:
+                rows.append((name.decode(), values))
+        return rows
+
+
+class ProcMemInfo:
+    """
+    /proc/meminfo in bytes with the same derived values as psutil.virtual_memory
+    """
+
+    __slots__ = ("file",)
+
+    def __init__(self, root: str = PROC):
+        self.file = ProcFile(f"{root}/meminfo")
+
+    def memory(self) -> dict:
+        info = {key: int(kb) * 1024 for key, kb in MEMINFO_LINE.findall(self.file.read())}
+
+        total = info[b"MemTotal"]
+        free = info[b"MemFree"]
+        buffers = info.get(b"Buffers", 0)
+        cached = info.get(b"Cached", 0) + info.get(b"SReclaimable", 0)
+        available = info.get(b"MemAvailable", free + buffers + cached)
+        used = total - free - buffers - cached
+        if used < 0:
+            used = total - free
+        swap_total = info.get(b"SwapTotal", 0)
+        swap_used = swap_total - info.get(b"SwapFree", 0)
+        return {
+            "total": total,
+            "available": available,
+            "percent": round((total - available) / total * 100, 1) if total else 0.0,
+            "used": used,
+            "free": free,
+            "buffers": buffers,
+            "cached": cached,
+            "shared": info.get(b"Shmem", 0),
+            "swap_total": swap_total,
+            "swap_used": swap_used,
+            "swap_percent": round(swap_used / swap_total * 100, 1) if swap_total else 0.0,
+        }
+
+
+# filesystems without blocks of their own or never changing in size
+VIRTUAL_FS = {
+    "overlay",
+    "squashfs",
+    "tmpfs",
+    "devtmpfs",
+    "ramfs",
+    "iso9660",
+    "nsfs",
+    "autofs",
+    "fuse.lxcfs",
+}
+# spaces and other whitespace in mountpoints are octal escapes
+OCTAL_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+
+class MountInfo:
+    """
+    Filesystems of block devices from /proc/self/mountinfo, one per device:
+    bind mounts and btrfs subvolumes are the same device mounted again.
+    The kernel flags the open file with POLLPRI when mount table changes,
+    so the table is parsed again only after mount or umount
+    """
+
+    __slots__ = ("file", "poll", "mounts")
+
+    def __init__(self, root: str = PROC):
+        self.file = ProcFile(f"{root}/self/mountinfo")
+        self.poll = select.poll()
+        self.poll.register(self.file.fd, select.POLLPRI | select.POLLERR)
+        # [(device, mountpoint, fstype)] ordered as mounted
+        self.mounts = self._parse()
+
+    def _parse(self) -> list[tuple[str, str, str]]:
+        mounts = {}
+        for line in str(self.file.read(), errors="replace").split("\n"):
+            fields, sep, fs = line.partition(" - ")
+            if not sep:
+                continue
+            fields = fields.split()
+            fstype, device = fs.split()[:2]
+            if fstype in VIRTUAL_FS or not device.startswith("/dev/"):
+                continue
+            mountpoint = OCTAL_ESCAPE.sub(lambda m: chr(int(m[1], 8)), fields[4])
+            # parents are listed before children, so the first mountpoint is the widest
+            if device not in mounts:
+                mounts[device] = (device, mountpoint, fstype)
+        return list(mounts.values())
+
+    def changed(self) -> bool:
+        if not self.poll.poll(0):
+            return False
+        self.mounts = self._parse()
+        return True
+
+
+# python procfs.py [CORES]
+# per tick cost of cpu percents on fake /proc/stat of many cores:
+# ProcStat against reading the file anew and building namedtuple per core
+def _bench(cores: int, ticks: int = 200):
+    from collections import namedtuple
+
+    CpuTimes = namedtuple("CpuTimes", CPU_FIELDS)
+
+    def write_stat(path: str, tick: int):
+        lines = [f"cpu  {' '.join(str(tick * (i + 1) * cores) for i in range(CPU_WIDTH))}"]
+        for core in range(cores):
+            lines.append(
+                f"cpu{core} {' '.join(str(tick * (i + 1) + core) for i in range(CPU_WIDTH))}"
+            )
+        lines.append("intr " + " ".join(["0"] * 1024))
+        with open(path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def reference(path: str, prev: list | None) -> tuple[list, list]:
+        with open(path, "rb") as file:
+            data = file.read()
+        times = [
+            CpuTimes(*map(float, line.split()[1 : CPU_WIDTH + 1]))
+            for line in data.split(b"\n")
+            if line.startswith(b"cpu")
+        ]
+        pct = []
+        for now, then in zip(times, prev or times):
+            deltas = [max(0.0, a - b) for a, b in zip(now, then)]
+            total = sum(deltas) - now.guest + then.guest - now.guest_nice + then.guest_nice
+            pct.append(
+                CpuTimes(*(round(d * 100 / total, 1) if total > 0 else 0.0 for d in deltas))
+            )
+        return times, pct
+
+    with tempfile.TemporaryDirectory() as root:
+        path = f"{root}/stat"
+        write_stat(path, 1)
+        reader = ProcStat(root)
+        prev = reference(path, None)[0]
+
+        elapsed_reader = elapsed_reference = 0.0
+        for tick in range(2, ticks + 2):
+            write_stat(path, tick)
+            start = time.perf_counter()
+            got = reader.rows(percpu=True)
+            elapsed_reader += time.perf_counter() - start
+            start = time.perf_counter()
+            prev, expected = reference(path, prev)
+            elapsed_reference += time.perf_counter() - start
+        assert got == [list(row) for row in expected[1:]]
+
+    print(
+        f"{cores} cores: procfs reader {elapsed_reader / ticks * 1e6:.0f} us, "
+        f"reopen and namedtuples {elapsed_reference / ticks * 1e6:.0f} us per tick"
+    )
+    try:
+        import psutil as ps
+    except ImportError:
+        return
+    ps.cpu_times_percent(percpu=True)
+    start = time.perf_counter()
+    for _ in range(ticks):
+        ps.cpu_times_percent(percpu=True)
+    print(
+        f"psutil on this host of {ps.cpu_count()} cores: "
+        f"{(time.perf_counter() - start) / ticks * 1e6:.0f} us per tick"
+    )
+
+
+if __name__ == "__main__":
+    _bench(int(sys.argv[1]) if len(sys.argv) >= 2 else 256)
@@ -1,18 +1,36 @@
+import copy
 import json
 import pathlib
+from operator import mul, itemgetter
+from itertools import repeat
+from typing import NamedTuple
 
-from config import SENSOR_CATEGORIES
+from config import SENSOR_CATEGORIES, PROMPT_CACHE_SIZE
+from wire.codec import content_hash
 
 JSON_FALLBACK = pathlib.Path(__file__).parent / "scheme/prompt.fallback.json"
 
-AVAIL_FIELDS = {
-    cat: set(json.load(open(JSON_FALLBACK, "r"))[cat]["units"].keys())
-    for cat in SENSOR_CATEGORIES
+# parsed once, every prompt starts from it
+FALLBACK = json.loads(JSON_FALLBACK.read_text())
+
+AVAIL_FIELDS = {cat: set(FALLBACK[cat]["units"]) for cat in SENSOR_CATEGORIES}
+
+# cat -> (columns of rows its tracker reads, {field: unit kind}),
+# registered by trackers as their classes are defined
+LAYOUTS = {}
+# unit kind -> unit -> multiplier of the value read, bytes come in bytes and frequency in MHz
+UNIT_SCALES = {
+    "bytes": {"kb": 1 / 1024, "mb": 1 / 1024**2, "gb": 1 / 1024**3, "tb": 1 / 1024**4},
+    "mhz": {"hz": 1024**2, "khz": 1024, "ghz": 1 / 1024},
 }
 
 
+def unit_scale(kind: str | None, unit: str | None) -> float:
+    return UNIT_SCALES.get(kind, {}).get(unit, 1.0)
+
+
 class Prompt:
-    __slots__ = ("mark", "interval", *SENSOR_CATEGORIES)
+    __slots__ = ("mark", "interval", "delta", "batch", *SENSOR_CATEGORIES)
 
     def __init__(self, **kwargs):
         self.load_fallback()
@@ -29,10 +47,14 @@ class Prompt:
             self.merge_dict(prompt_dict)
 
     def load_fallback(self):
-        with open(JSON_FALLBACK, "r") as prompt_file:
-            prompt_dict = json.load(prompt_file)
+        prompt_dict = FALLBACK
         self.mark = prompt_dict["mark"]
         self.interval = prompt_dict["interval"]
+        # {"keyframe": N, "epsilon": E, "compress": "zlib"} when backend wants deltas
+        self.delta = prompt_dict.get("delta", None)
+        # {"samples": N, "window": T} when backend wants samples in batches
+        # of N or every T seconds, whichever comes first
+        self.batch = prompt_dict.get("batch", None)
         for cat in SENSOR_CATEGORIES:
             setattr(self, cat, CategoryPrompt(cat, prompt_dict[cat]))
 
@@ -40,14 +62,38 @@ class Prompt:
         for cat in SENSOR_CATEGORIES:
             getattr(self, cat).validate()
 
+    def compile(self):
+        for cat in SENSOR_CATEGORIES:
+            getattr(self, cat).compile()
+
+    # seconds between samples of category, unless category has its own interval
+    # it is the prompt interval stretched by cost of the tracker
+    def interval_of(self, cat: str, cost: int = 1) -> float:
+        return getattr(self, cat).interval or self.interval * cost
+
+    # hash of what prompt asks for, the same for prompts made by different merges
+    def digest(self) -> str:
+        cats = (getattr(self, cat) for cat in SENSOR_CATEGORIES)
+        content = [self.mark, self.interval, self.delta, self.batch]
+        content.extend([cat.fields, cat.detailed, cat.units, cat.interval] for cat in cats)
+        return content_hash(json.dumps(content, sort_keys=True))
+
     def merge(self, other_prompt):
         self.interval = other_prompt.interval
+        self.delta = other_prompt.delta
+        self.batch = other_prompt.batch
         for cat in SENSOR_CATEGORIES:
             getattr(self, cat).merge(getattr(other_prompt, cat))
 
     def merge_dict(self, other_dict: dict):
+        if "mark" in other_dict:
+            self.mark = str(other_dict["mark"])
         if "interval" in other_dict:
             self.interval = other_dict["interval"]
+        if "delta" in other_dict:
+            self.delta = other_dict["delta"]
+        if "batch" in other_dict:
+            self.batch = other_dict["batch"]
         for cat in SENSOR_CATEGORIES:
             cat_prompt = CategoryPrompt(cat, other_dict.get(cat, None))
             cat_prompt.validate()
@@ -60,39 +106,56 @@ class Prompt:
 
 
 class CategoryPrompt:
-    __slots__ = ("cat", "fields", "detailed", "units")
+    __slots__ = ("cat", "fields", "detailed", "units", "interval", "plan")
+    # attributes set from prompt json
+    ATTRS = ("fields", "detailed", "units", "interval")
 
     def __init__(self, cat: str, prompt_dict: dict | None):
         self.cat = cat
+        self.plan = None
         if prompt_dict:
-            for attr in self.__class__.__slots__[1:]:
+            for attr in self.__class__.ATTRS:
                 setattr(self, attr, prompt_dict.get(attr, None))
         else:
-            for attr in self.__class__.__slots__[1:]:
+            for attr in self.__class__.ATTRS:
                 setattr(self, attr, None)
+        # own copies, fallback is shared by all prompts
+        self.fields = list(self.fields) if isinstance(self.fields, (list, tuple)) else None
+        self.units = dict(self.units) if isinstance(self.units, dict) else {}
 
     def validate(self):
-        ins_idx = 0
         if self.fields:
-            for idx, field in enumerate(self.fields):
-                if field in AVAIL_FIELDS[self.cat]:
-                    self.fields[ins_idx] = self.fields[idx].lower().trim()
-                    ins_idx += 1
-            self.fields = self.fields[:ins_idx]
+            fields = (str(field).strip().lower() for field in self.fields)
+            self.fields = [field for field in fields if field in AVAIL_FIELDS[self.cat]]
 
         if self.detailed not in (None, 0, 1):
             self.detailed = 0
-            
-        for field, unit in self.units.items():
-            self.units[field] = unit.lower().trim()
-            
+
+        if not isinstance(self.interval, (int, float)) or self.interval <= 0:
+            self.interval = None
+
+        self.units = {
+            str(field).strip().lower(): str(unit).strip().lower()
+            for field, unit in self.units.items()
+        }
+
+    # empty fields and zero detailed are given on purpose, e.g. by backend
+    # turning off categories nobody watches, so only missing ones are kept
     def merge(self, other_prompt):
-        if other_prompt.fields:
+        if other_prompt.fields is not None:
             self.fields = other_prompt.fields
-        if other_prompt.detailed:
+        if other_prompt.detailed is not None:
             self.detailed = other_prompt.detailed
         if other_prompt.units:
             self.units.update(other_prompt.units)
+        if other_prompt.interval:
+            self.interval = other_prompt.interval
+        self.plan = None
+
+    # plan is rebuilt whenever fields or units change
+    def compile(self) -> "Plan":
+        self.plan = Plan(self.fields, self.units, LAYOUTS.get(self.cat))
+        return self.plan
 
     def __str__(self) -> str:
         return "\n".join(
@@ -101,24 +164,234 @@ class CategoryPrompt:
                 f"\tfields: {self.fields}",
                 f"\tdetailed: {self.detailed}",
                 f"\tunits: {self.units}",
+                f"\tinterval: {self.interval}",
             ]
         )
 
 
+class Plan:
+    """
+    Category prompt compiled against the layout of rows its tracker reads:
+    indexes of the requested columns and multipliers into the requested units,
+    so a tick only picks columns out of rows and scales the ones in other units
+    """
+
+    __slots__ = ("fields", "units", "kinds", "names", "index", "scales")
+
+    def __init__(self, fields: list[str] | None, units: dict | None, layout: tuple | None):
+        self.fields = tuple(fields or ())
+        self.units = dict(units or {})
+        columns, self.kinds = layout or ((), {})
+        # requested fields found in rows, tracker gets the others elsewhere
+        self.names = tuple(field for field in self.fields if field in columns)
+        self.index = tuple(columns.index(field) for field in self.names)
+        self.scales = tuple(self.scale_of(field) for field in self.names)
+
+    # multiplier of field, also the ones outside of rows
+    def scale_of(self, field: str) -> float:
+        return unit_scale(self.kinds.get(field), self.units.get(field))
+
+    # [{field: value}] of rows, factor multiplies every value, e.g. 1 / elapsed
+    # seconds for rates. Values are taken a column at a time, scaled ones are
+    # rounded to hundredths and the others are left as read
+    def extract_rows(self, rows, factor: float = 1.0) -> list[dict]:
+        if not self.names:
+            return [{} for _ in rows]
+        columns = []
+        for col, scale in zip(self.index, self.scales):
+            column = map(itemgetter(col), rows)
+            if (scale := scale * factor) != 1.0:
+                column = map(round, map(mul, column, repeat(scale)), repeat(2))
+            columns.append(column)
+        return list(map(dict, map(zip, repeat(self.names), zip(*columns))))
+
+    def extract(self, row, factor: float = 1.0) -> dict:
+        return self.extract_rows((row,), factor)[0]
+
+
+class CategorySnapshot(NamedTuple):
+    fields: tuple
+    detailed: int | None
+    interval: float | None
+    plan: Plan
+
+
+class Snapshot:
+    """
+    Compiled prompt as tracker threads see it. Prompts arriving while trackers
+    are busy switch PromptStore to another snapshot, this one is never changed
+    """
+
+    __slots__ = ("mark", "interval", *SENSOR_CATEGORIES)
+
+    def __init__(self, prompt: Prompt):
+        object.__setattr__(self, "mark", prompt.mark)
+        object.__setattr__(self, "interval", prompt.interval)
+        for cat in SENSOR_CATEGORIES:
+            cat_prompt = getattr(prompt, cat)
+            snapshot = CategorySnapshot(
+                tuple(cat_prompt.fields or ()),
+                cat_prompt.detailed,
+                cat_prompt.interval,
+                cat_prompt.plan or cat_prompt.compile(),
+            )
+            object.__setattr__(self, cat, snapshot)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Prompt snapshot can't be changed, {name} is read only")
+
+    interval_of = Prompt.interval_of
+
+
 class PromptStore:
-    __slots__ = ("prompts", "mark")
+    __slots__ = ("prompts", "digests", "mark", "texts", "cache", "snapshot")
 
     def __init__(self):
-        self.prompts = {"fallback": Prompt()}
-        self.mark = "fallback"
+        fallback = Prompt()
+        fallback.compile()
+        # mark -> Prompt, "flb" of the fallback until backend sends its own
+        self.prompts = {fallback.mark: fallback}
+        # mark -> Prompt.digest of prompts
+        self.digests = {fallback.mark: fallback.digest()}
+        self.mark = fallback.mark
+        self.snapshot = Snapshot(fallback)
+        # hash of prompt text -> its parsed text, "use <hash>" applies it again.
+        # Both caches keep the least recently used entry first,
+        # backend sends the same few prompts over and over
+        self.texts = {}
+        # (hash of prompt text, digest of the prompt it was applied to)
+        # -> (compiled prompt it made, its digest)
+        self.cache = {}
 
-    def set_prompt(self, prompt_str: str):
-        prompt = Prompt(prompt_str=prompt_str)
-        if prompt.mark in self.prompts:
-            self.prompts[prompt.mark].merge(prompt)
-        else:
-            self.prompts[prompt.mark] = prompt
+    # repeated prompt costs a few dict lookups, returns its hash
+    def set_prompt(self, prompt_str: str) -> str:
+        digest = content_hash(prompt_str)
+        if (prompt_dict := _touch(self.texts, digest)) is None:
+            prompt_dict = _put(self.texts, digest, json.loads(prompt_str))
+        self._apply(digest, prompt_dict)
+        return digest
+
+    # backend sends "use <hash>" for prompts sent before, False when it is not cached
+    def use_prompt(self, digest: str) -> bool:
+        if (prompt_dict := _touch(self.texts, digest)) is None:
+            return False
+        self._apply(digest, prompt_dict)
+        return True
+
+    # prompt of known mark updates the previous one, what it leaves out is kept,
+    # not taken from fallback. So the same text makes different prompts
+    # from different bases and is cached along with the base
+    def _apply(self, digest: str, prompt_dict: dict):
+        mark = prompt_dict.get("mark")
+        key = (digest, self.digests.get(mark))
+        if (entry := _touch(self.cache, key)) is None:
+            if (base := self.prompts.get(mark)) is not None:
+                # base stays cached as is
+                prompt = copy.deepcopy(base)
+                prompt.merge_dict(prompt_dict)
+            else:
+                prompt = Prompt(prompt_dict=prompt_dict)
+            # trackers only run the plans, prompt is not looked into per tick
+            prompt.compile()
+            entry = _put(self.cache, key, (prompt, prompt.digest()))
+        prompt, self.digests[prompt.mark] = entry
+        self.prompts[prompt.mark] = prompt
         self.mark = prompt.mark
+        self.snapshot = Snapshot(prompt)
 
     def get_prompt(self) -> Prompt:
         return self.prompts[self.mark]
+
+
+# value of key made the most recently used one, None when it is not cached
+def _touch(cache: dict, key):
+    if (value := cache.pop(key, None)) is not None:
+        cache[key] = value
+    return value
+
+
+# the least recently used entry makes room for the new one
+def _put(cache: dict, key, value):
+    if len(cache) >= PROMPT_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[key] = value
+    return value
+
+
+# python prompt.py [CORES]
+# per report cost of detailed cpu report of many cores: compiled plan against
+# getattr of every field on namedtuples and unit conversion per value
+def _bench(cores: int, ticks: int = 200):
+    import time
+    import random
+    from collections import namedtuple
+
+    columns = (
+        "user",
+        "nice",
+        "system",
+        "idle",
+        "iowait",
+        "irq",
+        "softirq",
+        "steal",
+        "guest",
+        "guest_nice",
+        "freq",
+    )
+    CpuTimes = namedtuple("CpuTimes", columns)
+    fields = ["user", "system", "idle", "iowait", "freq"]
+    units = {"freq": "ghz"}
+
+    def mhz_converter(amount: float, into: str) -> float:
+        amount = int(amount)
+        match into:
+            case "hz":
+                amount *= 1024**2
+            case "khz":
+                amount *= 1024
+            case "ghz":
+                amount = round(amount / 1024, 2)
+        return amount
+
+    def reference(times: list) -> list[dict]:
+        report = [
+            {
+                field: value
+                for field in fields
+                if field != "freq" and (value := getattr(each_times, field, None)) is not None
+            }
+            for each_times in times
+        ]
+        for each_report, each_times in zip(report, times):
+            each_report["freq"] = mhz_converter(each_times.freq, units["freq"])
+        return report
+
+    rows = [
+        [round(random.uniform(0, 100), 1) for _ in columns[:-1]]
+        + [float(random.randint(800, 4800))]
+        for _ in range(cores)
+    ]
+    times = [CpuTimes(*row) for row in rows]
+    plan = Plan(fields, units, (columns, {"freq": "mhz"}))
+
+    start = time.perf_counter()
+    for _ in range(ticks):
+        expected = reference(times)
+    elapsed_reference = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(ticks):
+        got = plan.extract_rows(rows)
+    elapsed_plan = time.perf_counter() - start
+    assert [{**row, "freq": 0} for row in got] == [{**row, "freq": 0} for row in expected]
+
+    print(
+        f"{cores} cores: compiled plan {elapsed_plan / ticks * 1e6:.0f} us, "
+        f"field lookups and converters {elapsed_reference / ticks * 1e6:.0f} us per report"
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    _bench(int(sys.argv[1]) if len(sys.argv) >= 2 else 256)
@@ -0,0 +1,56 @@
+import logging
+import importlib
+from importlib import metadata
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+# name -> "module:Class" of trackers shipped with sensor,
+# module is imported only when tracker is enabled in config.TRACKERS
+BUILTIN = {
+    "cpu": "sensor:CpuTracker",
+    "net": "sensor:NetTracker",
+    "mem": "sensor:MemTracker",
+    "dsk": "sensor:DskTracker",
+    "gpu": "gpu:GpuTracker",
+    "tmp": "hwmon:TmpTracker",
+    "fan": "hwmon:FanTracker",
+}
+# third party trackers are installed as entry points of this group
+ENTRY_POINTS = "rte.trackers"
+
+
+def _entry_points() -> dict:
+    try:
+        return {ep.name: ep for ep in metadata.entry_points(group=ENTRY_POINTS)}
+    except Exception as exc:
+        logger.warning(f"Can't list {ENTRY_POINTS} entry points: {exc}")
+        return {}
+
+
+def _load(target: str | metadata.EntryPoint) -> type:
+    if isinstance(target, metadata.EntryPoint):
+        return target.load()
+    module, cls = target.split(":")
+    return getattr(importlib.import_module(module), cls)
+
+
+# trackers enabled in config, the ones not available on this host are skipped
+def load_trackers(names: list[str] | None = None) -> list:
+    # plugins can't replace builtin trackers
+    registry = {**_entry_points(), **BUILTIN}
+    trackers = []
+    for name in config.TRACKERS if names is None else names:
+        if (target := registry.get(name)) is None:
+            logger.warning(f"Unknown tracker {name}")
+            continue
+        try:
+            trackers.append(_load(target)())
+        except (ImportError, OSError) as exc:
+            logger.warning(f"Tracker {name} is not available: {exc}")
+            continue
+        logger.info(f"Loaded tracker {name}")
+    return trackers
@@ -4,61 +4,244 @@ import json
 import logging
 import asyncio as aio
 from asyncio import CancelledError
+from functools import cache
 
 import config
 from connection import Connection, CONN_ERROR
 from prompt import PromptStore
-from sensor import all_trackers
+from scheduler import Scheduler
+from spool import Spool
+from registry import load_trackers
+from wire.codec import CODECS, CODEC_BIN, CMD_USE, CMD_RESUME, Schema, Batch, encode_report
+from wire.codec import content_hash
+from wire.delta import DeltaEncoder, compress
 
 
 logger = logging.getLogger(__name__)
 
 conn = Connection()
 prompt_lock = aio.Lock()
+# trackers register layouts of their rows, which prompts are compiled against
+trackers = load_trackers()
 prompt_store = PromptStore()
-trackers = all_trackers()
+scheduler = Scheduler(trackers)
+spool = Spool()
 
 
-async def send_specs():
-    specs = json.dumps(
+# trackers don't change while sensor runs, so specs frame is made once
+@cache
+def specs_frame() -> str:
+    return json.dumps(
         {
             "type": "specs",
+            "header": f"spec!{config.GROUP}!{config.MACHINE}",
             "group": config.GROUP,
             "machine": config.MACHINE,
-            **{str(tracker): tracker.specs() for tracker in trackers},
+            "codecs": CODECS,
+            **{str(tracker): tracker.specs for tracker in trackers},
         }
     )
-    await conn.sendall(specs)
+
+
+async def send_specs():
+    await conn.sendall(specs_frame())
     logger.info("Sent specs to backend")
 
 
+# backend which gave us a token gets a short resume frame instead of specs
+async def send_hello():
+    if conn.token is None:
+        await send_specs()
+        return
+    await conn.sendall(f"{CMD_RESUME}{conn.token}?{content_hash(specs_frame())}")
+    logger.info("Sent resume to backend")
+
+
+# trackers are sampled when due, report goes out only if something changed
 async def send_reports():
-    interval = 1
     while True:
+        async with prompt_lock:
+            snapshot = prompt_store.snapshot
+        # collected without the lock, so prompts are received while trackers are busy,
+        # tracker threads read the snapshot new prompts leave alone
+        now = time.monotonic()
+        await scheduler.run_due(snapshot, now)
         async with prompt_lock:
             prompt = prompt_store.get_prompt()
-            report = json.dumps(
-                {
-                    "type": "report",
-                    "group": config.GROUP,
-                    "machine": config.MACHINE,
-                    "time": round(time.time()),
-                    "mark": prompt_store.mark,
-                    **{str(tracker): tracker.report(prompt) for tracker in trackers},
-                }
-            )
-            await conn.sendall(report)
-            logger.info("Sent report to backend")
-            interval = prompt.interval
-        await aio.sleep(interval)
+            if (body := scheduler.report(now)) is None:
+                logger.debug("Samples didn't change, report skipped")
+            if conn.spooling:
+                if body is not None:
+                    spool.append(prompt_store.mark, time.time(), body)
+            elif body is not None or conn.batch is not None:
+                try:
+                    if body is not None:
+                        await send_report(prompt, body)
+                    # batch goes out when its window is over even without new samples
+                    await flush_batch(prompt.batch)
+                except CONN_ERROR:
+                    logger.warning("Report didn't reach backend, spooling until it is back")
+                    spool_unsent(body)
+                    conn.spooling = True
+                    conn.close()
+        await scheduler.sleep()
+
+
+def spool_unsent(body: dict | None):
+    samples = []
+    if conn.batch is not None:
+        samples = list(zip(conn.batch.times, conn.batch.reports))
+        conn.batch = None
+    if body is not None and not any(report is body for _, report in samples):
+        samples.append((time.time(), body))
+    for sample_time, report in samples:
+        spool.append(prompt_store.mark, sample_time, report)
+
+
+# categories left out since their trackers hang are listed by every codec,
+# so backend tells them from categories nobody asked for
+async def send_report(prompt, body: dict):
+    stale = sorted(scheduler.stale)
+    if prompt.batch and conn.codec == CODEC_BIN:
+        await send_batched_report(body, stale)
+        return
+    if prompt.delta:
+        await send_delta_report(prompt.delta, body, stale)
+    elif conn.codec == CODEC_BIN:
+        await send_binary_report(body, stale)
+    else:
+        mark = prompt_store.mark
+        header = f"report!{config.GROUP}!{config.MACHINE}!{mark}!{round(time.time())}"
+        report = {"header": header, **body}
+        if stale:
+            report["stale"] = stale
+        await conn.sendall(json.dumps(report))
+    logger.info("Sent report to backend")
+
+
+# reports spooled while backend was not reachable go first, oldest first
+# and many per frame. Live reports keep going to spool until it is drained,
+# so backend gets all of them in order
+async def replay_spool():
+    sent = 0
+    while True:
+        records, cursor = spool.peek(config.SPOOL_BATCH_SIZE)
+        if not records:
+            break
+        header = f"late!{config.GROUP}!{config.MACHINE}!late!{round(time.time())}"
+        frame = b'{"type": "late", "header": "%s", "reports": [%s]}' % (
+            header.encode(encoding="utf-8"),
+            b",".join(records),
+        )
+        await conn.sendall(compress(frame, "zlib"))
+        spool.release(cursor)
+        sent += len(records)
+    conn.spooling = False
+    if sent:
+        logger.info(f"Sent {sent} spooled reports to backend")
+
+
+async def resume():
+    await send_hello()
+    # spooled reports are sent with codec agreed in ack
+    await conn.acked.wait()
+    await replay_spool()
+
+
+# schema is sent only when the layout of report changes,
+# e.g. after new prompt or when nic appears
+async def send_schema(schema: Schema):
+    if schema.id != conn.schema_id:
+        await conn.sendall(json.dumps(schema.to_dict()))
+        conn.schema_id = schema.id
+        logger.info(f"Sent report schema {schema.id} to backend")
+
+
+async def send_binary_report(body: dict, stale: list):
+    schema = Schema.from_report(prompt_store.mark, body, stale)
+    await send_schema(schema)
+    await conn.sendall(encode_report(schema, time.time(), body))
+
+
+# at high sampling rates samples are collected into a batch,
+# which goes to backend as one frame of columns
+async def send_batched_report(body: dict, stale: list):
+    schema = Schema.from_report(prompt_store.mark, body, stale)
+    if conn.batch is not None and conn.batch.schema is not schema:
+        await flush_batch(None)
+    await send_schema(schema)
+    if conn.batch is None:
+        conn.batch = Batch(schema)
+        conn.batch_started = time.monotonic()
+    conn.batch.add(time.time(), body)
+
+
+# batch is sent once it has "samples" samples or its "window" seconds are over,
+# right away when prompt doesn't ask for batches anymore
+async def flush_batch(params: dict | None):
+    if (batch := conn.batch) is None:
+        return
+    if (
+        params
+        and len(batch) < params.get("samples", 1)
+        and time.monotonic() - conn.batch_started < params.get("window", 0)
+    ):
+        return
+    await conn.sendall(batch.encode())
+    conn.batch = None
+    logger.info(f"Sent batch of {len(batch)} samples to backend")
+
+
+# keyframe every few ticks, in between only fields that changed,
+# mostly idle machine sends almost empty frames
+async def send_delta_report(params: dict, body: dict, stale: list):
+    if conn.delta is None or conn.delta.params != params:
+        conn.delta = DeltaEncoder(params)
+    mark = prompt_store.mark
+    header = f"delta!{config.GROUP}!{config.MACHINE}!{mark}!{round(time.time())}"
+    await conn.sendall(conn.delta.frame(header, mark, body, stale))
 
 
 async def recv_prompts():
     while True:
-        prompt_str = await conn.recvall()
-        logger.debug(f"Received prompt: {prompt_str}")
-        async with prompt_lock:
-            prompt_store.set_prompt(prompt_str)
+        msg = await conn.recvall()
+        match msg[:4]:
+            case "ack?":
+                _, conn.codec, *token = msg.split("?")
+                conn.token = token[0] if token else None
+                conn.acked.set()
+                logger.info(f"Backend acknowledged specs, using codec {conn.codec}")
+            case "spec":
+                # backend restarted without our token or specs changed
+                logger.info("Backend asked for specs")
+                conn.token = None
+                await send_specs()
+            case "use ":
+                digest = msg[len(CMD_USE) :].strip()
+                async with prompt_lock:
+                    found = prompt_store.use_prompt(digest)
+                    if found:
+                        scheduler.reset()
+                if not found:
+                    logger.warning(f"Backend asked for unknown prompt {digest}")
+                    await send_prompt_ack(digest, running=False)
+                    continue
+                logger.debug(f"Switched to cached prompt {digest}")
+                await send_prompt_ack(digest)
+            case _:
+                logger.debug(f"Received prompt: {msg}")
+                async with prompt_lock:
+                    digest = prompt_store.set_prompt(msg)
+                    scheduler.reset()
+                await send_prompt_ack(digest)
+
+
+# backend tracks which prompt every sensor runs, prompt it asked for
+# by hash and this sensor doesn't have is reported as missing
+async def send_prompt_ack(digest: str, running: bool = True):
+    header = f"ack!{config.GROUP}!{config.MACHINE}!{prompt_store.mark}!{round(time.time())}"
+    key = "prompt" if running else "missing"
+    await conn.sendall(json.dumps({"header": header, "type": "ack", key: digest}))
 
 
 async def aio_task(func):
@@ -83,17 +266,22 @@ async def main():
 
     logger.info(f"Current machine is <{config.MACHINE}> in group <{config.GROUP}>")
 
-    await conn.establish()
+    # sampling goes on while backend is not reachable, reports are spooled meanwhile
+    reports = aio.create_task(aio_task(send_reports))
 
     while True:
+        await conn.establish()
+        # backend of new connection gets full report right away
+        scheduler.reset()
         try:
-            tasks = aio.gather(aio_task(send_reports), aio_task(recv_prompts))
-            logger.debug("send_reports and recv_prompts scheduled")
+            tasks = aio.gather(aio_task(resume), aio_task(recv_prompts))
+            logger.debug("resume and recv_prompts scheduled")
             await tasks
         except CONN_ERROR:
             logger.warning("Connection lost, trying to reconnect")
             tasks.cancel()
-            await conn.establish()
+            conn.spooling = True
+            conn.close()
 
 
 if __name__ == "__main__":
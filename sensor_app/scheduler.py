@@ -0,0 +1,159 @@
+import time
+import heapq
+import logging
+import asyncio as aio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from prompt import Snapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Runs every tracker at the interval of its category, so cheap cpu samples
+    don't drag expensive disk ones along. Samples are merged into one report,
+    which is sent only when some sample changed or nothing was sent for too long.
+    Category whose samples stop changing is sampled less and less often,
+    up to UNCHANGED_BACKOFF_MAX times its interval, and back at its pace once they change.
+    Trackers run concurrently in threads, so a hung mount stalls neither
+    the event loop nor other categories: the late category is marked stale
+    """
+
+    __slots__ = (
+        "trackers",
+        "heap",
+        "latest",
+        "backoff",
+        "stale",
+        "running",
+        "executor",
+        "changed",
+        "reported",
+        "wakeup",
+    )
+
+    def __init__(self, trackers):
+        # cat -> tracker
+        self.trackers = {str(tracker): tracker for tracker in trackers}
+        # (monotonic time sample is due, cat), the earliest on top
+        self.heap = []
+        # cat -> the last sample
+        self.latest = {}
+        # cat -> times its interval is stretched since the samples didn't change
+        self.backoff = {}
+        # categories whose trackers missed the deadline, left out of reports
+        self.stale = set()
+        # cat -> future of the sample being collected
+        self.running = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.TRACKER_WORKERS, thread_name_prefix="tracker"
+        )
+        # some sample changed since the last report
+        self.changed = False
+        self.reported = 0.0
+        # set when trackers have to be sampled before their time
+        self.wakeup = aio.Event()
+        self.reset()
+
+    # new prompt: every category is sampled right away with new fields and intervals
+    def reset(self):
+        self.heap = [(0.0, cat) for cat in self.trackers]
+        self.latest = {}
+        self.backoff = {}
+        self.wakeup.set()
+
+    async def run_due(self, prompt: Snapshot, now: float):
+        heap = self.heap
+        collect = []
+        # host without any tracker loaded has nothing to sample
+        while heap and heap[0][0] <= now:
+            due, cat = heap[0]
+            interval = self._interval(cat, prompt)
+            # stalled sensor doesn't run the missed samples in a burst
+            due = due + interval if due + interval > now else now + interval
+            heapq.heapreplace(heap, (due, cat))
+            if (running := self.running.get(cat)) is not None and not running.done():
+                # hung tracker is not given another thread
+                logger.debug(f"Tracker {cat} is still busy with the previous sample")
+                continue
+            collect.append(self._collect(cat, prompt))
+        if collect:
+            await aio.gather(*collect)
+
+    # idle category waits longer, but never longer than report is held back
+    def _interval(self, cat: str, prompt: Snapshot) -> float:
+        interval = prompt.interval_of(cat, self.trackers[cat].COST)
+        if (backoff := self.backoff.get(cat, 1)) == 1:
+            return interval
+        return min(interval * backoff, max(interval, config.REPORT_UNCHANGED_AFTER))
+
+    async def _collect(self, cat: str, prompt: Snapshot):
+        tracker = self.trackers[cat]
+        loop = aio.get_running_loop()
+        future = self.running[cat] = loop.run_in_executor(self.executor, tracker.track, prompt)
+        try:
+            # shielded, so the sample still lands when it finally comes
+            sample = await aio.wait_for(
+                aio.shield(future), tracker.TIMEOUT or config.TRACKER_TIMEOUT
+            )
+        except aio.TimeoutError:
+            logger.warning(f"Tracker {cat} missed the deadline, its sample is stale")
+            self._mark_stale(cat)
+            future.add_done_callback(partial(self._late, cat))
+            return
+        except Exception:
+            logger.exception(f"Tracker {cat} failed")
+            self._mark_stale(cat)
+            return
+        self._store(cat, sample)
+
+    def _late(self, cat: str, future: aio.Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if self.running.get(cat) is future:
+            self._store(cat, future.result())
+
+    def _mark_stale(self, cat: str):
+        if cat not in self.stale:
+            self.stale.add(cat)
+            self.changed = True
+
+    def _store(self, cat: str, sample):
+        if cat in self.stale:
+            self.stale.discard(cat)
+            self.changed = True
+        if sample != self.latest.get(cat):
+            self.latest[cat] = sample
+            self.changed = True
+            self.backoff.pop(cat, None)
+        else:
+            self.backoff[cat] = min(self.backoff.get(cat, 1) * 2, config.UNCHANGED_BACKOFF_MAX)
+
+    # merged samples or None when nothing changed since the last report
+    def report(self, now: float) -> dict | None:
+        if not self.changed and now - self.reported < config.REPORT_UNCHANGED_AFTER:
+            return None
+        self.changed = False
+        self.reported = now
+        # ordered as trackers, so report layout doesn't depend on sampling order
+        return {
+            cat: self.latest[cat]
+            for cat in self.trackers
+            if cat in self.latest and cat not in self.stale
+        }
+
+    async def sleep(self):
+        if self.heap:
+            delay = max(self.heap[0][0] - time.monotonic(), 0)
+        else:
+            # only empty reports are due, they keep backend seeing the sensor
+            delay = config.REPORT_UNCHANGED_AFTER
+        try:
+            await aio.wait_for(self.wakeup.wait(), delay)
+        except aio.TimeoutError:
+            pass
+        self.wakeup.clear()
@@ -1,8 +1,15 @@
+import os
+import re
+import time
 import psutil as ps
 import json
+from functools import cache, lru_cache
+from itertools import chain, repeat
 
+import config
+import procfs
 from config import SENSOR_CATEGORIES
-from prompt import Prompt, PromptStore
+from prompt import Prompt, PromptStore, Snapshot, LAYOUTS
 
 import logging
 
@@ -10,7 +17,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-SPECS_SCHEME = json.load(open("scheme/specs.json", "r"))
+# units of specs, scheme of the deployment is read when cpu specs are first made
+@cache
+def specs_scheme() -> dict:
+    with open("scheme/specs.json", "r") as file:
+        return json.load(file)
 
 
 def byte_converter(amount: int, into: str) -> float:
@@ -38,26 +49,140 @@ def mhz_converter(amount: float, into: str) -> float:
     return amount
 
 
+# cost classes of trackers: category without its own interval
+# is sampled every COST prompt intervals
+COST_CHEAP = 1
+COST_MODERATE = 2
+COST_EXPENSIVE = 5
+
+
 class Tracker:
     __slots__ = "specs"
+    # seconds given to one sample, config.TRACKER_TIMEOUT when None
+    TIMEOUT = None
+    COST = COST_CHEAP
+    # (columns of rows tracker reads, {field: unit kind}) prompts are compiled against
+    LAYOUT = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "CATEGORY" in cls.__dict__:
+            LAYOUTS[cls.CATEGORY] = cls.LAYOUT
 
     def __init__(self):
         self.specs = self.get_specs()
 
-    def track(self, prompt: Prompt):
+    def __str__(self) -> str:
+        return self.__class__.CATEGORY
+
+    def track(self, prompt: Prompt | Snapshot):
         cat_prompt = getattr(prompt, self.__class__.CATEGORY)
+        if not cat_prompt.fields:
+            return {}
+        # snapshots of PromptStore come compiled, prompts made elsewhere on first use
+        plan = cat_prompt.plan or cat_prompt.compile()
         if not cat_prompt.detailed:
-            report = self.get_report(cat_prompt.fields, cat_prompt.units)
+            report = self.get_report(plan)
         else:
-            report = self.get_report_detailed(cat_prompt.fields, cat_prompt.units)
+            report = self.get_report_detailed(plan)
         return report
 
 
+class PsCounters:
+    """
+    psutil counterpart of procfs.ProcCounters for hosts without procfs
+    """
+
+    __slots__ = ("func", "fields", "names", "prev", "cur", "time", "elapsed")
+
+    def __init__(self, func, fields: tuple[str, ...]):
+        # returns {name: namedtuple of counters}
+        self.func = func
+        # psutil fields in the column order of the procfs reader
+        self.fields = fields
+        self.names = ()
+        self.prev = self.cur = {}
+        self.time = None
+        self.elapsed = 0.0
+        self.sample()
+
+    def sample(self) -> float:
+        fields = self.fields
+        counters = {
+            name: [getattr(values, field, 0) for field in fields]
+            for name, values in self.func().items()
+        }
+        now = time.monotonic()
+        names = tuple(counters)
+        if names != self.names:
+            self.names = names
+            self.cur = counters
+            self.time = None
+        self.prev, self.cur = self.cur, counters
+        self.elapsed = now - self.time if self.time is not None else 0.0
+        self.time = now
+        return self.elapsed
+
+    def rows(self, names=None) -> dict[str, list[float]]:
+        if not self.elapsed:
+            return {}
+        return {
+            name: [now - then for now, then in zip(values, self.prev[name])]
+            for name, values in self.cur.items()
+            if names is None or name in names
+        }
+
+    def total(self, names=None) -> list[float] | None:
+        if not self.elapsed:
+            return None
+        rows = self.rows(names).values()
+        return list(map(sum, zip(*rows))) if rows else [0.0] * len(self.fields)
+
+
+def open_counters(reader_cls, func):
+    if config.RAW_PROCFS and (reader := procfs.open_reader(reader_cls)) is not None:
+        return reader
+    return PsCounters(func, tuple(reader_cls.COLUMNS))
+
+
+# what partition names add to the name of their disk: sda1, nvme0n1p1, mmcblk0p2
+PARTITION_SUFFIX = re.compile(r"p?\d+")
+
+
+# psutil counters list partitions along with their disks, so summing all of them
+# counts every byte twice. Block devices of sysfs are whole disks, where there is
+# no sysfs partition is the name of another device with a number appended
+@lru_cache(maxsize=1)
+def whole_disks(names: tuple[str, ...]) -> set[str]:
+    block = f"{config.SYSFS_ROOT}/block"
+    if os.path.isdir(block):
+        return {name for name in names if os.path.exists(f"{block}/{name.replace('/', '!')}")}
+    return {
+        name
+        for name in names
+        if not any(
+            name != disk
+            and name.startswith(disk)
+            and PARTITION_SUFFIX.fullmatch(name, len(disk))
+            for disk in names
+        )
+    }
+
+
 class CpuTracker(Tracker):
     CATEGORY = "cpu"
+    # percents of procfs.ProcStat rows, current frequency is appended when asked for
+    LAYOUT = ((*procfs.CPU_FIELDS, "freq"), {"freq": "mhz"})
+
+    __slots__ = ("proc",)
+
+    def __init__(self):
+        super().__init__()
+        # cpu times straight from /proc/stat, None to ask psutil
+        self.proc = procfs.open_reader(procfs.ProcStat) if config.RAW_PROCFS else None
 
     def get_specs(self) -> dict:
-        units = SPECS_SCHEME["cpu"]["units"]
+        units = specs_scheme()["cpu"]["units"]
 
         specs = {}
         specs["cores_phys"] = ps.cpu_count(logical=False)
@@ -77,57 +202,236 @@ class CpuTracker(Tracker):
 
         return specs
 
-    def get_report(self, fields: list[str], units: dict) -> dict:
-        report = {}
+    def _rows(self, percpu: bool) -> list[list[float]]:
+        if self.proc is not None:
+            return self.proc.rows(percpu)
+        cpu_times = ps.cpu_times_percent(percpu=percpu)
+        return [
+            [getattr(times, field, 0.0) for field in procfs.CPU_FIELDS]
+            for times in (cpu_times if percpu else [cpu_times])
+        ]
+
+    def get_report(self, plan) -> dict:
+        row = self._rows(percpu=False)[0]
+        if "freq" in plan.fields:
+            row.append(ps.cpu_freq(percpu=False).current)
+        return plan.extract(row)
+
+    def get_report_detailed(self, plan) -> list[dict]:
+        rows = self._rows(percpu=True)
+        if "freq" in plan.fields:
+            # cores psutil has no frequency for get zero
+            freqs = (freq.current for freq in ps.cpu_freq(percpu=True))
+            for row, freq in zip(rows, chain(freqs, repeat(0.0))):
+                row.append(freq)
+        return plan.extract_rows(rows)
+
 
-        cpu_times = ps.cpu_times_percent(percpu=False)
-        report = {
-            field: value
-            for field in fields
-            if (value := getattr(cpu_times, field, None)) is not None
+class NetTracker(Tracker):
+    CATEGORY = "net"
+    # columns of procfs.ProcNetDev as report fields
+    LAYOUT = (
+        ("recv", "packets_recv", "errin", "dropin", "sent", "packets_sent", "errout", "dropout"),
+        {"recv": "bytes", "sent": "bytes"},
+    )
+
+    __slots__ = ("io",)
+
+    def __init__(self):
+        super().__init__()
+        self.io = open_counters(procfs.ProcNetDev, lambda: ps.net_io_counters(pernic=True))
+
+    def get_specs(self) -> dict:
+        return {"nics": list(ps.net_io_counters(pernic=True).keys())}
+
+    # per second rates of counters, bytes are converted into units
+    def get_report(self, plan) -> dict:
+        self.io.sample()
+        if (total := self.io.total()) is None:
+            return {}
+        return plan.extract(total, 1 / self.io.elapsed)
+
+    def get_report_detailed(self, plan) -> dict:
+        self.io.sample()
+        rows = self.io.rows()
+        if not rows:
+            return {}
+        return dict(zip(rows, plan.extract_rows(rows.values(), 1 / self.io.elapsed)))
+
+
+class MemTracker(Tracker):
+    CATEGORY = "mem"
+    # values come as a dict, plan only brings multipliers of units
+    LAYOUT = ((), dict.fromkeys(("used", "buffers", "cached", "shared", "swap"), "bytes"))
+
+    __slots__ = ("proc",)
+
+    def __init__(self):
+        super().__init__()
+        self.proc = procfs.open_reader(procfs.ProcMemInfo) if config.RAW_PROCFS else None
+
+    def get_specs(self) -> dict:
+        # the same units as standard prompt, so backend can turn used into percents
+        return {
+            "mem_total": byte_converter(ps.virtual_memory().total, "kb"),
+            "swp_total": byte_converter(ps.swap_memory().total, "kb"),
         }
 
-        if "freq" in fields:
-            freq = ps.cpu_freq(percpu=False)
-            report["freq"] = mhz_converter(freq.current, units["freq"])
+    def _memory(self) -> dict:
+        if self.proc is not None:
+            return self.proc.memory()
+        mem = ps.virtual_memory()
+        swp = ps.swap_memory()
+        return {
+            **mem._asdict(),
+            "swap_total": swp.total,
+            "swap_used": swp.used,
+            "swap_percent": swp.percent,
+        }
 
+    def get_report(self, plan) -> dict:
+        mem = self._memory()
+        report = {}
+        for field in plan.fields:
+            if field == "swap":
+                amount, percent = mem["swap_used"], mem["swap_percent"]
+            elif field == "used":
+                amount, percent = mem["used"], mem["percent"]
+            elif field in mem:
+                amount = mem[field]
+                percent = round(amount * 100 / mem["total"], 1)
+            else:
+                continue
+            if plan.units.get(field) == "%":
+                report[field] = percent
+            else:
+                report[field] = round(amount * plan.scale_of(field), 2)
         return report
 
-    def get_report_detailed(self, fields: list[str], units: dict) -> list[dict]:
-        report = []
-
-        cpu_times_percpu = ps.cpu_times_percent(percpu=True)
-        report = [
-            {
-                field: value
-                for field in fields
-                if (value := getattr(cpu_times, field, None)) is not None
-            }
-            for cpu_times in cpu_times_percpu
-        ]
+    # memory has no parts
+    get_report_detailed = get_report
+
+
+class DskTracker(Tracker):
+    CATEGORY = "dsk"
+    COST = COST_MODERATE
+    # columns of procfs.ProcDiskStats as report fields, used comes from statvfs
+    LAYOUT = (
+        (
+            "read_count",
+            "read_merged_count",
+            "read",
+            "read_time",
+            "write_count",
+            "write_merged_count",
+            "write",
+            "write_time",
+        ),
+        {"read": "bytes", "write": "bytes", "used": "bytes"},
+    )
+
+    __slots__ = ("io", "disks", "mounts", "partitions", "listed", "usage", "measured")
 
-        if "freq" in fields:
-            freq_percpu = ps.cpu_freq(percpu=True)
-            for each_report, each_freq in zip(report, freq_percpu):
-                each_report["freq"] = mhz_converter(each_freq.current, units["freq"])
+    def __init__(self):
+        # mount table is needed for specs already
+        self.mounts = procfs.open_reader(procfs.MountInfo) if config.RAW_PROCFS else None
+        self.partitions = []
+        self.listed = None
+        # name -> used bytes, cached for config.DSK_USAGE_TTL
+        self.usage = {}
+        self.measured = None
+        super().__init__()
+        self.io = open_counters(procfs.ProcDiskStats, lambda: ps.disk_io_counters(perdisk=True))
+        # whole disks summed into the standard report, None when psutil counters
+        # are read and disks are told from partitions by name, see whole_disks
+        self.disks = getattr(self.io, "disks", None)
+
+    # [(name, mountpoint)] of filesystems on block devices, one per device,
+    # mount table is read again only when it changes
+    def _partitions(self) -> list[tuple[str, str]]:
+        now = time.monotonic()
+        if self.mounts is not None:
+            if self.listed is not None and not self.mounts.changed():
+                return self.partitions
+            mounts = [(device, mountpoint) for device, mountpoint, _ in self.mounts.mounts]
+        elif self.listed is not None and now - self.listed < config.DSK_MOUNTS_TTL:
+            return self.partitions
+        else:
+            mounts = {}
+            for part in ps.disk_partitions(all=False):
+                mounts.setdefault(part.device, part.mountpoint)
+            mounts = list(mounts.items())
+        self.partitions = [(os.path.basename(device), mountpoint) for device, mountpoint in mounts]
+        self.listed = now
+        # usage of new mounts is measured right away
+        self.measured = None
+        logger.info(f"Tracking usage of {self.partitions}")
+        return self.partitions
+
+    # used bytes of every partition, statvfs is called once per TTL
+    def _usage(self) -> dict:
+        partitions = self._partitions()
+        now = time.monotonic()
+        if self.measured is not None and now - self.measured < config.DSK_USAGE_TTL:
+            return self.usage
+        usage = {}
+        for name, mountpoint in partitions:
+            try:
+                st = os.statvfs(mountpoint)
+            except OSError as exc:
+                logger.warning(f"Can't get usage of {mountpoint}: {exc}")
+                continue
+            # the same as psutil: blocks reserved for root are not counted as used
+            usage[name] = (st.f_blocks - st.f_bfree) * st.f_frsize
+        self.usage = usage
+        self.measured = now
+        return usage
+
+    def get_specs(self) -> list[dict]:
+        specs = []
+        for name, mountpoint in self._partitions():
+            try:
+                st = os.statvfs(mountpoint)
+            except OSError:
+                continue
+            total = byte_converter(st.f_blocks * st.f_frsize, "kb")
+            specs.append({"name": name, "mountpoint": mountpoint, "total": total})
+        return specs
 
+    def get_report(self, plan) -> dict:
+        self.io.sample()
+        disks = self.disks if self.disks is not None else whole_disks(self.io.names)
+        total = self.io.total(disks)
+        report = plan.extract(total, 1 / self.io.elapsed) if total is not None else {}
+        if "used" in plan.fields:
+            report["used"] = round(sum(self._usage().values()) * plan.scale_of("used"), 2)
         return report
 
-
-def all_trackers():
-    return [CpuTracker()]
+    def get_report_detailed(self, plan) -> dict:
+        self.io.sample()
+        names = [name for name, _ in self._partitions()]
+        rows = self.io.rows(names)
+        factor = 1 / self.io.elapsed if rows else 1.0
+        report = {name: plan.extract(rows[name], factor) if name in rows else {} for name in names}
+        if "used" in plan.fields:
+            scale = plan.scale_of("used")
+            for name, used in self._usage().items():
+                if name in report:
+                    report[name]["used"] = round(used * scale, 2)
+        return report
 
 
-from time import sleep
+if __name__ == "__main__":
+    from time import sleep
 
-cpu = CpuTracker()
+    cpu = CpuTracker()
 
-print(cpu.specs)
+    print(cpu.specs)
 
-prompt_store = PromptStore()
-prompt = prompt_store.get_prompt()
+    prompt_store = PromptStore()
+    prompt = prompt_store.get_prompt()
 
-while True:
-    report = cpu.track(prompt)
-    print(report)
-    sleep(2)
+    while True:
+        report = cpu.track(prompt)
+        print(report)
+        sleep(2)
@@ -0,0 +1,157 @@
+import os
+import mmap
+import json
+import struct
+import logging
+from pathlib import Path
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+
+# every record is its length followed by json of the report,
+# zero length marks the end of records in the segment
+RECORD = struct.Struct("<I")
+# segment starts with magic and offset of the first record not sent yet,
+# so records sent before sensor restarted are not sent again
+HEADER = struct.Struct("<4sQ")
+MAGIC = b"RTES"
+
+
+class Segment:
+    """
+    Append-only file of fixed size mapped into memory. The length of record
+    is written after the record itself, so torn write reads as the end of segment.
+    Segments of the previous version have no header, they are replayed whole
+    """
+
+    __slots__ = ("path", "file", "mm", "start", "end", "sent")
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.file = open(path, "a+b")
+        fresh = not os.fstat(self.file.fileno()).st_size
+        if os.fstat(self.file.fileno()).st_size < size:
+            # sparse and zeroed until records are written
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        if fresh:
+            HEADER.pack_into(self.mm, 0, MAGIC, HEADER.size)
+        magic, sent = HEADER.unpack_from(self.mm, 0)
+        # offset of the first record
+        self.start = HEADER.size if magic == MAGIC else 0
+        # records before this offset reached backend
+        self.sent = sent if magic == MAGIC else 0
+        # segment left by the previous run is appended to
+        self.end = self.start
+        while (record := self.read(self.end)) is not None:
+            self.end += RECORD.size + len(record)
+
+    def read(self, pos: int) -> bytes | None:
+        if pos + RECORD.size > len(self.mm):
+            return None
+        size = RECORD.unpack_from(self.mm, pos)[0]
+        if not size or pos + RECORD.size + size > len(self.mm):
+            return None
+        return self.mm[pos + RECORD.size : pos + RECORD.size + size]
+
+    def append(self, data: bytes) -> bool:
+        pos = self.end
+        if pos + RECORD.size + len(data) > len(self.mm):
+            return False
+        self.mm[pos + RECORD.size : pos + RECORD.size + len(data)] = data
+        RECORD.pack_into(self.mm, pos, len(data))
+        self.end = pos + RECORD.size + len(data)
+        return True
+
+    # records up to pos reached backend
+    def mark_sent(self, pos: int):
+        self.sent = pos
+        if self.start:
+            HEADER.pack_into(self.mm, 0, MAGIC, pos)
+
+    def close(self, remove: bool = False):
+        self.mm.close()
+        self.file.close()
+        if remove:
+            self.path.unlink(missing_ok=True)
+
+
+class Spool:
+    """
+    Reports made while backend is not reachable, in segment files of
+    config.SPOOL_SEGMENT_SIZE. Spool never takes more than config.SPOOL_SIZE,
+    the oldest segment is dropped to make room. Segments left by the previous
+    run are replayed as well
+    """
+
+    __slots__ = ("path", "segments", "seq", "dropped")
+
+    def __init__(self, path: str | None = None):
+        self.path = Path(path or config.SPOOL_DIR)
+        self.path.mkdir(parents=True, exist_ok=True)
+        # oldest first, file names are zero padded sequence numbers
+        self.segments = [
+            Segment(path, config.SPOOL_SEGMENT_SIZE) for path in sorted(self.path.glob("*.seg"))
+        ]
+        self.seq = int(self.segments[-1].path.stem) + 1 if self.segments else 0
+        # segments dropped since start
+        self.dropped = 0
+        if self.segments:
+            logger.info(f"Found {len(self.segments)} spool segments of the previous run")
+
+    def __bool__(self) -> bool:
+        return any(segment.end > segment.sent for segment in self.segments)
+
+    def _open(self) -> Segment:
+        segment = Segment(self.path / f"{self.seq:08d}.seg", config.SPOOL_SEGMENT_SIZE)
+        self.seq += 1
+        self.segments.append(segment)
+        while len(self.segments) * config.SPOOL_SEGMENT_SIZE > config.SPOOL_SIZE:
+            self.segments.pop(0).close(remove=True)
+            self.dropped += 1
+            logger.warning("Spool is full, dropped the oldest segment of reports")
+        return segment
+
+    def append(self, mark: str, time: float, body: dict):
+        data = json.dumps({"mark": mark, "time": round(time), "body": body}).encode(
+            encoding="utf-8"
+        )
+        if self.segments and self.segments[-1].append(data):
+            return
+        if not self._open().append(data):
+            logger.warning(f"Report of {len(data)} bytes doesn't fit into spool segment")
+
+    # the oldest records not sent yet, up to limit bytes but at least one,
+    # and the cursor to pass to release once they are sent
+    def peek(self, limit: int) -> tuple[list[bytes], tuple | None]:
+        records = []
+        # empty segment may be left by the previous run
+        while len(self.segments) > 1 and self.segments[0].sent >= self.segments[0].end:
+            self.segments.pop(0).close(remove=True)
+        if not self.segments:
+            return records, None
+        segment = self.segments[0]
+        pos = start = segment.sent
+        while (record := segment.read(pos)) is not None:
+            if records and pos + len(record) - start > limit:
+                break
+            records.append(record)
+            pos += RECORD.size + len(record)
+        return records, (segment, pos)
+
+    # peeked records reached backend, segment sent to the end is removed
+    def release(self, cursor: tuple):
+        segment, pos = cursor
+        if not self.segments or self.segments[0] is not segment:
+            # dropped to make room while records were being sent
+            return
+        segment.mark_sent(pos)
+        if pos >= segment.end:
+            self.segments.pop(0).close(remove=True)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
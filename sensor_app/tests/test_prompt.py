@@ -0,0 +1,132 @@
+import json
+import importlib.util
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from config import PROMPT_CACHE_SIZE
+from prompt import PromptStore
+
+
+BACKEND_DIR = Path(__file__).parents[2] / "backend_app"
+
+
+def load_builder():
+    # backend module is loaded by path, its package would clash with sensor modules
+    spec = importlib.util.spec_from_file_location(
+        "backend_prompts", BACKEND_DIR / "streaming" / "prompts.py"
+    )
+    prompts = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(prompts)
+    query_std = json.loads((BACKEND_DIR / "json" / "query.standard.json").read_text())
+    query_ext = json.loads((BACKEND_DIR / "json" / "query.extended.json").read_text())
+    return prompts, prompts.PromptBuilder(query_std, query_ext, 60)
+
+
+def topic(path: tuple, fields=None, interval=None):
+    cat = path[2] if len(path) == 3 and path[2] != "*" else None
+    return SimpleNamespace(path=path, cat=cat, fields=fields, interval=interval)
+
+
+def test_diff_keeps_what_it_leaves_out():
+    prompts, builder = load_builder()
+    store = PromptStore()
+    full = builder.build([], [topic(("b", "l"))])
+    store.set_prompt(json.dumps(full))
+
+    faster = builder.build([], [topic(("b", "l"), interval=0.5)])
+    diff = prompts.prompt_diff(full, faster)
+    assert set(diff) == {"mark", "interval"}
+    store.set_prompt(json.dumps(diff))
+
+    prompt = store.get_prompt()
+    assert prompt.mark == "ext"
+    assert prompt.interval == 0.5
+    for cat in prompts.CATEGORIES:
+        assert getattr(prompt, cat).fields == full[cat]["fields"]
+        assert getattr(prompt, cat).detailed == 1
+
+
+def test_diff_turns_off_categories():
+    prompts, builder = load_builder()
+    store = PromptStore()
+    full = builder.build([], [topic(("b", "l"))])
+    store.set_prompt(json.dumps(full))
+
+    narrowed = builder.build([], [topic(("b", "l", "cpu"), fields=frozenset({"user"}))])
+    store.set_prompt(json.dumps(prompts.prompt_diff(full, narrowed)))
+
+    prompt = store.get_prompt()
+    assert prompt.cpu.fields == ["user"]
+    assert prompt.cpu.detailed == 1
+    assert prompt.net.fields == []
+    assert prompt.dsk.fields == []
+
+
+def test_fallback_reports_are_taken_by_backend():
+    store = PromptStore()
+    # backend inserts reports of std, flb and ext marks only
+    assert store.mark == store.get_prompt().mark == "flb"
+    assert "flb" in store.digests
+
+
+def test_unknown_mark_starts_from_fallback():
+    _, builder = load_builder()
+    store = PromptStore()
+    store.set_prompt(json.dumps(builder.build([topic(("b",))], [])))
+
+    prompt = store.get_prompt()
+    assert prompt.mark == "std"
+    assert prompt.cpu.detailed == 0
+    # categories backend doesn't query are sampled as fallback says
+    assert prompt.gpu.fields == ["load", "memory"]
+
+
+def test_trackers_keep_their_snapshot_while_prompts_arrive():
+    _, builder = load_builder()
+    store = PromptStore()
+    store.set_prompt(json.dumps(builder.build([], [topic(("b", "l"))])))
+    snapshot = store.snapshot
+    cpu = snapshot.cpu
+
+    store.set_prompt(json.dumps(builder.build([topic(("b",))], [])))
+    assert store.snapshot is not snapshot
+    assert store.snapshot.cpu.detailed == 0
+    assert snapshot.mark == "ext"
+    assert snapshot.cpu is cpu and cpu.detailed == 1
+    with pytest.raises(AttributeError):
+        snapshot.interval = 1
+
+
+def test_repeated_diff_applies_to_the_prompt_sensor_runs():
+    prompts, builder = load_builder()
+    store = PromptStore()
+    full = builder.build([], [topic(("b", "l"))])
+    store.set_prompt(json.dumps(full))
+    faster = builder.build([], [topic(("b", "l"), interval=0.5)])
+    diff = json.dumps(prompts.prompt_diff(full, faster))
+    store.set_prompt(diff)
+
+    narrowed = builder.build([], [topic(("b", "l", "cpu"), fields=frozenset({"user"}))])
+    store.set_prompt(json.dumps(prompts.prompt_diff(faster, narrowed)))
+    store.set_prompt(diff)
+
+    prompt = store.get_prompt()
+    assert prompt.interval == 0.5
+    assert prompt.cpu.fields == ["user"]
+    assert prompt.net.fields == []
+
+
+def test_least_recently_used_prompt_is_dropped():
+    store = PromptStore()
+    digests = [
+        store.set_prompt(json.dumps({"mark": "std", "interval": idx + 1}))
+        for idx in range(PROMPT_CACHE_SIZE)
+    ]
+    assert store.use_prompt(digests[0])
+    store.set_prompt(json.dumps({"mark": "std", "interval": 100}))
+
+    assert store.use_prompt(digests[0])
+    assert store.get_prompt().interval == 1
+    assert not store.use_prompt(digests[1])
@@ -0,0 +1,74 @@
+import asyncio as aio
+import itertools
+
+import config
+from scheduler import Scheduler
+
+
+class Tracker:
+    COST = 1
+    TIMEOUT = None
+
+    def __init__(self, cat: str, changing: bool):
+        self.cat = cat
+        self.changing = changing
+        self.calls = 0
+
+    def __str__(self):
+        return self.cat
+
+    def track(self, prompt):
+        self.calls += 1
+        return {"value": self.calls if self.changing else 0}
+
+
+class Prompt:
+    def interval_of(self, cat: str, cost: int = 1) -> float:
+        return 1.0
+
+
+# tracker calls over minutes of simulated time
+def sample(scheduler: Scheduler, seconds: int, start: int = 0):
+    async def run():
+        for now in range(start * 10, (start + seconds) * 10):
+            await scheduler.run_due(Prompt(), now / 10)
+
+    aio.run(run())
+
+
+def test_unchanged_category_backs_off():
+    busy, idle = Tracker("cpu", True), Tracker("fan", False)
+    scheduler = Scheduler([busy, idle])
+    sample(scheduler, 300)
+    assert busy.calls == 300
+    # 1, 2, 4 seconds and then every UNCHANGED_BACKOFF_MAX
+    assert idle.calls < 300 / config.UNCHANGED_BACKOFF_MAX + 4
+    assert scheduler.report(300) == {"cpu": {"value": 300}, "fan": {"value": 0}}
+
+
+def test_change_restores_interval():
+    values = itertools.chain([0] * 6, itertools.count(1))
+    tracker = Tracker("tmp", False)
+    tracker.track = lambda prompt: next(values)
+    scheduler = Scheduler([tracker])
+    sample(scheduler, 20)
+    assert scheduler.backoff["tmp"] == config.UNCHANGED_BACKOFF_MAX
+    # samples change from the next one on
+    sample(scheduler, 20, start=20)
+    assert "tmp" not in scheduler.backoff
+
+    scheduler.reset()
+    assert not scheduler.backoff
+
+
+def test_host_without_trackers_sleeps_until_empty_report_is_due(monkeypatch):
+    monkeypatch.setattr(config, "REPORT_UNCHANGED_AFTER", 0.01)
+    scheduler = Scheduler([])
+
+    async def run():
+        await scheduler.run_due(Prompt(), 100)
+        await scheduler.sleep()
+        await aio.wait_for(scheduler.sleep(), 1)
+
+    aio.run(run())
+    assert scheduler.report(100) == {}
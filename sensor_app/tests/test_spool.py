@@ -0,0 +1,43 @@
+import json
+
+import config
+from spool import Spool, RECORD
+
+
+def times(records: list[bytes]) -> list[int]:
+    return [json.loads(record)["time"] for record in records]
+
+
+def test_restarted_sensor_resumes_after_sent_records(tmp_path):
+    spool = Spool(str(tmp_path))
+    for time in range(10):
+        spool.append("std", time, {"cpu": {"user": 1.0}})
+    records, cursor = spool.peek(1)
+    assert times(records) == [0]
+    spool.release(cursor)
+    records, cursor = spool.peek(3 * (RECORD.size + len(records[0])))
+    assert times(records) == [1, 2, 3]
+    spool.release(cursor)
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    records, cursor = spool.peek(config.SPOOL_BATCH_SIZE)
+    assert times(records) == list(range(4, 10))
+    spool.release(cursor)
+    assert not spool
+    spool.close()
+
+
+def test_segment_of_previous_version_is_replayed_whole(tmp_path):
+    data = json.dumps({"mark": "std", "time": 7, "body": {}}).encode()
+    # no header, records start right away
+    (tmp_path / "00000000.seg").write_bytes(RECORD.pack(len(data)) + data)
+    spool = Spool(str(tmp_path))
+    records, cursor = spool.peek(config.SPOOL_BATCH_SIZE)
+    assert times(records) == [7]
+    spool.release(cursor)
+    # new reports go on after the old ones
+    spool.append("std", 8, {})
+    records, _ = spool.peek(config.SPOOL_BATCH_SIZE)
+    assert times(records) == [8]
+    spool.close()
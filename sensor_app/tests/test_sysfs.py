@@ -0,0 +1,118 @@
+import pytest
+
+import config
+from prompt import Prompt
+from registry import load_trackers
+
+
+# units of cpu specs, the deployment provides its own scheme/specs.json
+SPECS_SCHEME = {
+    "cpu": {
+        "units": {"cores_phys": "", "cores_logic": "", "min_freq": "mhz", "max_freq": "mhz"}
+    }
+}
+
+
+@pytest.fixture
+def specs_scheme(monkeypatch):
+    import sensor
+
+    monkeypatch.setattr(sensor, "specs_scheme", lambda: SPECS_SCHEME)
+    return SPECS_SCHEME
+
+
+def write(path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+@pytest.fixture
+def sysfs(tmp_path, monkeypatch):
+    hwmon = tmp_path / "class" / "hwmon"
+    write(hwmon / "hwmon0" / "name", "k10temp\n")
+    write(hwmon / "hwmon0" / "temp1_input", "45500\n")
+    write(hwmon / "hwmon0" / "temp1_max", "70000\n")
+    write(hwmon / "hwmon0" / "temp1_label", "Tctl\n")
+    # unlabeled input of the second chip, which has fans too
+    write(hwmon / "hwmon1" / "name", "nct6775\n")
+    write(hwmon / "hwmon1" / "temp2_input", "61000\n")
+    write(hwmon / "hwmon1" / "fan1_input", "1200\n")
+    write(hwmon / "hwmon1" / "fan1_min", "300\n")
+    write(hwmon / "hwmon1" / "fan2_input", "900\n")
+
+    drm = tmp_path / "class" / "drm"
+    write(drm / "card0" / "device" / "gpu_busy_percent", "40\n")
+    write(drm / "card0" / "device" / "mem_info_vram_used", f"{512 * 1024**2}\n")
+    write(drm / "card0" / "device" / "mem_info_vram_total", f"{8 * 1024**3}\n")
+    write(drm / "card1" / "device" / "gpu_busy_percent", "10\n")
+    # connector of card0, not a gpu
+    write(drm / "card0-DP-1" / "device" / "gpu_busy_percent", "0\n")
+
+    monkeypatch.setattr(config, "SYSFS_ROOT", str(tmp_path))
+    return tmp_path
+
+
+def track(tracker, **cat_prompt) -> dict:
+    return tracker.track(Prompt(prompt_dict={str(tracker): cat_prompt}))
+
+
+def test_sysfs_trackers_report_the_fake_tree(sysfs):
+    gpu, tmp, fan = load_trackers(["gpu", "tmp", "fan"])
+
+    assert tmp.specs == {"zones": ["k10temp/Tctl", "nct6775/temp2"]}
+    assert track(tmp, fields=["current", "high"], detailed=1) == {
+        "k10temp/Tctl": {"current": 45.5, "high": 70.0},
+        "nct6775/temp2": {"current": 61.0},
+    }
+    # the hottest zone
+    assert track(tmp, fields=["current"], units={"current": "f"}) == {"current": 141.8}
+
+    assert fan.specs == {"fans": ["nct6775/fan1", "nct6775/fan2"]}
+    assert track(fan, fields=["rpm", "min"], detailed=1) == {
+        "nct6775/fan1": {"rpm": 1200, "min": 300},
+        "nct6775/fan2": {"rpm": 900},
+    }
+    assert track(fan, fields=["rpm", "min"]) == {"rpm": 1050, "min": 300}
+
+    assert gpu.specs["gpus"] == ["card0", "card1"]
+    assert track(gpu, fields=["load", "memory"], detailed=1) == {
+        "card0": {"load": 40, "memory": 512.0},
+        "card1": {"load": 10},
+    }
+    assert track(gpu, fields=["load", "memory"], units={"memory": "gb"}) == {
+        "load": 25.0,
+        "memory": 0.5,
+    }
+
+
+def test_values_are_read_again_every_tick(sysfs):
+    (tmp,) = load_trackers(["tmp"])
+    write(sysfs / "class" / "hwmon" / "hwmon1" / "temp2_input", "75250\n")
+    assert track(tmp, fields=["current"]) == {"current": 75.2}
+
+
+def test_trackers_without_hardware_are_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SYSFS_ROOT", str(tmp_path))
+    assert load_trackers(["gpu", "tmp", "fan"]) == []
+
+
+def test_psutil_disks_are_summed_without_partitions(sysfs, monkeypatch):
+    from sensor import whole_disks
+
+    names = ("sda", "sda1", "sda2", "nvme0n1", "nvme0n1p1", "mmcblk0", "mmcblk0p1", "dm-0")
+    # no block devices in sysfs, partitions are told by name
+    whole_disks.cache_clear()
+    assert whole_disks(names) == {"sda", "nvme0n1", "mmcblk0", "dm-0"}
+
+    for name in ("sda", "nvme0n1"):
+        (sysfs / "block" / name).mkdir(parents=True)
+    whole_disks.cache_clear()
+    assert whole_disks(names) == {"sda", "nvme0n1"}
+    whole_disks.cache_clear()
+
+
+def test_cpu_specs_follow_units_of_the_scheme(specs_scheme):
+    (cpu,) = load_trackers(["cpu"])
+    assert cpu.specs["cores_logic"] >= 1
+    # values with units become strings
+    assert cpu.specs["max_freq"].endswith(" mhz")
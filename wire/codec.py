@@ -0,0 +1,266 @@
+import sys
+import json
+import math
+import zlib
+import struct
+import hashlib
+from array import array
+
+
+# every message between sensor and backend is a length-prefixed frame
+# json frames are utf-8 text, binary frames start with MAGIC byte
+# which can never be the first byte of json document or text command
+MAGIC = 0xB1
+VERSION = 1
+
+CODEC_BIN = f"bin{VERSION}"
+CODEC_JSON = "json"
+# ordered by preference, json is always available as a fallback
+CODECS = (CODEC_BIN, CODEC_JSON)
+
+# kinds of binary frames
+KIND_REPORT = 1
+# samples of the same schema, header has time of the last one and is followed by
+# number of samples, times of samples and then values column by column: every field
+# of schema is followed by the next one, not every sample
+KIND_BATCH = 2
+
+# magic, version, kind, schema id, time
+BIN_HEADER = struct.Struct("<BBBxId")
+# number of samples in batch
+BATCH_HEADER = struct.Struct("<I")
+
+# layouts of category inside report
+ROW_FLAT = 0  # {field: value}
+ROW_LIST = 1  # [{field: value}, ...], e.g. per core
+ROW_NAMED = 2  # {name: {field: value}}, e.g. per nic or per disk
+
+NAN = math.nan
+
+
+def negotiate(offered, accepted=CODECS) -> str:
+    for codec in accepted:
+        if codec in offered:
+            return codec
+    return CODEC_JSON
+
+
+# backend sends f"{CMD_USE}{hash}" instead of prompt sensor has seen already
+CMD_USE = "use "
+# sensor holding token from f"ack?{codec}?{token}" reconnects with
+# f"{CMD_RESUME}{token}?{hash of specs frame}" instead of specs,
+# backend not knowing the token asks for full specs with CMD_SPECS
+CMD_RESUME = "resume?"
+CMD_SPECS = "specs?"
+
+
+# hash of prompts and specs frames, the same on sensor and backend
+def content_hash(data: str | bytes) -> str:
+    if isinstance(data, str):
+        data = data.encode(encoding="utf-8")
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def is_binary(frame) -> bool:
+    return len(frame) > 0 and frame[0] == MAGIC
+
+
+class Schema:
+    """
+    Describes how numeric fields of report are packed into array('d').
+    Sensor sends schema once as json frame {"type": "schema", ...},
+    after that every binary report refers to it by id. Categories left out
+    of reports as stale are part of the schema, they change the layout anyway
+    """
+
+    __slots__ = ("id", "mark", "cats", "stale", "size")
+
+    def __init__(self, mark: str, cats: list, stale=()):
+        self.mark = mark
+        # ((cat, layout, fields, rows), ...)
+        # rows is tuple of names for ROW_NAMED and number of rows otherwise
+        self.cats = _layout(cats)
+        self.stale = tuple(stale)
+        self.size = sum(
+            len(fields) * (len(rows) if layout == ROW_NAMED else rows)
+            for _, layout, fields, rows in self.cats
+        )
+        self.id = zlib.crc32(
+            json.dumps([mark, self.cats, self.stale]).encode(encoding="utf-8")
+        )
+
+    @classmethod
+    def from_report(cls, mark: str, report: dict, stale=()):
+        cats = []
+        for cat, data in report.items():
+            if isinstance(data, list):
+                fields = data[0].keys() if data else ()
+                cats.append((cat, ROW_LIST, fields, len(data)))
+            elif data and isinstance(next(iter(data.values())), dict):
+                fields = next(iter(data.values())).keys()
+                cats.append((cat, ROW_NAMED, fields, data.keys()))
+            else:
+                cats.append((cat, ROW_FLAT, data.keys(), 1))
+
+        key = (mark, _layout(cats), tuple(stale))
+        if (schema := _SCHEMAS.get(key)) is None:
+            schema = _SCHEMAS[key] = cls(mark, cats, stale)
+        return schema
+
+    @classmethod
+    def from_dict(cls, schema_dict: dict):
+        return cls(schema_dict["mark"], schema_dict["cats"], schema_dict.get("stale", ()))
+
+    def to_dict(self) -> dict:
+        schema_dict = {"type": "schema", "id": self.id, "mark": self.mark, "cats": self.cats}
+        if self.stale:
+            schema_dict["stale"] = self.stale
+        return schema_dict
+
+
+# schemas built by sensor, keyed by report layout
+_SCHEMAS = {}
+
+
+def _layout(cats) -> tuple:
+    return tuple(
+        (cat, layout, tuple(fields), tuple(rows) if layout == ROW_NAMED else rows)
+        for cat, layout, fields, rows in cats
+    )
+
+
+def _pack(schema: Schema, report: dict) -> array:
+    values = array("d")
+    for cat, layout, fields, rows in schema.cats:
+        data = report[cat]
+        if layout == ROW_FLAT:
+            values.extend(data.get(field, NAN) for field in fields)
+        elif layout == ROW_LIST:
+            for row in data:
+                values.extend(row.get(field, NAN) for field in fields)
+        else:
+            for name in rows:
+                row = data[name]
+                values.extend(row.get(field, NAN) for field in fields)
+    return values
+
+
+def encode_report(schema: Schema, time: float, report: dict) -> bytes:
+    values = _pack(schema, report)
+    # values are always sent little-endian
+    if sys.byteorder == "big":
+        values.byteswap()
+    header = BIN_HEADER.pack(MAGIC, VERSION, KIND_REPORT, schema.id, time)
+    return header + values.tobytes()
+
+
+class Batch:
+    """
+    Samples of one schema collected by sensor to be sent in one frame,
+    reports are kept as they are until the batch is encoded into columns
+    """
+
+    __slots__ = ("schema", "times", "reports")
+
+    def __init__(self, schema: Schema):
+        self.schema = schema
+        self.times = []
+        self.reports = []
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def add(self, time: float, report: dict):
+        self.times.append(time)
+        self.reports.append(report)
+
+    def encode(self) -> bytes:
+        size, count = self.schema.size, len(self.times)
+        rows = array("d")
+        for report in self.reports:
+            rows.extend(_pack(self.schema, report))
+        values = array("d", self.times)
+        for col in range(size):
+            values.extend(rows[col::size])
+        if sys.byteorder == "big":
+            values.byteswap()
+        header = BIN_HEADER.pack(MAGIC, VERSION, KIND_BATCH, self.schema.id, self.times[-1])
+        return header + BATCH_HEADER.pack(count) + values.tobytes()
+
+
+def decode_header(frame) -> tuple[int, int, float]:
+    magic, version, kind, schema_id, time = BIN_HEADER.unpack_from(frame)
+    if version != VERSION:
+        raise ValueError(f"Unsupported binary frame version {version}")
+    return kind, schema_id, time
+
+
+def _doubles(body: memoryview) -> memoryview | array:
+    if sys.byteorder == "big":
+        values = array("d", body.tobytes())
+        values.byteswap()
+        return values
+    return body.cast("d")
+
+
+def decode_values(schema: Schema, frame) -> memoryview | array:
+    body = memoryview(frame)[BIN_HEADER.size :]
+    if len(body) != schema.size * 8:
+        raise ValueError(
+            f"Report of {len(body)} bytes doesn't match schema {schema.id} of {schema.size} fields"
+        )
+    return _doubles(body)
+
+
+def decode_report(schema: Schema, frame) -> dict:
+    """
+    Builds the report body straight from packed values,
+    missing fields (NaN) are left out
+    """
+
+    return unpack_report(schema.cats, decode_values(schema, frame))
+
+
+# times of samples and their values column by column, see KIND_BATCH
+def decode_batch(schema: Schema, frame) -> tuple[memoryview | array, memoryview | array]:
+    count = BATCH_HEADER.unpack_from(frame, BIN_HEADER.size)[0]
+    body = memoryview(frame)[BIN_HEADER.size + BATCH_HEADER.size :]
+    if len(body) != (schema.size + 1) * count * 8:
+        raise ValueError(
+            f"Batch of {len(body)} bytes doesn't hold {count} samples of schema {schema.id}"
+        )
+    values = _doubles(body)
+    return values[:count], values[count:]
+
+
+# report of sample idx of batch, values being columns of count samples
+def batch_report(cats: tuple, values, count: int, idx: int) -> dict:
+    return unpack_report(cats, values[idx::count])
+
+
+def unpack_report(cats: tuple, values) -> dict:
+    report = {}
+    offset = 0
+    for cat, layout, fields, rows in cats:
+        width = len(fields)
+        if layout == ROW_FLAT:
+            report[cat] = _row(fields, values, offset)
+            offset += width
+        elif layout == ROW_LIST:
+            report[cat] = [_row(fields, values, offset + i * width) for i in range(rows)]
+            offset += width * rows
+        else:
+            report[cat] = {
+                name: _row(fields, values, offset + i * width)
+                for i, name in enumerate(rows)
+            }
+            offset += width * len(rows)
+    return report
+
+
+def _row(fields: tuple, values, offset: int) -> dict:
+    return {
+        field: value
+        for field, value in zip(fields, values[offset : offset + len(fields)])
+        if value == value
+    }
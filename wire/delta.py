@@ -0,0 +1,220 @@
+import sys
+import json
+import time
+import zlib
+
+
+# Delta reporting: sensor sends keyframe with the full report every `keyframe` ticks
+# and in between only fields changed by more than `epsilon` since they were last sent.
+# Frames are json documents {"type": "delta", "header": ..., "seq": N, ...},
+# categories left out of report as stale are listed in "stale" of every frame
+# keyframe: {"key": 1, "body": {cat: ...}}
+# delta:    {"set": [[cat, row, field, value], ...]}, row is null for flat categories,
+#           index of the row for per core ones and name of the row for per nic ones
+
+# compressed frames start with this byte followed by zlib stream,
+# it can't be the first byte of json document, text command or binary frame
+ZLIB = 0xB2
+# compressing smaller frames doesn't pay off
+COMPRESS_MIN_SIZE = 256
+
+COMPRESSORS = ("zlib",)
+
+
+def compress(data: bytes, method: str | None) -> bytes:
+    if method == "zlib" and len(data) >= COMPRESS_MIN_SIZE:
+        return bytes((ZLIB,)) + zlib.compress(data, 1)
+    return data
+
+
+def is_compressed(frame) -> bool:
+    return len(frame) > 0 and frame[0] == ZLIB
+
+
+def decompress(frame, max_size: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(memoryview(frame)[1:], max_size)
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Compressed frame expands beyond {max_size} bytes")
+    return data
+
+
+def flatten(body: dict) -> dict:
+    """
+    (cat, row, field) -> value of every field in report body,
+    row is None for flat categories
+    """
+
+    flat = {}
+    for cat, data in body.items():
+        if isinstance(data, list):
+            for row, values in enumerate(data):
+                for field, value in values.items():
+                    flat[cat, row, field] = value
+        elif data and isinstance(next(iter(data.values())), dict):
+            for row, values in data.items():
+                for field, value in values.items():
+                    flat[cat, row, field] = value
+        else:
+            for field, value in data.items():
+                flat[cat, None, field] = value
+    return flat
+
+
+class DeltaEncoder:
+    """
+    Sensor side: remembers values last sent to backend.
+    Every change of report layout (new prompt, nic appeared) forces keyframe,
+    so deltas never have to remove fields
+    """
+
+    __slots__ = ("params", "keyframe", "epsilon", "compress", "mark", "tick", "seq", "sent")
+
+    # params come from "delta" of prompt: {"keyframe": N, "epsilon": E, "compress": "zlib"}
+    def __init__(self, params: dict):
+        self.params = params
+        self.keyframe = max(params.get("keyframe", 30), 1)
+        self.epsilon = params.get("epsilon", 0)
+        # unknown compressors are ignored rather than breaking reports
+        self.compress = params.get("compress", None)
+        if self.compress not in COMPRESSORS:
+            self.compress = None
+        self.mark = None
+        self.tick = 0
+        self.seq = 0
+        # (cat, row, field) -> value known to backend
+        self.sent = {}
+
+    def encode(self, mark: str, body: dict) -> dict:
+        flat = flatten(body)
+        self.seq += 1
+        if (
+            mark != self.mark
+            or self.tick % self.keyframe == 0
+            or flat.keys() != self.sent.keys()
+        ):
+            self.mark = mark
+            self.tick = 1
+            self.sent = flat
+            return {"seq": self.seq, "key": 1, "body": body}
+
+        self.tick += 1
+        changes = []
+        sent = self.sent
+        epsilon = self.epsilon
+        for path, value in flat.items():
+            old = sent[path]
+            # drift is measured against the value backend has, so it can't creep
+            if value != old and not (
+                isinstance(value, (int, float))
+                and isinstance(old, (int, float))
+                and abs(value - old) <= epsilon
+            ):
+                sent[path] = value
+                changes.append((*path, value))
+        return {"seq": self.seq, "set": changes}
+
+    def frame(self, header: str, mark: str, body: dict, stale=()) -> bytes:
+        delta = self.encode(mark, body)
+        if stale:
+            delta["stale"] = list(stale)
+        data = json.dumps({"type": "delta", "header": header, **delta})
+        return compress(data.encode(encoding="utf-8"), self.compress)
+
+
+class DeltaDecoder:
+    """
+    Backend side: full report of one sensor rebuilt from keyframes and deltas.
+    Changed categories and rows are copied, so reports returned earlier stay intact
+    """
+
+    __slots__ = ("seq", "report")
+
+    def __init__(self):
+        self.seq = None
+        self.report = None
+
+    # returns full report or None when delta doesn't follow the known state
+    def apply(self, delta: dict) -> dict | None:
+        seq = delta["seq"]
+        if delta.get("key"):
+            self.seq = seq
+            self.report = delta["body"]
+            return self.report
+        if self.report is None or seq != self.seq + 1:
+            # the next keyframe brings the state back
+            return None
+        self.seq = seq
+
+        report = dict(self.report)
+        copied = set()
+        for cat, row, field, value in delta["set"]:
+            if cat not in copied:
+                data = report[cat]
+                report[cat] = list(data) if isinstance(data, list) else dict(data)
+                copied.add(cat)
+            data = report[cat]
+            if row is None:
+                data[field] = value
+                continue
+            if (cat, row) not in copied:
+                data[row] = dict(data[row])
+                copied.add((cat, row))
+            data[row][field] = value
+        self.report = report
+        return report
+
+
+# python -m wire.delta [TICKS]
+# compares bytes sent by idle node with full json reports and with deltas
+def _bench(ticks: int):
+    def body(tick: int) -> dict:
+        return {
+            "cpu": [
+                {"user": 1.0 + (core == 0) * (tick % 3), "system": 0.5, "idle": 98.5, "freq": 2400}
+                for core in range(32)
+            ],
+            "net": {
+                f"eth{nic}": {"recv": 0.1 * (tick % 2) * (nic == 0), "sent": 0.0, "errin": 0, "errout": 0}
+                for nic in range(4)
+            },
+            "mem": {"total": 65536, "used": 2048 + (tick % 5 == 0), "swap": 0},
+            "dsk": {
+                f"sd{chr(97 + disk)}": {"read": 0.0, "write": 0.2 * (disk == 0), "total": 1024**3}
+                for disk in range(8)
+            },
+        }
+
+    bodies = [body(tick) for tick in range(ticks)]
+    frames = [json.dumps({"header": "std!bench!node!std!0", **b}).encode() for b in bodies]
+    start = time.perf_counter()
+    for frame in frames:
+        json.loads(frame)
+    full_time = time.perf_counter() - start
+    full = sum(map(len, frames))
+
+    # without epsilon every rebuilt report is exactly the one sensor had
+    encoder = DeltaEncoder({"keyframe": 30})
+    decoder = DeltaDecoder()
+    for b in bodies:
+        assert decoder.apply(json.loads(encoder.frame("delta!bench!node!std!0", "std", b))) == b
+
+    for method in (None, "zlib"):
+        encoder = DeltaEncoder({"keyframe": 30, "epsilon": 0.05, "compress": method})
+        frames = [encoder.frame("delta!bench!node!std!0", "std", b) for b in bodies]
+        decoder = DeltaDecoder()
+        start = time.perf_counter()
+        for frame in frames:
+            if is_compressed(frame):
+                frame = decompress(frame, 1024**2)
+            decoder.apply(json.loads(frame))
+        delta_time = time.perf_counter() - start
+        print(
+            f"{method or 'plain'} deltas: {sum(map(len, frames)) / ticks:.0f} bytes "
+            f"and {delta_time / ticks * 1e6:.1f} us to rebuild per tick, "
+            f"full reports: {full / ticks:.0f} bytes and {full_time / ticks * 1e6:.1f} us to parse"
+        )
+
+
+if __name__ == "__main__":
+    _bench(int(sys.argv[1]) if len(sys.argv) >= 2 else 3000)
@@ -0,0 +1,189 @@
+import time
+import struct
+import socket
+import logging
+import asyncio as aio
+
+
+logger = logging.getLogger(__name__)
+
+
+# frame is 4-byte native int with the size of payload followed by payload
+SIZE = struct.Struct("i")
+# frames bigger than that are treated as corrupted stream
+MAX_FRAME_SIZE = 16 * 1024**2
+# initial capacity of receive buffer, it grows up to max frame size
+BUFFER_SIZE = 64 * 1024
+
+
+class FrameTooLarge(ConnectionError):
+    pass
+
+
+def check_size(size: int, max_size: int):
+    if size < 0 or size > max_size:
+        raise FrameTooLarge(f"Frame of {size} bytes exceeds limit of {max_size} bytes")
+
+
+async def read_frame(reader: aio.StreamReader, max_size: int = MAX_FRAME_SIZE) -> bytes:
+    """
+    Reads whole frame, short reads are impossible unlike with reader.read(size).
+    Raises aio.IncompleteReadError when peer disconnects
+    """
+
+    size = SIZE.unpack(await reader.readexactly(SIZE.size))[0]
+    check_size(size, max_size)
+    return await reader.readexactly(size)
+
+
+# header and payload go with a single write and drain
+async def write_frame(writer: aio.StreamWriter, data: bytes):
+    writer.writelines((SIZE.pack(len(data)), data))
+    await writer.drain()
+
+
+class FrameBuffer:
+    """
+    Preallocated receive buffer splitting stream into frames.
+    Transport writes straight into get_buffer(), complete frames are handed
+    out as memoryviews into the buffer, so they are valid only until next get_buffer()
+    """
+
+    __slots__ = ("buf", "view", "start", "end", "max_size")
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.buf = bytearray(min(BUFFER_SIZE, max_size + SIZE.size))
+        self.view = memoryview(self.buf)
+        # unconsumed data is buf[start:end]
+        self.start = 0
+        self.end = 0
+        self.max_size = max_size
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        # move the tail of partial frame to the beginning
+        if self.start:
+            pending = self.end - self.start
+            self.view[:pending] = self.view[self.start : self.end]
+            self.start, self.end = 0, pending
+        if self.end == len(self.buf):
+            self._grow(len(self.buf) * 2)
+        return self.view[self.end :]
+
+    def buffer_updated(self, nbytes: int):
+        self.end += nbytes
+
+    def frames(self):
+        while self.end - self.start >= SIZE.size:
+            size = SIZE.unpack_from(self.buf, self.start)[0]
+            check_size(size, self.max_size)
+            frame_end = self.start + SIZE.size + size
+            if frame_end > self.end:
+                # frame doesn't fit, make room for it at the next get_buffer
+                if frame_end - self.start > len(self.buf):
+                    self._grow(frame_end - self.start)
+                return
+            frame = self.view[self.start + SIZE.size : frame_end]
+            self.start = frame_end
+            yield frame
+
+    def _grow(self, capacity: int):
+        capacity = min(max(capacity, len(self.buf)), self.max_size + SIZE.size)
+        if capacity == len(self.buf):
+            return
+        # frames handed out earlier keep the old buffer alive
+        pending = self.end - self.start
+        buf = bytearray(capacity)
+        buf[:pending] = self.view[self.start : self.end]
+        self.buf, self.view = buf, memoryview(buf)
+        self.start, self.end = 0, pending
+
+
+class FrameProtocol(aio.BufferedProtocol):
+    """
+    Base protocol receiving frames without copying,
+    subclasses implement frame_received(frame: memoryview).
+    Frame it fails on goes to frame_failed, frames after it are still received
+    """
+
+    def __init__(self, max_size: int = MAX_FRAME_SIZE):
+        self.frames = FrameBuffer(max_size)
+        self.transport = None
+
+    def connection_made(self, transport: aio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        self.frames.buffer_updated(nbytes)
+        try:
+            for frame in self.frames.frames():
+                try:
+                    self.frame_received(frame)
+                except Exception as exc:
+                    self.frame_failed(frame, exc)
+        except FrameTooLarge:
+            self.transport.abort()
+            raise
+
+    def frame_received(self, frame: memoryview):
+        raise NotImplementedError
+
+    def frame_failed(self, frame: memoryview, exc: Exception):
+        peer = self.transport.get_extra_info("peername")
+        logger.warning(f"Dropped frame of {len(frame)} bytes from {peer}: {exc!r}")
+
+    def send_frame(self, data: bytes):
+        self.transport.writelines((SIZE.pack(len(data)), data))
+
+
+# python -m wire.framing
+# floods frames through socketpair and measures throughput of both readers
+async def _bench(frames: int = 100_000, size: int = 512):
+    payload = bytes(size)
+    loop = aio.get_running_loop()
+
+    async def flood(sock: socket.socket):
+        _, writer = await aio.open_connection(sock=sock)
+        for _ in range(frames):
+            writer.writelines((SIZE.pack(len(payload)), payload))
+            if writer.transport.get_write_buffer_size() > 1024**2:
+                await writer.drain()
+        await writer.drain()
+        writer.close()
+
+    rsock, wsock = socket.socketpair()
+    reader, writer = await aio.open_connection(sock=rsock)
+    start = time.perf_counter()
+    flooding = aio.create_task(flood(wsock))
+    for _ in range(frames):
+        await read_frame(reader)
+    await flooding
+    elapsed = time.perf_counter() - start
+    print(f"read_frame:    {frames / elapsed:,.0f} frames/s")
+    writer.close()
+
+    class Counter(FrameProtocol):
+        def __init__(self):
+            super().__init__()
+            self.received = 0
+            self.done = loop.create_future()
+
+        def frame_received(self, frame: memoryview):
+            self.received += 1
+            if self.received == frames:
+                self.done.set_result(None)
+
+    rsock, wsock = socket.socketpair()
+    start = time.perf_counter()
+    _, counter = await loop.connect_accepted_socket(Counter, rsock)
+    flooding = aio.create_task(flood(wsock))
+    await counter.done
+    await flooding
+    elapsed = time.perf_counter() - start
+    print(f"FrameProtocol: {frames / elapsed:,.0f} frames/s")
+
+
+if __name__ == "__main__":
+    aio.run(_bench())
@@ -0,0 +1,165 @@
+import socket
+import struct
+import asyncio as aio
+
+import pytest
+
+from wire.framing import SIZE, BUFFER_SIZE, FrameBuffer, FrameProtocol, FrameTooLarge
+from wire.framing import read_frame
+
+
+FRAMES = 100_000
+
+
+# payload of frame idx, sizes vary so frames straddle reads, some outgrow the buffer
+def payload(idx: int) -> bytes:
+    size = 3 * BUFFER_SIZE if idx % 10_000 == 1 else idx % 300
+    return struct.pack("<I", idx) + bytes(size)
+
+
+async def flood(sock: socket.socket, frames: int = FRAMES, tail: bytes = b""):
+    _, writer = await aio.open_connection(sock=sock)
+    for idx in range(frames):
+        data = payload(idx)
+        writer.writelines((SIZE.pack(len(data)), data))
+        if writer.transport.get_write_buffer_size() > 1024**2:
+            await writer.drain()
+    writer.write(tail)
+    await writer.drain()
+    writer.close()
+
+
+class Collector(FrameProtocol):
+    def __init__(self, max_size: int | None = None):
+        super().__init__(*(() if max_size is None else (max_size,)))
+        self.received = 0
+        self.errors = []
+        self.lost = aio.get_running_loop().create_future()
+
+    def frame_received(self, frame: memoryview):
+        idx = struct.unpack_from("<I", frame)[0]
+        if idx != self.received or bytes(frame) != payload(idx):
+            self.errors.append(idx)
+        self.received += 1
+
+    def connection_lost(self, exc: Exception | None):
+        self.lost.set_result(exc)
+
+
+async def accept(protocol, sock: socket.socket):
+    _, proto = await aio.get_running_loop().connect_accepted_socket(protocol, sock)
+    return proto
+
+
+def test_read_frame_gets_every_frame_of_flood():
+    async def run():
+        rsock, wsock = socket.socketpair()
+        reader, writer = await aio.open_connection(sock=rsock)
+        flooding = aio.create_task(flood(wsock))
+        for idx in range(FRAMES):
+            assert await read_frame(reader) == payload(idx)
+        await flooding
+        # peer is gone
+        with pytest.raises(aio.IncompleteReadError):
+            await read_frame(reader)
+        writer.close()
+
+    aio.run(run())
+
+
+def test_frame_protocol_gets_every_frame_of_flood():
+    async def run():
+        rsock, wsock = socket.socketpair()
+        proto = await accept(Collector, rsock)
+        await flood(wsock)
+        await proto.lost
+        assert proto.received == FRAMES
+        assert proto.errors == []
+
+    aio.run(run())
+
+
+def test_read_frame_rejects_oversize_frame():
+    async def run():
+        reader = aio.StreamReader()
+        reader.feed_data(SIZE.pack(1025) + bytes(1025))
+        with pytest.raises(FrameTooLarge):
+            await read_frame(reader, 1024)
+        reader = aio.StreamReader()
+        reader.feed_data(SIZE.pack(-1))
+        with pytest.raises(FrameTooLarge):
+            await read_frame(reader, 1024)
+
+    aio.run(run())
+
+
+def test_frame_protocol_aborts_on_oversize_frame():
+    async def run():
+        rsock, wsock = socket.socketpair()
+        proto = await accept(lambda: Collector(4 * BUFFER_SIZE), rsock)
+        oversize = SIZE.pack(4 * BUFFER_SIZE + 1) + bytes(4 * BUFFER_SIZE + 1)
+        await flood(wsock, 10, tail=oversize + SIZE.pack(4) + struct.pack("<I", 10))
+        await proto.lost
+        assert proto.transport.is_closing()
+        # frames before the oversize one got through, nothing after it
+        assert proto.received == 10
+        assert proto.errors == []
+
+    aio.run(run())
+
+
+def test_short_read_keeps_partial_frame():
+    async def run():
+        reader = aio.StreamReader()
+        reader.feed_data(SIZE.pack(8) + b"1234")
+        reader.feed_eof()
+        with pytest.raises(aio.IncompleteReadError):
+            await read_frame(reader)
+
+        rsock, wsock = socket.socketpair()
+        proto = await accept(Collector, rsock)
+        await flood(wsock, 5, tail=SIZE.pack(8) + struct.pack("<I", 5))
+        await proto.lost
+        assert proto.received == 5
+        assert proto.errors == []
+
+    aio.run(run())
+
+
+# transport hands data over in pieces that don't line up with frames
+def test_frame_buffer_splits_stream_of_short_reads():
+    frames = FrameBuffer(4 * BUFFER_SIZE)
+    stream = b"".join(SIZE.pack(len(data)) + data for data in map(payload, range(20_002)))
+    got = []
+    pos = 0
+    while pos < len(stream):
+        buf = frames.get_buffer()
+        nbytes = min(len(buf), 7, len(stream) - pos)
+        buf[:nbytes] = stream[pos : pos + nbytes]
+        frames.buffer_updated(nbytes)
+        pos += nbytes
+        got.extend(bytes(frame) for frame in frames.frames())
+    assert got == list(map(payload, range(20_002)))
+
+
+class Picky(Collector):
+    def frame_received(self, frame: memoryview):
+        if struct.unpack_from("<I", frame)[0] % 3 == 0:
+            raise ValueError("can't decode")
+        super().frame_received(frame)
+
+    def frame_failed(self, frame: memoryview, exc: Exception):
+        self.errors.append(struct.unpack_from("<I", frame)[0])
+        self.received += 1
+
+
+def test_frame_that_fails_does_not_drop_the_rest():
+    async def run():
+        rsock, wsock = socket.socketpair()
+        proto = await accept(Picky, rsock)
+        await flood(wsock, 30)
+        assert await proto.lost is None
+        assert proto.received == 30
+        assert proto.errors == list(range(0, 30, 3))
+
+    aio.run(run())